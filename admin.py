@@ -1,17 +1,25 @@
-import copy
 import datetime
+import json
 from functools import wraps
 
 import bcrypt
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import create_access_token, verify_jwt_in_request, get_jwt, current_user
 from sqlalchemy.orm import joinedload
-from sqlalchemy import or_, func
+from sqlalchemy import func
 
 from database import db_session
+from exchanging import valid_candidates
+import events
+import instrumentation
+import jobs
+import progress
 from models import Admin, Student, Team, ExchangingNeed, CustomQuestionnaireItem, SystemSetting, QuestionnaireItem, \
-    MatchingScore, QuestionnaireAnswer, TeamRequest, TeamInvitation, get_system_setting, CustomQuestionnaireAnswer, \
-    ExchangingRequest
+    QuestionnaireAnswer, TeamInvitation, get_system_setting, AllocationPlan, ExchangingCandidate, Job, \
+    QuestionnaireRevision, ScanRun, set_system_setting
+from questionnaire import normalize_item, diff_items, current_items, invalidated_item_ids
+from partitions import CATEGORY_GROUPS_SETTING, parse_category_groups
+from score_matrix import published_blocks
 
 admin_pages = Blueprint('admin_pages', __name__, template_folder="templates/admin")
 
@@ -158,40 +166,14 @@ def student_list():
 @admin_required()
 def student_import():
     if request.json is not None and request.json.get("students", None) is not None:
-        students = request.json.get("students")
-
-        data_to_store = []
-        students_id_in_store = [item[0] for item in db_session.query(Student.id).all()]
-        for student in copy.deepcopy(students):
-            # 导入时要把学生姓名里的空格替换为#
-            space_count = student.split()
-            if len(space_count) != 5:
-                continue
-            id, name, gender, category, password = space_count
-            id = int(id)
-
-            # 查重
-            if id in students_id_in_store:
-                continue
-            else:
-                students_id_in_store.append(id)
-                students.remove(student)
-
-            name = name.replace("#", " ")
-            password = bcrypt.hashpw(bytes(password, encoding="utf8"), bcrypt.gensalt())
-            data_to_store.append(
-                Student(id=id, name=name, gender=gender, category=category, password=password, last_logged_at=None)
-            )
-
-        db_session.bulk_save_objects(data_to_store)
-
-        db_session.commit()
+        # 逐个 bcrypt 很慢，交给后台任务分批导入，导入失败的学生在任务结果的 fail_to_import 里
+        job = jobs.enqueue("student_import", {"students": request.json.get("students")}, current_user.id)
 
         return jsonify({
             "code": 200,
             "msg": "success",
             "data": {
-                "fail_to_import": students
+                "job_id": job.id
             }
         })
 
@@ -219,6 +201,10 @@ def student_update():
             if result is not True:
                 return result
 
+            # 性别或类别变化时学生换到另一个匹配分块
+            if student.gender != gender or (category is not None and student.category != category):
+                events.publish(events.EVENT_STUDENTS, student.id)
+
             student.name = name
             student.contact = contact
             student.gender = gender
@@ -318,7 +304,10 @@ def student_questionnaire():
                 if exist_answer.item_id == key:
                     need_to_create = False
                     if exist_answer.answer != str(value['answer']) or exist_answer.weight != value['weight']:
-                        exist_answer.answer = str(value['answer'])
+                        # 只改权重时保留文本向量，匹配任务按新权重重新汇总即可
+                        if exist_answer.answer != str(value['answer']):
+                            exist_answer.answer = str(value['answer'])
+                            exist_answer.vector = None
                         exist_answer.weight = value['weight']
                         exist_answer.updated_at = datetime.datetime.now()
                         db_session.commit()
@@ -334,14 +323,8 @@ def student_questionnaire():
 
         if data_changed:
             db_session.bulk_save_objects(bulk_save_models)
-            db_session.commit()
-
-            # 删除匹配得分
-            db_session.query(MatchingScore) \
-                .filter((MatchingScore.to_student_id == student.id) | (
-                    MatchingScore.from_student_id == student.id)) \
-                .delete(synchronize_session=False)
-
+            events.publish(events.EVENT_ANSWERS, student.id)
+            # 旧的匹配分在重新计算前继续用于推荐，匹配任务只重写这位学生的匹配分
             db_session.commit()
 
         return jsonify({
@@ -360,16 +343,15 @@ def student_delete():
         id = request.json.get('student_id', None)
         student = db_session.query(Student).get(id)
         if student is not None:
-            db_session.query(MatchingScore).where(or_(MatchingScore.from_student_id == student.id, MatchingScore.to_student_id == student.id)).delete()
-            db_session.query(TeamInvitation).where(TeamInvitation.from_student_id == student.id).delete()
-            db_session.query(TeamInvitation).where(TeamInvitation.to_student_id == student.id).update({
-                TeamInvitation.to_student_id: 0,
-                TeamInvitation.status: -2,
-                TeamInvitation.reason: "目标用户已被删除"
-            })
+            job = jobs.enqueue("student_delete", {"student_id": student.id}, current_user.id)
 
-            db_session.delete(student)
-            db_session.commit()
+            return jsonify({
+                "code": 200,
+                "msg": "success",
+                "data": {
+                    "job_id": job.id
+                }
+            })
 
     return jsonify({
         "code": 200,
@@ -418,6 +400,15 @@ def system_setting_get():
 @admin_required()
 def system_setting_update():
     if request.json is not None:
+        if CATEGORY_GROUPS_SETTING in request.json:
+            try:
+                parse_category_groups(request.json[CATEGORY_GROUPS_SETTING])
+            except (TypeError, ValueError):
+                return jsonify({
+                    "code": 400,
+                    "msg": "可混寝类别分组的格式不正确，应为类别名数组的数组，如 [[\"计算机类\", \"软件工程\"]]"
+                })
+
         for key, value in request.json.items():
             item_in_db = db_session.query(SystemSetting).filter(SystemSetting.key == key).first()
             if item_in_db is not None:
@@ -430,6 +421,10 @@ def system_setting_update():
                 item = SystemSetting(key=key, value=value)
                 db_session.add(item)
 
+            # 类别分组变化后学生所在的匹配分块随之变化
+            if key == CATEGORY_GROUPS_SETTING:
+                events.publish(events.EVENT_STUDENTS)
+
             db_session.commit()
 
     return jsonify({
@@ -473,47 +468,69 @@ def questionnaire_list():
 @admin_required()
 def questionnaire_set():
     if request.json is not None:
-        # 删除所有的匹配分
-        # 删除所有的问卷答案
-        old_items = [MatchingScore, QuestionnaireAnswer, QuestionnaireItem]
-        for old_item in old_items:
-            db_session.query(old_item).delete()
-            db_session.commit()
-
-        # 重新写入
-        item_list = []
-
-        for piece in request.json:
-            title = piece.get('title', None)
-            weight = piece.get('weight', None)
-            data_type = piece.get('data_type', None)
-            params = piece.get('params', "{}")
-            index = piece.get('index', None)
-            id = piece.get('id', None)
-            type = piece.get('type', 'text')
-            if type == 'text':
-                weight = 0
-
-            item = QuestionnaireItem(
-                title=title,
-                weight=weight,
-                data_type=data_type,
-                params=str(params),
-                index=index,
-                id=id,
-                type=type
-            )
-            item_list.append(item)
-
-        db_session.bulk_save_objects(item_list)
-        db_session.commit()
+        # 按题目比较差异后只作废受影响的答案和匹配分，数据量大时耗时较长，交给后台任务执行
+        job = jobs.enqueue("questionnaire_set", {"items": request.json}, current_user.id)
 
         return jsonify({
             "code": 200,
-            "msg": "success"
+            "msg": "success",
+            "data": {
+                "job_id": job.id
+            }
         })
 
 
+@admin_pages.post('/questionnaire/diff')
+@admin_required()
+def questionnaire_diff():
+    if type(request.json) is not list:
+        return jsonify({
+            "code": 400,
+            "msg": "问卷数据错误"
+        })
+
+    # 只预览修改问卷会影响哪些题目，不做任何修改
+    changes = diff_items(current_items(), [normalize_item(piece) for piece in request.json])
+    # affected_students 是匹配分会被删除的学生，reweighted_students 是只需按新权重重新汇总匹配分的学生
+    affected_students = db_session.query(func.count(func.distinct(QuestionnaireAnswer.student_id))) \
+        .filter(QuestionnaireAnswer.item_id.in_(invalidated_item_ids(changes))).scalar()
+    reweighted_students = db_session.query(func.count(func.distinct(QuestionnaireAnswer.student_id))) \
+        .filter(QuestionnaireAnswer.item_id.in_(changes["reweighted"])).scalar()
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": {
+            "changes": changes,
+            "affected_students": affected_students,
+            "reweighted_students": reweighted_students
+        }
+    })
+
+
+@admin_pages.get('/questionnaire/revision/list')
+@admin_required()
+def questionnaire_revision_list():
+    revisions = db_session.query(QuestionnaireRevision) \
+        .order_by(QuestionnaireRevision.id.desc()) \
+        .limit(request.args.get('limit', 20, type=int)) \
+        .all()
+
+    data = []
+    for revision in revisions:
+        item = revision.to_dict(rules=['-items', '-changes'])
+        item['changes'] = json.loads(revision.changes) if revision.changes else None
+        data.append(item)
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": {
+            "revisions": data
+        }
+    })
+
+
 @admin_pages.post('/system_reset/perform')
 @admin_required()
 # @jwt_required(fresh=True)
@@ -533,39 +550,15 @@ def system_reset():
             "msg": "密码错误"
         })
 
-    # 删除matching scores
-    db_session.query(MatchingScore).delete()
-
-    # 删除所有自定义问卷答案
-    db_session.query(CustomQuestionnaireAnswer).delete()
-
-    # 删除所有自定义问卷
-    db_session.query(CustomQuestionnaireItem).delete()
-
-    # 删除所有问卷答案
-    db_session.query(QuestionnaireAnswer).delete()
-
-    # 删除所有组队邀请信息
-    db_session.query(TeamInvitation).delete()
-
-    # 删除所有组队请求
-    db_session.query(TeamRequest).delete()
-
-    # 删除所有组队信息
-    db_session.query(Team).delete()
-
-    # 删除所有交换请求
-    db_session.query(ExchangingNeed).delete()
-    db_session.query(ExchangingRequest).delete()
-
-    # 删除所有学生账号
-    db_session.query(Student).delete()
-
-    db_session.commit()
+    # 删除所有匹配分、问卷答案、队伍、交换请求和学生账号，交给后台任务分批执行
+    job = jobs.enqueue("system_reset", created_by=current_user.id)
 
     return jsonify({
         "code": 200,
-        "msg": "success"
+        "msg": "success",
+        "data": {
+            "job_id": job.id
+        }
     })
 
 
@@ -763,3 +756,454 @@ def team_add_student():
             "code": 200,
             "msg": "success"
         })
+
+
+@admin_pages.post('/allocation/create')
+@admin_required()
+def allocation_create():
+    if request.json is not None:
+        gender = request.json.get('gender', None)
+        category = request.json.get('category', None)
+        if gender is None:
+            return jsonify({
+                "code": 400,
+                "msg": "缺少必要参数"
+            })
+
+        # 同一分组同时只允许一个排队中或计算中的方案
+        running_count = db_session.query(AllocationPlan) \
+            .filter(AllocationPlan.gender == gender) \
+            .filter(AllocationPlan.category == category if category is not None else AllocationPlan.category.is_(None)) \
+            .filter(AllocationPlan.status.in_([0, 1])) \
+            .count()
+        if running_count > 0:
+            return jsonify({
+                "code": 400,
+                "msg": "该分组已有正在计算的分配方案，请稍后再试"
+            })
+
+        plan = AllocationPlan(gender=gender, category=category, status=0)
+        db_session.add(plan)
+        db_session.commit()
+        jobs.enqueue("allocation", {"plan_id": plan.id}, current_user.id)
+
+        return jsonify({
+            "code": 200,
+            "msg": "success",
+            "data": {
+                "plan_id": plan.id
+            }
+        })
+
+    return jsonify({
+        "code": 400,
+        "msg": "数据校验错误"
+    })
+
+
+@admin_pages.get('/allocation/list')
+@admin_required()
+def allocation_list():
+    plans = db_session.query(AllocationPlan).order_by(AllocationPlan.id.desc()).all()
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": {
+            "plans": [plan.to_dict(rules=['-result']) for plan in plans]
+        }
+    })
+
+
+@admin_pages.get('/allocation/info')
+@admin_required()
+def allocation_info():
+    plan_id = request.args.get('plan_id', None)
+    plan = db_session.query(AllocationPlan).get(plan_id)
+    if plan is None:
+        return jsonify({
+            "code": 404,
+            "msg": "分配方案不存在"
+        })
+
+    data = plan.to_dict(rules=['-result'])
+    data['result'] = json.loads(plan.result) if plan.result else None
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": data
+    })
+
+
+@admin_pages.post('/allocation/commit')
+@admin_required()
+def allocation_commit():
+    if request.json is not None:
+        plan_id = request.json.get('plan_id', None)
+        plan = db_session.query(AllocationPlan).get(plan_id)
+        if plan is None:
+            return jsonify({
+                "code": 404,
+                "msg": "分配方案不存在"
+            })
+        if plan.status != 2:
+            return jsonify({
+                "code": 400,
+                "msg": "只能提交已计算完成且未提交的方案"
+            })
+
+        result = plan.apply()
+        if result is not True:
+            return result
+
+        return jsonify({
+            "code": 200,
+            "msg": "success"
+        })
+
+    return jsonify({
+        "code": 400,
+        "msg": "数据校验错误"
+    })
+
+
+@admin_pages.post('/allocation/discard')
+@admin_required()
+def allocation_discard():
+    if request.json is not None:
+        plan_id = request.json.get('plan_id', None)
+        plan = db_session.query(AllocationPlan).get(plan_id)
+        # 计算中的方案只有在没有任务负责它时（如任务已失败或被删除）才能废弃
+        if plan is not None and plan.status == 1 and jobs.allocation_job(plan.id) is not None:
+            return jsonify({
+                "code": 400,
+                "msg": "方案正在计算中，请先取消对应的任务"
+            })
+        if plan is not None and plan.status in [0, 1, 2, -1]:
+            plan.status = -2
+            plan.updated_at = datetime.datetime.now()
+            db_session.commit()
+
+    return jsonify({
+        "code": 200,
+        "msg": "success"
+    })
+
+
+@admin_pages.get('/exchanging/candidates')
+@admin_required()
+def exchanging_candidates():
+    student_id = request.args.get('student_id', None, type=int)
+    candidates = valid_candidates(student_id)
+
+    involved_ids = set()
+    for candidate in candidates:
+        involved_ids.update(json.loads(candidate.student_ids))
+    names = dict(db_session.query(Student.id, Student.name).filter(Student.id.in_(involved_ids)).all())
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": {
+            "candidates": [{
+                "id": candidate.id,
+                "total_gain": candidate.total_gain,
+                "min_gain": candidate.min_gain,
+                "length": candidate.length,
+                "students": [{
+                    "id": member,
+                    "name": names.get(member),
+                    "from_team_id": team_id,
+                    "to_team_id": team_ids[(index + 1) % len(team_ids)],
+                    "gain": gain
+                } for index, (member, team_id, gain) in enumerate(zip(student_ids, team_ids, gains))]
+            } for candidate, student_ids, team_ids, gains in [
+                (candidate, json.loads(candidate.student_ids), json.loads(candidate.team_ids), json.loads(candidate.gains))
+                for candidate in candidates
+            ]]
+        }
+    })
+
+
+@admin_pages.post('/exchanging/candidate/apply')
+@admin_required()
+def exchanging_candidate_apply():
+    if request.json is not None:
+        candidate_id = request.json.get('candidate_id', None)
+        candidate = db_session.query(ExchangingCandidate).get(candidate_id)
+        if candidate is None or candidate not in valid_candidates():
+            return jsonify({
+                "code": 404,
+                "msg": "换寝方案不存在或已失效"
+            })
+
+        student_ids = json.loads(candidate.student_ids)
+        team_ids = json.loads(candidate.team_ids)
+        for index, student_id in enumerate(student_ids):
+            db_session.query(Student).filter(Student.id == student_id).update({
+                Student.team_id: team_ids[(index + 1) % len(team_ids)]
+            })
+
+        db_session.query(ExchangingNeed) \
+            .filter(ExchangingNeed.student_id.in_(student_ids)) \
+            .filter(ExchangingNeed.processed == 0) \
+            .update({ExchangingNeed.processed: 1}, synchronize_session=False)
+
+        db_session.delete(candidate)
+        db_session.commit()
+
+        return jsonify({
+            "code": 200,
+            "msg": "success"
+        })
+
+    return jsonify({
+        "code": 400,
+        "msg": "数据校验错误"
+    })
+
+
+@admin_pages.post('/exchanging/rescan')
+@admin_required()
+def exchanging_rescan():
+    # 队伍调整较多时，清空候选并让后台任务重新为所有未处理的需求寻找换寝环
+    db_session.query(ExchangingCandidate).delete()
+    events.publish(events.EVENT_EXCHANGING)
+    db_session.commit()
+    set_system_setting("exchanging_scanned_need_id", "0")
+    set_system_setting("exchanging_pending_need_ids", "[]")
+
+    return jsonify({
+        "code": 200,
+        "msg": "success"
+    })
+
+
+@admin_pages.post('/jobs/enqueue')
+@admin_required()
+def job_enqueue():
+    if request.json is not None:
+        job_type = request.json.get('type', None)
+        if job_type not in jobs.handlers:
+            return jsonify({
+                "code": 400,
+                "msg": "未知的任务类型"
+            })
+
+        job = jobs.enqueue(job_type, request.json.get('params', {}), current_user.id)
+
+        return jsonify({
+            "code": 200,
+            "msg": "success",
+            "data": {
+                "job_id": job.id
+            }
+        })
+
+    return jsonify({
+        "code": 400,
+        "msg": "数据校验错误"
+    })
+
+
+@admin_pages.get('/jobs/list')
+@admin_required()
+def job_list():
+    job_list = db_session.query(Job).order_by(Job.id.desc()).limit(request.args.get('limit', 50, type=int)).all()
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": {
+            "jobs": [job.to_dict(rules=['-result', '-error']) for job in job_list]
+        }
+    })
+
+
+@admin_pages.get('/jobs/status')
+@admin_required()
+def job_status():
+    job = db_session.query(Job).get(request.args.get('job_id', None))
+    if job is None:
+        return jsonify({
+            "code": 404,
+            "msg": "任务不存在"
+        })
+
+    data = job.to_dict(rules=['-result'])
+    data['result'] = json.loads(job.result) if job.result else None
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": data
+    })
+
+
+@admin_pages.post('/jobs/cancel')
+@admin_required()
+def job_cancel():
+    if request.json is not None:
+        job = db_session.query(Job).get(request.json.get('job_id', None))
+        if job is None:
+            return jsonify({
+                "code": 404,
+                "msg": "任务不存在"
+            })
+        if job.status not in [jobs.JOB_QUEUED, jobs.JOB_RUNNING]:
+            return jsonify({
+                "code": 400,
+                "msg": "任务已结束，无法取消"
+            })
+
+        jobs.cancel(job)
+
+        return jsonify({
+            "code": 200,
+            "msg": "success"
+        })
+
+    return jsonify({
+        "code": 400,
+        "msg": "数据校验错误"
+    })
+
+
+# 抽样请求的 SQL 统计，只包含处理本次请求的 worker 进程的数据
+@admin_pages.get('/instrumentation/sql')
+@admin_required()
+def instrumentation_sql():
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": instrumentation.snapshot(request.args.get('limit', 20, type=int))
+    })
+
+
+@admin_pages.post('/instrumentation/sql/reset')
+@admin_required()
+def instrumentation_sql_reset():
+    instrumentation.reset()
+    return jsonify({
+        "code": 200,
+        "msg": "success"
+    })
+
+
+# 匹配任务每次扫描的进度，由 worker 限频写入
+@admin_pages.get('/matching/scan-runs')
+@admin_required()
+def scan_run_list():
+    run_list = db_session.query(ScanRun).order_by(ScanRun.id.desc()).limit(request.args.get('limit', 20, type=int)).all()
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": {
+            "runs": [run.to_dict() for run in run_list]
+        }
+    })
+
+
+@admin_pages.get('/matching/scan-runs/status')
+@admin_required()
+def scan_run_status():
+    # 不指定 run_id 时返回最近一次扫描
+    run_id = request.args.get('run_id', None, type=int)
+    if run_id is None:
+        run = db_session.query(ScanRun).order_by(ScanRun.id.desc()).first()
+    else:
+        run = db_session.query(ScanRun).get(run_id)
+    if run is None:
+        return jsonify({
+            "code": 404,
+            "msg": "扫描记录不存在"
+        })
+
+    data = run.to_dict()
+    data['blocks'] = json.loads(run.blocks) if run.blocks else []
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": data
+    })
+
+
+@admin_pages.post('/matching/trigger')
+@admin_required()
+def matching_trigger():
+    # incremental 检查并重写有变化的学生，full 丢弃缓存重新计算全部匹配分；worker 收到事件后立即执行
+    if request.json is not None:
+        mode = request.json.get('mode', progress.SCAN_INCREMENTAL)
+        if mode not in [progress.SCAN_INCREMENTAL, progress.SCAN_FULL]:
+            return jsonify({
+                "code": 400,
+                "msg": "未知的扫描方式"
+            })
+
+        run = progress.enqueue(mode, request.json.get('category', None) or None, current_user.id)
+
+        return jsonify({
+            "code": 200,
+            "msg": "success",
+            "data": {
+                "run_id": run.id
+            }
+        })
+
+    return jsonify({
+        "code": 400,
+        "msg": "数据校验错误"
+    })
+
+
+@admin_pages.post('/matching/cancel')
+@admin_required()
+def matching_cancel():
+    if request.json is not None:
+        run = db_session.query(ScanRun).get(request.json.get('run_id', None))
+        if run is None:
+            return jsonify({
+                "code": 404,
+                "msg": "扫描记录不存在"
+            })
+        if run.status not in [progress.SCAN_QUEUED, progress.SCAN_RUNNING]:
+            return jsonify({
+                "code": 400,
+                "msg": "扫描已结束，无法取消"
+            })
+
+        progress.cancel(run)
+
+        return jsonify({
+            "code": 200,
+            "msg": "success"
+        })
+
+    return jsonify({
+        "code": 400,
+        "msg": "数据校验错误"
+    })
+
+
+@admin_pages.get('/matching/stats')
+@admin_required()
+def matching_stats():
+    running = db_session.query(ScanRun) \
+        .filter(ScanRun.status.in_([progress.SCAN_QUEUED, progress.SCAN_RUNNING])) \
+        .order_by(ScanRun.id.asc()).all()
+    last_finished = db_session.query(ScanRun) \
+        .filter(ScanRun.status == progress.SCAN_FINISHED) \
+        .order_by(ScanRun.id.desc()).first()
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": {
+            "blocks": published_blocks(),
+            "active_runs": [run.to_dict() for run in running],
+            "last_finished_run": last_finished.to_dict() if last_finished is not None else None
+        }
+    })
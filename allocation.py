@@ -0,0 +1,253 @@
+import json
+import math
+import time
+
+import numpy as np
+from sqlalchemy import select
+
+from config import GeneralConfig
+from database import db_session
+from models import AllocationPlan, MatchingScore, Student, Team, get_system_setting
+
+# 局部搜索时每次参与计算的行数，用来限制 (m, m) 增益矩阵的内存占用
+SWAP_ROW_BLOCK = 1024
+
+
+def category_filter(column, category):
+    if category is None:
+        return column.is_(None)
+    return column == category
+
+
+def load_pair_matrix(student_ids):
+    """读取一组学生之间的匹配分，返回对称的两两得分矩阵（取双向分数的平均值）"""
+    ids = np.asarray(sorted(student_ids), dtype=np.int64)
+    n = len(ids)
+    scores = np.zeros((n, n), dtype=np.float32)
+    known = np.zeros((n, n), dtype=bool)
+    if n == 0:
+        return ids, scores
+
+    statement = select(MatchingScore.from_student_id, MatchingScore.to_student_id, MatchingScore.score) \
+        .where(MatchingScore.from_student_id.in_(ids.tolist())) \
+        .execution_options(yield_per=50000)
+
+    for rows in db_session.execute(statement).partitions():
+        rows = np.asarray(rows, dtype=np.float64)
+        from_index = np.searchsorted(ids, rows[:, 0].astype(np.int64))
+        to_index = np.searchsorted(ids, rows[:, 1].astype(np.int64))
+        to_index_clipped = np.minimum(to_index, n - 1)
+        valid = ids[to_index_clipped] == rows[:, 1].astype(np.int64)
+        scores[from_index[valid], to_index[valid]] = rows[valid, 2]
+        known[from_index[valid], to_index[valid]] = True
+
+    # 缺失的分数（如未填写问卷的学生）用已知分数的均值代替，避免被当成最差组合
+    fill_value = float(scores[known].mean()) if known.any() else 0.0
+    both = known & known.T
+    pair_scores = np.where(both, (scores + scores.T) / 2,
+                           np.where(known, scores, np.where(known.T, scores.T, fill_value))).astype(np.float32)
+    np.fill_diagonal(pair_scores, 0)
+
+    return ids, pair_scores
+
+
+def allocate(pair_scores, team_of, team_count, max_count, time_limit=None):
+    """
+    在已有队伍的基础上，把未分配的学生放进队伍，使所有队伍内部两两得分之和尽量大
+    pair_scores: (n, n) 对称得分矩阵
+    team_of: (n,) 每个学生所在队伍的下标，未分配为 -1；已有队员不会被移动
+    team_count: 已有队伍数量，新队伍的下标从 team_count 开始
+    返回 (team_of, new_team_count)
+    """
+    if time_limit is None:
+        time_limit = GeneralConfig.ALLOCATION_MAX_SECONDS
+    started_at = time.monotonic()
+
+    n = len(team_of)
+    team_of = np.array(team_of, dtype=np.int64)
+    movable = np.flatnonzero(team_of < 0)
+    if len(movable) == 0:
+        return team_of, 0
+
+    sizes = np.bincount(team_of[team_of >= 0], minlength=team_count)
+    free_slots = int(np.clip(max_count - sizes, 0, None).sum())
+    new_team_count = int(math.ceil(max(0, len(movable) - free_slots) / max_count))
+    total_teams = team_count + new_team_count
+    sizes = np.concatenate([sizes, np.zeros(new_team_count, dtype=np.int64)])
+
+    membership = np.zeros((n, total_teams), dtype=np.float32)
+    assigned = team_of >= 0
+    membership[np.flatnonzero(assigned), team_of[assigned]] = 1
+    # gains[s, t]: 学生 s 与队伍 t 现有成员的得分之和
+    gains = pair_scores @ membership
+
+    def place(student, team):
+        team_of[student] = team
+        sizes[team] += 1
+        gains[:, team] += pair_scores[:, student]
+
+    # 新队伍的种子：依次挑选与已选种子最不相似的学生，让各个新队伍分散开
+    pending = list(movable)
+    if new_team_count > 0:
+        affinity = pair_scores[np.ix_(movable, movable)]
+        first = int(np.argmin(affinity.sum(axis=1)))
+        seeds = [first]
+        nearest = affinity[first].copy()
+        nearest[first] = np.inf
+        for _ in range(1, min(new_team_count, len(movable))):
+            candidate = int(np.argmin(nearest))
+            seeds.append(candidate)
+            nearest = np.maximum(nearest, affinity[candidate])
+            nearest[seeds] = np.inf
+        for offset, seed in enumerate(seeds):
+            place(movable[seed], team_count + offset)
+        seeded = set(movable[seeds].tolist())
+        pending = [student for student in pending if student not in seeded]
+
+    # 贪心：最容易找到好队友的学生先选队伍
+    if pending:
+        pending = np.asarray(pending)
+        top_k = max(1, min(max_count - 1, n - 1))
+        strength = -np.sort(-pair_scores[pending], axis=1)[:, :top_k].sum(axis=1)
+        for student in pending[np.argsort(-strength)]:
+            open_teams = np.flatnonzero(sizes < max_count)
+            team = open_teams[int(np.argmax(gains[student, open_teams]))]
+            place(int(student), int(team))
+
+    # 局部搜索：交换两个学生，或把学生移到有空位的队伍；互不相干的队伍可以在同一轮里一起调整
+    while time.monotonic() - started_at < time_limit:
+        operations = _improving_operations(pair_scores, gains, team_of, sizes, movable, max_count)
+        if not operations:
+            break
+
+        touched_teams = set()
+        for gain, a, b, target_team in operations:
+            team_a = int(team_of[a])
+            team_b = int(team_of[b]) if b >= 0 else target_team
+            if team_a in touched_teams or team_b in touched_teams:
+                continue
+            touched_teams.update((team_a, team_b))
+
+            gains[:, team_a] -= pair_scores[:, a]
+            gains[:, team_b] += pair_scores[:, a]
+            team_of[a] = team_b
+            if b >= 0:
+                gains[:, team_b] -= pair_scores[:, b]
+                gains[:, team_a] += pair_scores[:, b]
+                team_of[b] = team_a
+            else:
+                sizes[team_a] -= 1
+                sizes[team_b] += 1
+
+    return team_of, new_team_count
+
+
+def _improving_operations(pair_scores, gains, team_of, sizes, movable, max_count, epsilon=1e-6):
+    """返回本轮所有能提高总分的操作 (增益, a, b, 目标队伍)，b 为 -1 表示移动到空位，按增益从大到小排序"""
+    operations = []
+    teams = team_of[movable]
+    own_gains = gains[movable, teams]
+    movable_gains = gains[movable]
+
+    for start in range(0, len(movable), SWAP_ROW_BLOCK):
+        rows = slice(start, start + SWAP_ROW_BLOCK)
+        row_students = movable[rows]
+        row_teams = teams[rows]
+
+        # 交换 a、b：a 进入 b 的队伍、b 进入 a 的队伍，减去 a、b 之间被重复计算的得分
+        delta = movable_gains[rows][:, teams] \
+            + movable_gains[:, row_teams].T \
+            - own_gains[rows][:, None] - own_gains[None, :] \
+            - 2 * pair_scores[np.ix_(row_students, movable)]
+        delta[row_teams[:, None] == teams[None, :]] = -np.inf
+        # 只看上三角，避免同一对学生算两次
+        delta[np.arange(delta.shape[0])[:, None] + start >= np.arange(len(movable))[None, :]] = -np.inf
+
+        best = np.argmax(delta, axis=1)
+        best_delta = delta[np.arange(delta.shape[0]), best]
+        for offset in np.flatnonzero(best_delta > epsilon):
+            operations.append((float(best_delta[offset]), int(row_students[offset]), int(movable[best[offset]]), -1))
+
+    open_teams = np.flatnonzero(sizes < max_count)
+    if len(open_teams) > 0:
+        move_delta = movable_gains[:, open_teams] - own_gains[:, None]
+        move_delta[teams[:, None] == open_teams[None, :]] = -np.inf
+        best = np.argmax(move_delta, axis=1)
+        best_delta = move_delta[np.arange(len(movable)), best]
+        for offset in np.flatnonzero(best_delta > epsilon):
+            operations.append((float(best_delta[offset]), int(movable[offset]), -1, int(open_teams[best[offset]])))
+
+    operations.sort(key=lambda operation: -operation[0])
+    return operations
+
+
+def run_plan(plan):
+    teams = db_session.query(Team) \
+        .filter(Team.gender == plan.gender) \
+        .filter(category_filter(Team.category, plan.category)) \
+        .order_by(Team.id.asc()) \
+        .all()
+    unassigned_ids = [row[0] for row in db_session.query(Student.id)
+                      .filter(Student.team_id.is_(None))
+                      .filter(Student.gender == plan.gender)
+                      .filter(category_filter(Student.category, plan.category))
+                      .all()]
+    max_count = int(get_system_setting("team_max_student_count", 4))
+
+    member_team = {}
+    for team_index, team in enumerate(teams):
+        for student in team.students:
+            member_team[student.id] = team_index
+
+    ids, pair_scores = load_pair_matrix(list(member_team.keys()) + unassigned_ids)
+    team_of = np.array([member_team.get(int(student_id), -1) for student_id in ids], dtype=np.int64)
+    team_of, new_team_count = allocate(pair_scores, team_of, len(teams), max_count)
+
+    result_teams = []
+    total_score = 0.0
+    for team_index in range(len(teams) + new_team_count):
+        members = np.flatnonzero(team_of == team_index)
+        new_members = [int(ids[index]) for index in members if int(ids[index]) not in member_team]
+        if not new_members:
+            continue
+
+        block = pair_scores[np.ix_(members, members)]
+        pair_count = len(members) * (len(members) - 1) / 2
+        team_score = float(block.sum() / 2 / pair_count) if pair_count else 0.0
+        total_score += float(block.sum() / 2)
+        result_teams.append({
+            "team_id": teams[team_index].id if team_index < len(teams) else None,
+            "member_ids": [int(ids[index]) for index in members if int(ids[index]) in member_team],
+            "student_ids": new_members,
+            "score": round(team_score, 2)
+        })
+
+    plan.team_max_student_count = max_count
+    plan.total_score = round(total_score, 2)
+    plan.result = json.dumps({
+        "teams": result_teams,
+        "new_team_count": len([team for team in result_teams if team["team_id"] is None]),
+        "student_count": len(unassigned_ids)
+    })
+
+
+def run_plan_by_id(plan_id):
+    plan = db_session.query(AllocationPlan).get(plan_id)
+    # 排队期间被管理员废弃的方案不再计算；状态为 1 说明 worker 计算到一半异常退出，任务被放回队列后重新计算
+    if plan is None or plan.status not in (0, 1):
+        return
+
+    plan.status = 1
+    db_session.commit()
+    started_at = time.monotonic()
+    try:
+        run_plan(plan)
+        plan.status = 2
+        plan.message = "计算完成，用时 {:.1f} 秒".format(time.monotonic() - started_at)
+        db_session.commit()
+    except Exception as e:
+        db_session.rollback()
+        plan.status = -1
+        plan.message = str(e)
+        db_session.commit()
+        raise
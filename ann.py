@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+
+# 候选学生对模式用的近邻索引：倒排文件（IVF）
+# 先用 k-means 把所有点分成 lists 个桶，每个点只与离它最近的 probes 个桶里的点精确计算距离，取最近的 k 个作为近邻
+# n 个点互相查询的开销从 O(n²·d) 降到 O(n·(lists + probes·n/lists)·d)，lists 取 √n 时约为 O(n^1.5·probes·d)
+# 距离为欧氏距离；文本向量先归一化，此时欧氏距离与余弦的排序一致
+# 近邻只用来挑选候选学生对，候选对的相似度和匹配分仍然精确计算（见 matching.refresh_candidates）
+
+# 训练 k-means 时每个桶采样的点数
+SAMPLES_PER_LIST = 64
+# 计算距离时每次处理的查询数，限制 (rows, 桶内点数) 临时矩阵的内存占用
+ROW_BLOCK = 1024
+
+
+def squared_distances(left, right):
+    """(m, d) 与 (n, d) 两组点之间的欧氏距离平方 (m, n)"""
+    distances = (left * left).sum(axis=1)[:, None] - 2 * (left @ right.T) + (right * right).sum(axis=1)[None, :]
+    return np.maximum(distances, 0)
+
+
+def _list_sums(points, assignments, lists):
+    """每个桶内点的坐标之和，用 one-hot 矩阵乘法代替很慢的 np.add.at"""
+    one_hot = np.zeros((lists, len(points)), dtype=points.dtype)
+    one_hot[assignments, np.arange(len(points))] = 1
+    return one_hot @ points
+
+
+def _nearest_lists(points, centroids, count):
+    """每个点最近的 count 个桶"""
+    nearest = np.empty((len(points), count), dtype=np.int64)
+    for start in range(0, len(points), ROW_BLOCK):
+        distances = squared_distances(points[start:start + ROW_BLOCK], centroids)
+        if count < len(centroids):
+            nearest[start:start + ROW_BLOCK] = np.argpartition(distances, count - 1, axis=1)[:, :count]
+        else:
+            nearest[start:start + ROW_BLOCK] = np.argsort(distances, axis=1)
+    return nearest
+
+
+class IVFIndex:
+    def __init__(self, points, lists=None, iterations=8, seed=0):
+        """points 为 (n, d) 的坐标，lists 为桶的个数，默认 √n"""
+        self.points = np.ascontiguousarray(points, dtype=np.float32)
+        n = len(self.points)
+        self.lists = max(1, min(n, lists or int(math.sqrt(n))))
+
+        rng = np.random.default_rng(seed)
+        sample = self.points[rng.choice(n, min(n, self.lists * SAMPLES_PER_LIST), replace=False)]
+        centroids = sample[rng.choice(len(sample), self.lists, replace=False)]
+        for _ in range(iterations):
+            assignments = _nearest_lists(sample, centroids, 1)[:, 0]
+            counts = np.bincount(assignments, minlength=self.lists)
+            sums = _list_sums(sample, assignments, self.lists)
+            # 空桶保留原来的中心
+            centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+        self.centroids = centroids.astype(np.float32)
+
+        # 桶内的点按下标连续存放
+        assignments = _nearest_lists(self.points, self.centroids, 1)[:, 0]
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.searchsorted(assignments[self.order], np.arange(self.lists + 1))
+
+    def neighbours(self, k, probes, queries=None):
+        """
+        每个查询点在最近的 probes 个桶里最近的 k 个其他点，返回 (m, k) 的下标，不足 k 个时用 -1 补齐
+        queries 为查询点的下标，默认查询所有点
+        """
+        queries = np.arange(len(self.points)) if queries is None else np.asarray(queries, dtype=np.int64)
+        m = len(queries)
+        probes = max(1, min(probes, self.lists))
+        nearest = _nearest_lists(self.points[queries], self.centroids, probes)
+
+        candidates = np.full((m, probes, k), -1, dtype=np.int64)
+        distances = np.full((m, probes, k), np.inf, dtype=np.float32)
+        # 按桶分组查询：同一个桶的所有查询与桶内的点一次矩阵乘法算完
+        flat = nearest.ravel()
+        order = np.argsort(flat, kind="stable")
+        bounds = np.searchsorted(flat[order], np.arange(self.lists + 1))
+        for list_index in range(self.lists):
+            members = self.order[self.offsets[list_index]:self.offsets[list_index + 1]]
+            probing = order[bounds[list_index]:bounds[list_index + 1]]
+            if len(members) == 0 or len(probing) == 0:
+                continue
+            count = min(k, len(members))
+            for start in range(0, len(probing), ROW_BLOCK):
+                rows, slots = np.divmod(probing[start:start + ROW_BLOCK], probes)
+                block = squared_distances(self.points[queries[rows]], self.points[members])
+                block[queries[rows][:, None] == members[None, :]] = np.inf
+                top = np.argpartition(block, count - 1, axis=1)[:, :count] if count < len(members) else \
+                    np.broadcast_to(np.arange(count), (len(rows), count))
+                candidates[rows, slots, :count] = members[top]
+                distances[rows, slots, :count] = np.take_along_axis(block, top, axis=1)
+
+        # 合并各个桶的结果
+        candidates = candidates.reshape(m, -1)
+        distances = distances.reshape(m, -1)
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k] if k < distances.shape[1] else \
+            np.broadcast_to(np.arange(distances.shape[1]), (m, distances.shape[1]))
+        result = np.take_along_axis(candidates, top, axis=1)
+        result[np.isinf(np.take_along_axis(distances, top, axis=1))] = -1
+        return result
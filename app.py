@@ -1,15 +1,24 @@
+import gevent_patch  # noqa: F401  必须最先导入
+import boot
+
 from datetime import datetime, timedelta
 
-from flask import Flask
+from flask import Flask, jsonify
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, get_jwt, create_access_token, get_jwt_identity, set_access_cookies
 from flask_talisman import Talisman
 
+import instrumentation
+import metrics
+import replica
 from config import GeneralConfig
-from database import db_session
+from database import db_session, engine, replica_engine
 from admin import admin_pages
 from models import Admin, Student
 from student import student_pages
+from sqlalchemy import text
+
+boot.mark("imports")
 
 app = Flask(__name__)
 app.config.from_object(GeneralConfig)
@@ -18,6 +27,13 @@ jwt = JWTManager(app)
 # security headers
 # Talisman(app)
 
+# 抽样统计每个接口的 SQL 条数和耗时，见 /api/admin/instrumentation/sql
+instrumentation.init_app(app, engine, replica_engine)
+# 请求耗时、连接池等待等 Prometheus 指标，见 /metrics
+metrics.init_app(app, engine, replica_engine)
+# 学生端只读接口读只读副本，写入过数据的客户端短时间内读主库
+replica.init_app(app)
+
 app.register_blueprint(admin_pages, url_prefix="/api/admin")
 app.register_blueprint(student_pages, url_prefix="/api/student")
 
@@ -28,6 +44,8 @@ CORS(
     expose_headers=['Refresh-Access-Token']
 )
 
+boot.mark("app_created")
+
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
@@ -40,7 +58,8 @@ def shutdown_session(exception=None):
 
 @jwt.user_identity_loader
 def user_identity_lookup(id):
-    return id
+    # PyJWT 2.10 起 sub 必须是字符串，否则带着令牌的请求都会返回 422
+    return str(id)
 
 
 # Register a callback function that loads a user from your database whenever
@@ -49,7 +68,7 @@ def user_identity_lookup(id):
 # if the user has been deleted from the database).
 @jwt.user_lookup_loader
 def user_lookup_callback(_jwt_header, jwt_data):
-    identity = jwt_data["sub"]
+    identity = int(jwt_data["sub"])
     role = jwt_data.get('role', 'student')
     if role == "admin":
         return db_session.query(Admin).get(identity)
@@ -70,6 +89,7 @@ def refresh_expiring_jwts(response):
                 "role": get_jwt()['role']
             })
             response.headers['Refresh-Access-Token'] = access_token
+            metrics.JWT_REFRESHES.inc()
 
         return response
     except (RuntimeError, KeyError):
@@ -81,5 +101,42 @@ def hello_world():  # put application's code here
     return 'Hello World!'
 
 
+# 存活探针：进程能处理请求即可，不访问数据库
+@app.route('/health')
+def health():
+    return jsonify({
+        "code": 200,
+        "msg": "success"
+    })
+
+
+# 就绪探针：数据库可用后才接收流量，同时返回启动各阶段的耗时
+@app.route('/ready')
+def ready():
+    try:
+        db_session.execute(text("SELECT 1"))
+    except Exception as e:
+        return jsonify({
+            "code": 503,
+            "msg": "数据库不可用",
+            "data": {
+                "phases": boot.phases(),
+                "error": str(e)
+            }
+        }), 503
+
+    if not boot.marked("ready"):
+        boot.mark("ready")
+
+    return jsonify({
+        "code": 200,
+        "msg": "success",
+        "data": {
+            "boot_seconds": boot.boot_seconds(),
+            "phases": boot.phases()
+        }
+    })
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,116 @@
+"""
+候选对模式基准：在合成的学生上比较候选对模式（matching.refresh_candidates）与完整匹配分矩阵
+用法: python -m benchmarks.ann --per-gender 2000 --probes 4,8,16
+只取第一个性别的分块，在内存里算出精确的 (n, n) 匹配分作为基准，再按每组参数挑选候选对并计算候选对的匹配分，输出
+candidate_pairs     候选学生对（无序）的个数，与 n(n-1)/2 的比例 pair_fraction
+recall_outgoing     每位学生发出的匹配分最高的 --top 位同学中，出现在候选对里的比例（与第 --top 名同分的都算在内）
+recall_incoming     同上，按收到的匹配分
+seconds             挑选候选对加计算匹配分的耗时，exact_seconds 为计算完整矩阵的耗时（都不含写数据库）
+编码器用 HashEncoder 代替，只有完全相同的文本向量才相近；合成答案是均匀随机的，没有真实问卷里的“生活习惯相近的一群人”，
+是近邻搜索最不利的情况，真实数据的召回需要用真实数据测
+单核、--dim 64、每个性别 4000 人（88 道题）时：完整矩阵 83 秒；默认参数（probes 8）候选对占 7.6%，6.2 秒，
+recall_outgoing 0.36；probes 16 时 0.42；--numeric-neighbours 200 --probes 16 时候选对占 11%，8.7 秒，0.53
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+
+def exact_scores(items, n):
+    """完整的 (n, n) 匹配分矩阵，scores[i, j] 为 i → j"""
+    import matching
+
+    scores = np.zeros((n, n), dtype=np.float32)
+    columns = np.arange(n)
+    rows_per_block = max(1, matching.INSERT_CHUNK * 10 // n)
+    for start in range(0, n, rows_per_block):
+        rows = np.arange(start, min(n, start + rows_per_block))
+        left, right = np.repeat(rows, n), np.tile(columns, len(rows))
+        outgoing, _ = matching.aggregate_pairs(items, left, right)
+        scores[rows] = outgoing.reshape(len(rows), n)
+    np.fill_diagonal(scores, -np.inf)
+    return scores
+
+
+def recall(scores, left, right, top):
+    """每行匹配分最高的 top 个中出现在候选对里的比例的平均值，与第 top 名同分的都算相关"""
+    n = len(scores)
+    threshold = -np.partition(-scores, top - 1, axis=1)[:, top - 1]
+    candidates = np.zeros((n, n), dtype=bool)
+    candidates[left, right] = True
+    candidates[right, left] = True
+    found = np.count_nonzero(candidates & (scores >= threshold[:, None]), axis=1)
+    return float(np.mean(np.minimum(found, top) / top))
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="ann-benchmark-")
+    from config import GeneralConfig
+
+    GeneralConfig.MATCHING_STORE_PATH = os.path.join(workdir, "matching")
+
+    from benchmarks.cohort import HashEncoder, generate, use_database
+
+    use_database(args.database_url or "sqlite:///" + os.path.join(workdir, "ann.db"))
+
+    import encoders
+    import matching
+    from snapshot import load_snapshot
+
+    encoders._encoder = HashEncoder(args.dim)
+    generate(args.per_gender, seed=args.seed)
+    snapshot = load_snapshot(1)
+    n = len(snapshot.ids)
+    items = matching.pair_items(matching.CandidateStore("benchmark"), matching.item_kernels(), snapshot.answers)
+
+    started_at = time.perf_counter()
+    scores = exact_scores(items, n)
+    exact_seconds = time.perf_counter() - started_at
+
+    results = []
+    for probes in args.probes:
+        GeneralConfig.MATCHING_ANN_TEXT_NEIGHBOURS = args.text_neighbours
+        GeneralConfig.MATCHING_ANN_NUMERIC_NEIGHBOURS = args.numeric_neighbours
+        GeneralConfig.MATCHING_ANN_PROBES = probes
+        GeneralConfig.MATCHING_ANN_LISTS = args.lists
+
+        started_at = time.perf_counter()
+        left, right = matching.candidate_pairs(items, n)
+        matching.aggregate_pairs(items, left, right)
+        seconds = time.perf_counter() - started_at
+        results.append({
+            "probes": probes,
+            "candidate_pairs": len(left),
+            "pair_fraction": round(len(left) / (n * (n - 1) / 2), 4),
+            "recall_outgoing": round(recall(scores, left, right, args.top), 4),
+            "recall_incoming": round(recall(scores.T.copy(), left, right, args.top), 4),
+            "seconds": round(seconds, 3)
+        })
+
+    return {"students": n, "items": len(items), "text_neighbours": args.text_neighbours,
+            "numeric_neighbours": args.numeric_neighbours, "lists": args.lists or int(np.sqrt(n)), "top": args.top,
+            "exact_seconds": round(exact_seconds, 3), "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="候选对模式的召回与耗时")
+    parser.add_argument("--per-gender", type=int, default=2000, help="每个性别的学生数")
+    parser.add_argument("--database-url", default=None, help="默认用一个临时 SQLite 库；MySQL 须为空的测试库")
+    parser.add_argument("--dim", type=int, default=768, help="HashEncoder 的向量维度")
+    parser.add_argument("--text-neighbours", type=int, default=10, help="同 MATCHING_ANN_TEXT_NEIGHBOURS")
+    parser.add_argument("--numeric-neighbours", type=int, default=100, help="同 MATCHING_ANN_NUMERIC_NEIGHBOURS")
+    parser.add_argument("--probes", default="8", help="MATCHING_ANN_PROBES，逗号分隔可比较多组")
+    parser.add_argument("--lists", type=int, default=0, help="同 MATCHING_ANN_LISTS，0 表示 √n")
+    parser.add_argument("--top", type=int, default=10, help="计算召回的前几名")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    args.probes = [int(probes) for probes in args.probes.split(",")]
+    print(json.dumps(run(args), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
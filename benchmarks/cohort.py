@@ -0,0 +1,181 @@
+"""
+合成数据：按 default_questionnaire.json 的题目生成学生和问卷答案，供匹配基准和压测使用
+数据库由 DATABASE_URL 指定，本地可以用 SQLite 文件代替 MySQL，也可以指向一个空的 MySQL 测试库
+用法: python -m benchmarks.cohort --database-url sqlite:///cohort.db --per-gender 1000
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+from encoders import Encoder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 所有合成学生的登录密码
+PASSWORD = "benchmark"
+INSERT_CHUNK = 5000
+# 不是题目的控件
+LAYOUT_WIDGETS = ('divider', 'static-text', 'html-text', 'grid', 'grid-col', 'tab', 'tab-pane', 'card')
+
+PHRASES = ["早睡早起", "经常熬夜", "喜欢安静", "喜欢热闹", "周末宅在宿舍", "周末出去玩", "爱打篮球", "喜欢看书",
+           "玩原神", "听周杰伦", "喜欢做饭", "作息规律", "爱干净", "不介意外放", "喜欢摄影", "想考研", "想出国",
+           "喜欢跑步", "喜欢桌游", "不抽烟不喝酒"]
+
+
+def use_database(url):
+    """让 database 模块连接到 url，并建好所有表；必须在导入 database 之前调用"""
+    from config import GeneralConfig
+
+    os.environ["DATABASE_URL"] = url
+    GeneralConfig.DATABASE_URL = url
+    GeneralConfig.DATABASE_LOG = False
+
+    if url.startswith("sqlite"):
+        # 模型使用 MySQL 的列类型，用 SQLite 代替 MySQL 时映射成 SQLite 的类型
+        from sqlalchemy.dialects.mysql import DOUBLE, LONGBLOB, LONGTEXT, MEDIUMBLOB, TINYINT
+        from sqlalchemy.ext.compiler import compiles
+
+        for mysql_type, sqlite_type in ((LONGTEXT, "TEXT"), (TINYINT, "INTEGER"), (DOUBLE, "REAL"),
+                                        (LONGBLOB, "BLOB"), (MEDIUMBLOB, "BLOB")):
+            compiles(mysql_type, "sqlite")(lambda element, compiler, sqlite_type=sqlite_type, **kw: sqlite_type)
+
+    import database
+    import models
+
+    models.Base.metadata.create_all(database.engine)
+    return database.engine
+
+
+class HashEncoder(Encoder):
+    """基准用的编码器：用答案的哈希生成固定的随机向量，不加载模型"""
+
+    def __init__(self, dim=768):
+        self.dim = dim
+        self.count = 0
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf8"), digest_size=8).digest(), "little")
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+
+    def encode(self, texts):
+        if isinstance(texts, str):
+            self.count += 1
+            return self._vector(texts)
+        self.count += len(texts)
+        return np.asarray([self._vector(text) for text in texts])
+
+
+def questionnaire_widgets(path=None):
+    """问卷设计 JSON 里的题目控件，返回 (设计 JSON, [(type, options)])"""
+    with open(path or os.path.join(ROOT, "default_questionnaire.json"), encoding="utf-8") as f:
+        questionnaire_json = f.read()
+
+    widgets = []
+    pending = [json.loads(questionnaire_json)]
+    while pending:
+        node = pending.pop(0)
+        if isinstance(node, list):
+            pending[:0] = node
+        elif isinstance(node, dict):
+            if isinstance(node.get('options'), dict) and node.get('type') not in (None,) + LAYOUT_WIDGETS:
+                widgets.append((node['type'], node['options']))
+            pending.extend(value for key, value in node.items() if key != 'options' and isinstance(value, (list, dict)))
+    return questionnaire_json, widgets
+
+
+def random_answer(widget_type, options, rng):
+    values = [option['value'] for option in options.get('optionItems') or []]
+    if widget_type == 'checkbox' and values:
+        return str(rng.sample(values, rng.randint(1, min(3, len(values)))))
+    if widget_type in ('radio', 'select') and values:
+        return str(rng.choice(values))
+    if widget_type == 'rate':
+        return str(rng.randint(0, int(options.get('max', 5))))
+    if widget_type == 'slider':
+        return str(rng.randint(int(options.get('min', 0)), int(options.get('max', 100))))
+    if widget_type == 'number':
+        return str(rng.randint(1, 7))
+    if widget_type == 'time':
+        return "{:02d}:{:02d}".format(rng.randint(0, 23), rng.choice([0, 15, 30, 45]))
+    return "，".join(rng.sample(PHRASES, rng.randint(1, 3)))
+
+
+def insert_chunked(table, rows):
+    from sqlalchemy import insert
+
+    from database import db_session
+
+    for start in range(0, len(rows), INSERT_CHUNK):
+        db_session.execute(insert(table), rows[start:start + INSERT_CHUNK])
+        db_session.commit()
+
+
+def generate(per_gender, categories=("default",), answer_rate=0.9, seed=0):
+    """
+    生成 2 × per_gender 个学生（男 1、女 2）及其问卷答案，学生 id 从 1 开始连续编号
+    每个学生以 answer_rate 的概率回答每道题，返回生成的行数和耗时
+    """
+    import bcrypt
+
+    from database import db_session
+    from models import QuestionnaireAnswer, QuestionnaireItem, Student, set_system_setting
+
+    rng = random.Random(seed)
+    started_at = time.perf_counter()
+
+    questionnaire_json, widgets = questionnaire_widgets()
+    set_system_setting("questionnaire_json", questionnaire_json)
+    items = []
+    for index, (widget_type, options) in enumerate(widgets):
+        items.append({"id": options['name'], "title": options.get('label') or options['name'], "weight": 1,
+                      "data_type": "text" if widget_type in ('input', 'textarea') else "integer",
+                      "params": json.dumps(options, ensure_ascii=False), "index": index, "type": widget_type})
+    insert_chunked(QuestionnaireItem.__table__, items)
+
+    password = bcrypt.hashpw(PASSWORD.encode("utf8"), bcrypt.gensalt()).decode("utf8")
+    students = [{"id": student_id, "name": "学生{}".format(student_id), "gender": 1 if student_id <= per_gender else 2,
+                 "category": rng.choice(categories), "password": password}
+                for student_id in range(1, 2 * per_gender + 1)]
+    insert_chunked(Student.__table__, students)
+
+    now = datetime.datetime.now()
+    answers = []
+    for student in students:
+        for (widget_type, options), item in zip(widgets, items):
+            if rng.random() > answer_rate:
+                continue
+            answers.append({"student_id": student["id"], "item_id": item["id"],
+                            "answer": random_answer(widget_type, options, rng),
+                            "weight": rng.choice([1, 1, 2, 3, 0]),
+                            "updated_at": now})
+        if len(answers) >= INSERT_CHUNK:
+            insert_chunked(QuestionnaireAnswer.__table__, answers)
+            answers = []
+    insert_chunked(QuestionnaireAnswer.__table__, answers)
+
+    rows = len(items) + len(students) + db_session.query(QuestionnaireAnswer).count()
+    return {"students": len(students), "items": len(items), "rows": rows,
+            "seconds": round(time.perf_counter() - started_at, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按默认问卷生成合成学生和答案")
+    parser.add_argument("--database-url", required=True, help="空的测试库，例如 sqlite:///cohort.db")
+    parser.add_argument("--per-gender", type=int, default=1000, help="每个性别的学生数")
+    parser.add_argument("--categories", default="default", help="学生类别，逗号分隔")
+    parser.add_argument("--answer-rate", type=float, default=0.9, help="每道题被回答的概率")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    use_database(args.database_url)
+    result = generate(args.per_gender, args.categories.split(","), args.answer_rate, args.seed)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
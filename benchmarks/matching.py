@@ -0,0 +1,205 @@
+"""
+匹配基准：在合成的学生上运行匹配任务（matching.refresh_all，即 scan_students 的主体），按阶段统计耗时
+用法: python -m benchmarks.matching --per-gender 100,1000,5000 --save baseline.json
+     python -m benchmarks.matching --per-gender 1000 --baseline baseline.json   # 与基线比较，变慢超过阈值时退出码为 1
+每个规模在全新的子进程、临时 SQLite 库和临时缓存目录里运行，--database-url 可改为一个空的 MySQL 测试库
+编码器用 HashEncoder 代替，不加载模型；各阶段统计
+seconds 墙钟耗时，pairs_per_second 每秒写入的匹配分（学生对），db_rows_per_second 每秒写入和删除的行数，
+peak_rss_mb 该阶段的内存峰值
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def peak_rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def reset_peak_rss():
+    # 写入 5 会把 VmHWM 重置为当前的常驻内存（Linux 4.0+），这样可以分阶段统计峰值
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class RowCounter:
+    """统计写入和删除 matching_scores 的行数"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.inserted = 0
+        self.deleted = 0
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        statement = statement.lstrip().upper()
+        if "MATCHING_SCORES" not in statement[:64] or cursor.rowcount is None or cursor.rowcount < 0:
+            return
+        if statement.startswith("INSERT"):
+            self.inserted += cursor.rowcount
+        elif statement.startswith("DELETE"):
+            self.deleted += cursor.rowcount
+
+
+def run_stage(name, counter, function):
+    reset_peak_rss()
+    inserted, deleted = counter.inserted, counter.deleted
+    started_at = time.perf_counter()
+    rewritten = function()
+    seconds = time.perf_counter() - started_at
+    pairs = counter.inserted - inserted
+    rows = pairs + counter.deleted - deleted
+    return {
+        "stage": name,
+        "seconds": round(seconds, 3),
+        "rewritten_students": rewritten,
+        "pairs": pairs,
+        "pairs_per_second": round(pairs / seconds) if seconds > 0 else None,
+        "db_rows_per_second": round(rows / seconds) if seconds > 0 else None,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def change_answers(fraction, seed, weights_only=False):
+    """模拟学生修改问卷：fraction 比例的学生各修改一道题的答案或权重，返回修改的学生数"""
+    import datetime
+    import random
+
+    from database import db_session
+    from models import QuestionnaireAnswer
+
+    rng = random.Random(seed)
+    student_ids = [row[0] for row in db_session.query(QuestionnaireAnswer.student_id).distinct().all()]
+    changed = rng.sample(student_ids, max(1, int(len(student_ids) * fraction)))
+    for student_id in changed:
+        answer = rng.choice(db_session.query(QuestionnaireAnswer).filter_by(student_id=student_id).all())
+        if weights_only:
+            answer.weight = rng.choice([1, 2, 3])
+        else:
+            # 与学生提交问卷一致：换一个答案，清空向量
+            answer.answer = answer.answer + " "
+            answer.vector = None
+        answer.updated_at = datetime.datetime.now()
+    db_session.commit()
+    return len(changed)
+
+
+def run_size(per_gender, database_url, dim, change_fraction, seed):
+    """在当前进程里运行一个规模的全部阶段"""
+    workdir = tempfile.mkdtemp(prefix="matching-benchmark-")
+    from config import GeneralConfig
+
+    GeneralConfig.MATCHING_STORE_PATH = os.path.join(workdir, "matching")
+    GeneralConfig.SCORE_MATRIX_PATH = os.path.join(workdir, "scores")
+    GeneralConfig.PURGE_PAUSE_SECONDS = 0
+
+    from benchmarks.cohort import HashEncoder, generate, use_database
+
+    engine = use_database(database_url or "sqlite:///" + os.path.join(workdir, "matching.db"))
+
+    import encoders
+    import matching
+    from progress import ScanProgress
+
+    encoder = HashEncoder(dim)
+    encoders._encoder = encoder
+    counter = RowCounter(engine)
+
+    reset_peak_rss()
+    cohort = generate(per_gender, seed=seed)
+    stages = [{"stage": "generate", "seconds": cohort["seconds"], "rows": cohort["rows"],
+               "db_rows_per_second": round(cohort["rows"] / cohort["seconds"]) if cohort["seconds"] else None,
+               "peak_rss_mb": peak_rss_mb()}]
+
+    # 基准只统计耗时，进度不打印也不写 scan_runs
+    quiet = ScanProgress(persist=False, level="error")
+
+    stages.append(run_stage("initial", counter, lambda: matching.refresh_all(quiet)))
+    stages[-1]["encoded_answers"] = encoder.count
+    stages.append(run_stage("unchanged", counter, lambda: matching.refresh_all(quiet)))
+    change_answers(change_fraction, seed)
+    stages.append(run_stage("answers_changed", counter, lambda: matching.refresh_all(quiet)))
+    change_answers(change_fraction, seed + 1, weights_only=True)
+    stages.append(run_stage("weights_changed", counter, lambda: matching.refresh_all(quiet)))
+
+    return {"per_gender": per_gender, "students": cohort["students"], "items": cohort["items"], "stages": stages}
+
+
+def run_subprocess(per_gender, args):
+    command = [sys.executable, "-m", "benchmarks.matching", "--worker", "--per-gender", str(per_gender),
+               "--dim", str(args.dim), "--change-fraction", str(args.change_fraction), "--seed", str(args.seed)]
+    if args.database_url:
+        command += ["--database-url", args.database_url]
+    completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+    raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr else "子进程没有输出结果")
+
+
+def compare(results, baseline, tolerance):
+    """与基线逐阶段比较耗时，返回变慢超过 tolerance 的阶段"""
+    baseline = {(result["per_gender"], stage["stage"]): stage for result in baseline for stage in result["stages"]}
+    regressions = []
+    for result in results:
+        for stage in result["stages"]:
+            base = baseline.get((result["per_gender"], stage["stage"]))
+            if base is None or not base["seconds"]:
+                continue
+            ratio = stage["seconds"] / base["seconds"]
+            stage["baseline_seconds"] = base["seconds"]
+            if ratio > 1 + tolerance:
+                regressions.append({"per_gender": result["per_gender"], "stage": stage["stage"],
+                                    "seconds": stage["seconds"], "baseline_seconds": base["seconds"],
+                                    "ratio": round(ratio, 2)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="匹配任务基准")
+    parser.add_argument("--per-gender", default="100,1000", help="每个性别的学生数，逗号分隔，例如 100,1000,20000")
+    parser.add_argument("--database-url", default=None, help="默认每个规模用一个临时 SQLite 库；MySQL 须为空的测试库")
+    parser.add_argument("--dim", type=int, default=768, help="HashEncoder 的向量维度")
+    parser.add_argument("--change-fraction", type=float, default=0.01, help="增量阶段修改答案的学生比例")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", default=None, help="把结果保存为基线文件")
+    parser.add_argument("--baseline", default=None, help="与之前保存的基线比较")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="耗时超过基线多少比例算变慢")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.per_gender.split(",")]
+    if args.worker:
+        result = run_size(sizes[0], args.database_url, args.dim, args.change_fraction, args.seed)
+        print("RESULT " + json.dumps(result, ensure_ascii=False))
+        return
+
+    results = [run_subprocess(size, args) for size in sizes]
+    output = {"results": results}
+    if args.baseline:
+        with open(args.baseline) as f:
+            output["regressions"] = compare(results, json.load(f)["results"], args.tolerance)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"results": results}, f, ensure_ascii=False, indent=2)
+    print(json.dumps(output, ensure_ascii=False, indent=2))
+    if output.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+启动耗时基准：每次都在全新的子进程里测量模块导入耗时、常驻内存，以及编码器第一次加载和释放后的内存
+用法: python -m benchmarks.startup --module tasks --encode --backend text2vec-int8 --repeat 3
+     python -m benchmarks.startup --serve   # 启动 gunicorn，测量到 /ready 返回 200 的耗时
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["numpy", "torch", "text2vec", "transformers"]
+
+PROBE = '''
+import json, os, time
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+result = {{"rss_start_mb": rss_mb()}}
+started_at = time.perf_counter()
+import {module}
+result["import_seconds"] = time.perf_counter() - started_at
+result["rss_imported_mb"] = rss_mb()
+import sys
+result["heavy_modules"] = [name for name in {heavy_modules} if name in sys.modules]
+
+if {encode}:
+    from encoders import get_encoder
+    encoder = get_encoder()
+    started_at = time.perf_counter()
+    encoder.encode("喜欢安静，作息规律")
+    result["first_encode_seconds"] = time.perf_counter() - started_at
+    result["rss_loaded_mb"] = rss_mb()
+    started_at = time.perf_counter()
+    encoder.encode("周末喜欢出去玩")
+    result["warm_encode_seconds"] = time.perf_counter() - started_at
+    encoder.unload()
+    result["rss_unloaded_mb"] = rss_mb()
+
+print("RESULT " + json.dumps(result))
+'''
+
+
+def run_once(module, encode, backend):
+    env = dict(os.environ)
+    if backend:
+        env["ENCODER_BACKEND"] = backend
+    probe = PROBE.format(module=module, encode=encode, heavy_modules=HEAVY_MODULES)
+    completed = subprocess.run([sys.executable, "-c", probe], cwd=ROOT, env=env, capture_output=True, text=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+    raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr else "子进程没有输出结果")
+
+
+def serve_once(timeout):
+    """用 gunicorn.config.py 启动 API，轮询 /ready 直到返回 200"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    started_at = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.config.py",
+                                "--bind", "127.0.0.1:{}".format(port),
+                                "--access-logfile", "-", "--error-logfile", "-", "app:app"],
+                               cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started_at < timeout:
+            try:
+                with urllib.request.urlopen("http://127.0.0.1:{}/ready".format(port), timeout=1) as response:
+                    body = json.loads(response.read())
+                    return {"ready_seconds": time.perf_counter() - started_at,
+                            "worker_boot_seconds": body["data"]["boot_seconds"]}
+            except (urllib.error.URLError, ConnectionError, OSError):
+                time.sleep(0.05)
+        raise RuntimeError("{} 秒内 /ready 没有返回 200".format(timeout))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量进程启动耗时与内存占用")
+    parser.add_argument("--module", default="tasks", help="要导入的模块，例如 tasks 或 app")
+    parser.add_argument("--encode", action="store_true", help="同时测量编码器第一次加载的耗时和内存")
+    parser.add_argument("--backend", default=None, help="编码器后端，覆盖 ENCODER_BACKEND")
+    parser.add_argument("--serve", action="store_true", help="启动 gunicorn 并测量到就绪的耗时")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.serve:
+        runs = [serve_once(args.timeout) for _ in range(args.repeat)]
+    else:
+        runs = [run_once(args.module, args.encode, args.backend) for _ in range(args.repeat)]
+    summary = {key: round(statistics.median(run[key] for run in runs), 3)
+               for key in runs[0] if isinstance(runs[0][key], (int, float))}
+    summary.update({key: value for key, value in runs[0].items() if not isinstance(value, (int, float))})
+    print(json.dumps({"module": "gunicorn app:app" if args.serve else args.module, "backend": args.backend,
+                      "repeat": args.repeat, "median": summary}, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import os
+import time
+
+# 进程启动各阶段的耗时记录，/ready 接口会把它们返回给探针和运维
+
+
+def _process_started_at():
+    # 从 /proc 读取进程真正的启动时间，这样解释器启动和导入 boot 之前的耗时也能算进去
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - (uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+process_started_at = _process_started_at()
+_phases = []
+
+
+def mark(phase):
+    _phases.append((phase, time.time()))
+
+
+def marked(phase):
+    return any(item[0] == phase for item in _phases)
+
+
+def phases():
+    return [{
+        "phase": phase,
+        "seconds_since_start": round(at - process_started_at, 3)
+    } for phase, at in _phases]
+
+
+def boot_seconds():
+    return round(_phases[-1][1] - process_started_at, 3) if _phases else None
@@ -0,0 +1,75 @@
+import time
+
+from sqlalchemy import func, text
+
+from config import GeneralConfig
+from database import db_session
+
+
+def is_referenced(model):
+    """是否有其他表的外键指向该表，被引用的表在 MySQL 里不能 TRUNCATE"""
+    table = model.__table__
+    for other in table.metadata.tables.values():
+        if other is table:
+            continue
+        if any(foreign_key.column.table is table for foreign_key in other.foreign_keys):
+            return True
+    return False
+
+
+def purge(model, *criteria, chunk_size=None, on_progress=None):
+    """
+    批量删除数据，返回删除的行数
+    没有过滤条件且表没有被外键引用时直接 TRUNCATE；否则按主键顺序每次删除 chunk_size 行并单独提交，
+    避免一个大事务撑爆 undo log、长时间锁住学生端的读写
+    on_progress(fraction, deleted) 在每批提交后调用
+    """
+    chunk_size = chunk_size or GeneralConfig.PURGE_CHUNK_SIZE
+    table = model.__table__
+
+    if not criteria and db_session.get_bind().dialect.name == "mysql" and not is_referenced(model):
+        # 大表上 COUNT(*) 本身就要扫很久，这里只取 information_schema 里的估计值用于展示
+        deleted = db_session.execute(text("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                                          "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name"),
+                                     {"name": table.name}).scalar() or 0
+        # TRUNCATE 会隐式提交，先把之前的修改提交掉
+        db_session.commit()
+        db_session.execute(text("TRUNCATE TABLE `{}`".format(table.name)))
+        db_session.commit()
+        if on_progress is not None:
+            on_progress(1.0, deleted)
+        return deleted
+
+    primary_key = model.id
+    lowest, highest = db_session.query(func.min(primary_key), func.max(primary_key)).filter(*criteria).one()
+    if lowest is None:
+        return 0
+
+    deleted = 0
+    lower = lowest
+    while True:
+        # 找到下一批的上界：从 lower 开始第 chunk_size + 1 行的主键，走主键索引，不需要 COUNT
+        upper = db_session.query(primary_key) \
+            .filter(*criteria) \
+            .filter(primary_key >= lower) \
+            .order_by(primary_key.asc()) \
+            .offset(chunk_size) \
+            .limit(1) \
+            .scalar()
+
+        query = db_session.query(model).filter(*criteria).filter(primary_key >= lower)
+        if upper is not None:
+            query = query.filter(primary_key < upper)
+        deleted += query.delete(synchronize_session=False)
+        db_session.commit()
+
+        if on_progress is not None:
+            fraction = 1.0 if upper is None else (upper - lowest) / (highest - lowest + 1)
+            on_progress(fraction, deleted)
+        if upper is None:
+            return deleted
+
+        lower = upper
+        if GeneralConfig.PURGE_PAUSE_SECONDS > 0:
+            # 给其他事务让出锁和 IO
+            time.sleep(GeneralConfig.PURGE_PAUSE_SECONDS)
@@ -0,0 +1,80 @@
+from sqlalchemy import func
+
+from database import db_session
+from models import MatchingScore, Student
+
+# 匹配分是有方向的：to_student 视角下的分数按 to_student 自己的权重计算，与推荐列表保持一致
+
+
+def _summary(mean, minimum, square_mean, count):
+    if not count:
+        return None
+    mean = float(mean)
+    return {
+        "mean": round(mean, 2),
+        "min": round(float(minimum), 2),
+        # 方差 = E[x²] - E[x]²，浮点误差可能带来极小的负数
+        "variance": round(max(float(square_mean) - mean * mean, 0.0), 2),
+        "count": int(count)
+    }
+
+
+def team_compatibility(student_id, team_ids):
+    """
+    一次查询算出学生与多个队伍的契合度：学生对各队伍成员（不含自己）匹配分的均值、最小值和方差
+    返回 {team_id: summary}，没有任何匹配分的队伍不会出现在结果中
+    """
+    team_ids = [team_id for team_id in set(team_ids) if team_id is not None]
+    if not team_ids:
+        return {}
+
+    rows = db_session.query(Student.team_id,
+                            func.avg(MatchingScore.score),
+                            func.min(MatchingScore.score),
+                            func.avg(MatchingScore.score * MatchingScore.score),
+                            func.count(MatchingScore.id)) \
+        .join(Student, Student.id == MatchingScore.from_student_id) \
+        .filter(MatchingScore.to_student_id == student_id) \
+        .filter(Student.team_id.in_(team_ids)) \
+        .filter(Student.id != student_id) \
+        .group_by(Student.team_id) \
+        .all()
+
+    return {team_id: _summary(*values) for team_id, *values in rows}
+
+
+def members_compatibility(team_id, student_ids=None):
+    """
+    一次查询算出多位学生与某队伍的契合度，返回 {student_id: summary}
+    student_ids 为空时计算队伍里每位成员与其他成员的契合度
+    """
+    member = Student.__table__.alias("member")
+    query = db_session.query(MatchingScore.to_student_id,
+                             func.avg(MatchingScore.score),
+                             func.min(MatchingScore.score),
+                             func.avg(MatchingScore.score * MatchingScore.score),
+                             func.count(MatchingScore.id)) \
+        .join(member, member.c.id == MatchingScore.from_student_id) \
+        .filter(member.c.team_id == team_id)
+
+    if student_ids is None:
+        query = query.join(Student, Student.id == MatchingScore.to_student_id) \
+            .filter(Student.team_id == team_id)
+    else:
+        query = query.filter(MatchingScore.to_student_id.in_(student_ids))
+
+    rows = query.group_by(MatchingScore.to_student_id).all()
+
+    return {student_id: _summary(*values) for student_id, *values in rows}
+
+
+def team_sizes(team_ids):
+    """一次查询得到多个队伍的人数"""
+    team_ids = [team_id for team_id in set(team_ids) if team_id is not None]
+    if not team_ids:
+        return {}
+
+    return dict(db_session.query(Student.team_id, func.count(Student.id))
+                .filter(Student.team_id.in_(team_ids))
+                .group_by(Student.team_id)
+                .all())
@@ -9,12 +9,62 @@ class GeneralConfig:
     DB_USER = os.getenv('DB_USER', 'root')
     DB_PASSWORD = os.getenv('DB_PASSWORD', '')
     
-    # 构建数据库URL
-    DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    # 构建数据库URL，也可以直接用 DATABASE_URL 指定（例如本地测试用的 SQLite）
+    DATABASE_URL = os.getenv('DATABASE_URL', f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
+    # 只读副本的 URL，学生端只读接口的查询发往副本；为空时全部走主库，本地测试可以指向另一个 SQLite 文件或 MySQL 实例
+    DATABASE_REPLICA_URL = os.getenv('DATABASE_REPLICA_URL', '')
+    DATABASE_REPLICA_MAX_LAG = float(os.getenv('DATABASE_REPLICA_MAX_LAG', '2'))  # 副本延迟超过多少秒时改读主库，也是写入后多少秒内读主库
+    DATABASE_REPLICA_LAG_CHECK_SECONDS = float(os.getenv('DATABASE_REPLICA_LAG_CHECK_SECONDS', '5'))  # 每个进程多久查询一次副本延迟
+    # 连接池：每个进程常驻 DATABASE_POOL_SIZE 个连接，为 0 时按每个 API 实例的连接预算平均分给各 gunicorn worker
+    # gevent worker 里的请求超过连接数时在连接池上排队，最多等待 DATABASE_POOL_TIMEOUT 秒
+    GUNICORN_WORKERS = int(os.getenv('GUNICORN_WORKERS', '4'))  # gunicorn worker 进程数
+    GUNICORN_WORKER_CONNECTIONS = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))  # 每个 gevent worker 同时处理的请求数
+    DATABASE_GEVENT = os.getenv('DATABASE_GEVENT', 'False').lower() == 'true'  # 导入 app 前 monkey patch，gunicorn.config.py 会打开
+    DATABASE_MAX_CONNECTIONS = int(os.getenv('DATABASE_MAX_CONNECTIONS', '80'))  # 每个 API 实例所有 worker 合计的连接预算
+    DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', '0'))  # 每个进程常驻的连接数，0 表示 DATABASE_MAX_CONNECTIONS / GUNICORN_WORKERS
+    DATABASE_MAX_OVERFLOW = int(os.getenv('DATABASE_MAX_OVERFLOW', '0'))  # 每个进程高峰时临时多开的连接数
+    DATABASE_POOL_TIMEOUT = float(os.getenv('DATABASE_POOL_TIMEOUT', '10'))  # 等待空闲连接的最长秒数，超时的请求直接报错
+    DATABASE_POOL_PRE_PING = os.getenv('DATABASE_POOL_PRE_PING', 'False').lower() == 'true'  # 取出连接时先检查是否断开，每次多一次往返
+    DATABASE_POOL_USE_LIFO = os.getenv('DATABASE_POOL_USE_LIFO', 'False').lower() == 'true'  # 优先复用最近归还的连接，空闲连接更容易被回收
     
     JWT_SECRET_KEY = os.getenv('JWT_SECRET', "R2xpmzp1F9QcpHn9")
-    DATABASE_LOG = os.getenv('DATABASE_LOG', 'True').lower() == 'true'
-    ASYNC_JOB_SCAN_INTERVAL = int(os.getenv('ASYNC_JOB_SCAN_INTERVAL', '10'))  # in seconds
+    DATABASE_LOG = os.getenv('DATABASE_LOG', 'False').lower() == 'true'  # 逐条打印 SQL，只在本地排查问题时打开
+    SQL_STATS_SAMPLE_RATE = float(os.getenv('SQL_STATS_SAMPLE_RATE', '0.05'))  # 统计 SQL 的请求比例，0 表示不统计
+    SQL_STATS_LOG_INTERVAL = int(os.getenv('SQL_STATS_LOG_INTERVAL', '300'))  # 多少秒打印一次各接口的 SQL 统计，0 表示不打印
+    SQL_STATS_SLOW_MS = int(os.getenv('SQL_STATS_SLOW_MS', '1000'))  # 抽样请求超过该耗时时打印一行明细
+    SQL_STATS_N_PLUS_ONE = int(os.getenv('SQL_STATS_N_PLUS_ONE', '10'))  # 一次请求里同一种语句执行这么多次时标记为 N+1
+    METRICS_DIR = os.getenv('METRICS_DIR', './data/metrics')  # gunicorn 各 worker 汇总指标用的目录，同一台机器上的 worker 共享
+    METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '5'))  # worker 最多每隔多少秒把指标写到 METRICS_DIR
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))  # 匹配任务进程暴露 /metrics 的端口，0 表示不暴露
+    EVENT_POLL_INTERVAL = float(os.getenv('EVENT_POLL_INTERVAL', '1'))  # worker 查询新变更事件的间隔（秒）
+    EVENT_POLL_BATCH = int(os.getenv('EVENT_POLL_BATCH', '1000'))  # 每次最多读取的事件数
+    EVENT_FALLBACK_SECONDS = int(os.getenv('EVENT_FALLBACK_SECONDS', '60'))  # 没有事件时多久兜底执行一次所有任务
+    MATCHING_DEBOUNCE_SECONDS = float(os.getenv('MATCHING_DEBOUNCE_SECONDS', '3'))  # 最后一次提交答案后等待多久再计算匹配分
+    MATCHING_MAX_DELAY_SECONDS = float(os.getenv('MATCHING_MAX_DELAY_SECONDS', '30'))  # 持续有提交时最多等待多久
+    PURGE_CHUNK_SIZE = int(os.getenv('PURGE_CHUNK_SIZE', '5000'))  # 批量删除时每个事务删除的行数
+    PURGE_PAUSE_SECONDS = float(os.getenv('PURGE_PAUSE_SECONDS', '0.05'))  # 批量删除每批之间的停顿，给学生端让路
+    MATCHING_STORE_PATH = os.getenv('MATCHING_STORE_PATH', './data/matching')  # 逐题相似度缓存目录
+    MATCHING_SIMILARITY_DTYPE = os.getenv('MATCHING_SIMILARITY_DTYPE', 'float32')  # float16 可将缓存减半
+    SCORE_MATRIX_PATH = os.getenv('SCORE_MATRIX_PATH', './data/scores')  # 发布给 API 读取的匹配分矩阵目录，需与 worker 共享
+    MATCHING_FULL_CHECK_SECONDS = int(os.getenv('MATCHING_FULL_CHECK_SECONDS', '600'))  # 答案概况没变时多久完整检查一次
+    # 候选对模式：学生很多的分块只为每位学生的近邻计算和保存匹配分（见 ann.py 和 matching.refresh_candidates）
+    MATCHING_ANN = os.getenv('MATCHING_ANN', 'False').lower() == 'true'  # 是否打开候选对模式
+    MATCHING_ANN_MIN_STUDENTS = int(os.getenv('MATCHING_ANN_MIN_STUDENTS', '5000'))  # 分块学生数达到该值时才使用
+    MATCHING_ANN_TEXT_NEIGHBOURS = int(os.getenv('MATCHING_ANN_TEXT_NEIGHBOURS', '10'))  # 每道文本题为每位学生取的近邻数
+    MATCHING_ANN_NUMERIC_NEIGHBOURS = int(os.getenv('MATCHING_ANN_NUMERIC_NEIGHBOURS', '100'))  # 按数值类答案取的近邻数
+    MATCHING_ANN_PROBES = int(os.getenv('MATCHING_ANN_PROBES', '8'))  # 每位学生查询的 IVF 桶数，越大召回越高越慢
+    MATCHING_ANN_LISTS = int(os.getenv('MATCHING_ANN_LISTS', '0'))  # IVF 桶的个数，0 表示 √n
+    PROGRESS_LOG_LEVEL = os.getenv('PROGRESS_LOG_LEVEL', 'info')  # 匹配任务的日志级别 debug / info / warning / error
+    PROGRESS_LOG_FORMAT = os.getenv('PROGRESS_LOG_FORMAT', 'json')  # json 每行一个 JSON 对象，text 为纯文本
+    PROGRESS_LOG_INTERVAL = float(os.getenv('PROGRESS_LOG_INTERVAL', '10'))  # 匹配进度最多每隔多少秒打印并写入 scan_runs 一次
+    JOB_IMPORT_CHUNK_SIZE = int(os.getenv('JOB_IMPORT_CHUNK_SIZE', '50'))  # 导入学生时每个事务处理的人数
+    ALLOCATION_MAX_SECONDS = int(os.getenv('ALLOCATION_MAX_SECONDS', '300'))  # 自动分配局部搜索的时间上限
+    EXCHANGING_MAX_CYCLE_LENGTH = int(os.getenv('EXCHANGING_MAX_CYCLE_LENGTH', '3'))  # 换寝环最多涉及几个人
+    EXCHANGING_FANOUT = int(os.getenv('EXCHANGING_FANOUT', '20'))  # 搜索换寝环时每人只考虑提升最大的前 N 个去向
+    ENCODER_BACKEND = os.getenv('ENCODER_BACKEND', 'text2vec')  # text2vec / text2vec-int8 / onnx
+    ENCODER_MODEL = os.getenv('ENCODER_MODEL', 'shibing624/text2vec-base-chinese')
+    ENCODER_ONNX_PATH = os.getenv('ENCODER_ONNX_PATH', './models/text2vec.onnx')
+    ENCODER_IDLE_TIMEOUT = int(os.getenv('ENCODER_IDLE_TIMEOUT', '600'))  # 编码器空闲多少秒后释放，0 表示不释放
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=15)
     JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=30)
 
@@ -1,14 +1,55 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 from config import GeneralConfig
 
-engine = create_engine(GeneralConfig.DATABASE_URL, echo=GeneralConfig.DATABASE_LOG,
-                       pool_size=10,
-                       pool_recycle=7200,
-                       pool_timeout=30)
-db_session: scoped_session = scoped_session(sessionmaker(autocommit=False,
+
+def pool_options():
+    """每个进程的连接池参数，见 config.py"""
+    pool_size = GeneralConfig.DATABASE_POOL_SIZE or \
+        max(1, GeneralConfig.DATABASE_MAX_CONNECTIONS // max(1, GeneralConfig.GUNICORN_WORKERS))
+    return dict(pool_size=pool_size,
+                max_overflow=GeneralConfig.DATABASE_MAX_OVERFLOW,
+                pool_timeout=GeneralConfig.DATABASE_POOL_TIMEOUT,
+                pool_recycle=7200,
+                pool_pre_ping=GeneralConfig.DATABASE_POOL_PRE_PING,
+                pool_use_lifo=GeneralConfig.DATABASE_POOL_USE_LIFO)
+
+
+engine = create_engine(GeneralConfig.DATABASE_URL, echo=GeneralConfig.DATABASE_LOG, **pool_options())
+# 只读副本，未配置时所有查询都走主库
+replica_engine = create_engine(GeneralConfig.DATABASE_REPLICA_URL, echo=GeneralConfig.DATABASE_LOG,
+                               **pool_options()) if GeneralConfig.DATABASE_REPLICA_URL else None
+
+
+class RoutingSession(Session):
+    """
+    session.info["use_replica"] 为 True 时（由 replica.replica_reads 在只读接口里设置）查询发往只读副本
+    写入（flush、INSERT / UPDATE / DELETE、SELECT ... FOR UPDATE）总是发往主库，写入之后这个 session 的读也回到主库
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if replica_engine is None or not self.info.get("use_replica") or self.info.get("wrote") or self._flushing:
+            return engine
+        if clause is not None and (clause.is_dml or getattr(clause, "_for_update_arg", None) is not None):
+            return engine
+        return replica_engine
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def _mark_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _mark_flush(session, flush_context):
+    session.info["wrote"] = True
+
+
+db_session: scoped_session = scoped_session(sessionmaker(class_=RoutingSession,
+                                                         autocommit=False,
                                                          autoflush=True,
                                                          bind=engine))
 Base = declarative_base()
@@ -0,0 +1,193 @@
+import gc
+import threading
+import time
+
+import numpy as np
+
+from config import GeneralConfig
+
+
+class Encoder:
+    """文本编码器接口，具体后端只需实现 load / encode / unload"""
+
+    def load(self):
+        raise NotImplementedError
+
+    def encode(self, texts):
+        """texts 为单个字符串时返回一维向量，为列表时返回 (n, dim) 矩阵"""
+        raise NotImplementedError
+
+    def unload(self):
+        pass
+
+
+class Text2VecEncoder(Encoder):
+    """text2vec 的 SentenceModel（torch），quantize=True 时对 Linear 层做动态 int8 量化，CPU 推理更快、占用更少"""
+
+    def __init__(self, model_name, quantize=False):
+        self.model_name = model_name
+        self.quantize = quantize
+        self.model = None
+
+    def load(self):
+        # torch 和 text2vec 只在真正需要编码时才导入
+        from text2vec import SentenceModel
+
+        self.model = SentenceModel(self.model_name)
+        if self.quantize:
+            import torch
+
+            self.model.bert = torch.quantization.quantize_dynamic(self.model.bert, {torch.nn.Linear},
+                                                                  dtype=torch.qint8)
+
+    def encode(self, texts):
+        return np.asarray(self.model.encode(texts))
+
+    def unload(self):
+        self.model = None
+
+
+class OnnxEncoder(Encoder):
+    """onnxruntime 推理，模型由 export_onnx 导出，不需要在 worker 里加载 torch"""
+
+    def __init__(self, model_name, model_path, max_length=256):
+        self.model_name = model_name
+        self.model_path = model_path
+        self.max_length = max_length
+        self.session = None
+        self.tokenizer = None
+
+    def load(self):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.session = onnxruntime.InferenceSession(self.model_path, providers=["CPUExecutionProvider"])
+
+    def encode(self, texts):
+        single = isinstance(texts, str)
+        batch = self.tokenizer([texts] if single else list(texts), padding=True, truncation=True,
+                               max_length=self.max_length, return_tensors="np")
+        input_names = [item.name for item in self.session.get_inputs()]
+        hidden = self.session.run(None, {name: batch[name] for name in input_names})[0]
+
+        # 与 text2vec 默认的 MEAN 池化一致
+        mask = batch["attention_mask"][..., None].astype(np.float32)
+        embeddings = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return embeddings[0] if single else embeddings
+
+    def unload(self):
+        self.session = None
+        self.tokenizer = None
+
+
+class LazyEncoder(Encoder):
+    """
+    第一次 encode 时才加载后端，空闲超过 idle_timeout 秒后由 unload_if_idle 释放
+    unload_if_idle 在调度器的另一个线程里执行，加载、计数和释放都在 _lock 内进行，正在 encode 时不会释放
+    """
+
+    def __init__(self, backend, idle_timeout):
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self.loaded = False
+        self.last_used_at = None
+        self.load_seconds = None
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not self.loaded:
+            started_at = time.monotonic()
+            self.backend.load()
+            self.load_seconds = time.monotonic() - started_at
+            self.loaded = True
+        self.last_used_at = time.monotonic()
+
+    def load(self):
+        with self._lock:
+            self._load()
+
+    def encode(self, texts):
+        with self._lock:
+            self._load()
+            self.in_use += 1
+        try:
+            return self.backend.encode(texts)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+                self.last_used_at = time.monotonic()
+
+    def _unload(self):
+        if self.loaded:
+            self.backend.unload()
+            self.loaded = False
+            gc.collect()
+
+    def unload(self):
+        with self._lock:
+            self._unload()
+
+    def unload_if_idle(self):
+        with self._lock:
+            if self.loaded and self.in_use == 0 and self.idle_timeout > 0 and \
+                    time.monotonic() - self.last_used_at > self.idle_timeout:
+                self._unload()
+                return True
+        return False
+
+
+def create_encoder(backend=None):
+    backend = backend or GeneralConfig.ENCODER_BACKEND
+    if backend == "text2vec":
+        return Text2VecEncoder(GeneralConfig.ENCODER_MODEL)
+    elif backend == "text2vec-int8":
+        return Text2VecEncoder(GeneralConfig.ENCODER_MODEL, quantize=True)
+    elif backend == "onnx":
+        return OnnxEncoder(GeneralConfig.ENCODER_MODEL, GeneralConfig.ENCODER_ONNX_PATH)
+    raise ValueError("未知的编码器后端: {}".format(backend))
+
+
+_encoder = None
+
+
+def get_encoder():
+    global _encoder
+    if _encoder is None:
+        _encoder = LazyEncoder(create_encoder(), GeneralConfig.ENCODER_IDLE_TIMEOUT)
+    return _encoder
+
+
+def cos_sim(vector_a, vector_b):
+    norm = np.linalg.norm(vector_a) * np.linalg.norm(vector_b)
+    if norm == 0:
+        return 0.0
+    return float(np.dot(vector_a, vector_b) / norm)
+
+
+def export_onnx(model_name, model_path, quantize=True):
+    """把 HuggingFace 模型导出为 ONNX，quantize=True 时再做一次动态 int8 量化"""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    sample = tokenizer(["导出"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    export_path = model_path + ".fp32" if quantize else model_path
+    torch.onnx.export(model, tuple(sample[name] for name in input_names), export_path,
+                      input_names=input_names, output_names=["last_hidden_state"],
+                      dynamic_axes=dynamic_axes, opset_version=14)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(export_path, model_path, weight_type=QuantType.QInt8)
+
+
+if __name__ == '__main__':
+    export_onnx(GeneralConfig.ENCODER_MODEL, GeneralConfig.ENCODER_ONNX_PATH)
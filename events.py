@@ -0,0 +1,102 @@
+import datetime
+import threading
+import time
+
+from sqlalchemy import event, func
+
+from config import GeneralConfig
+from database import db_session
+from models import Event, ExchangingNeed, ExchangingRequest
+
+# 变更事件（outbox）：修改答案、学生、问卷，或排队后台任务和扫描时，在同一个事务里写一条 events
+# worker 每 EVENT_POLL_INTERVAL 秒按主键查询一次有没有新事件，只在有事件时才执行相应的任务，空闲时几乎不访问数据库
+# API 和 worker 可能不在同一台机器上，所以通过数据库而不是进程间通信传递
+# 并发事务提交的顺序可能与主键顺序不同，个别事件可能被跳过，worker 每 EVENT_FALLBACK_SECONDS 秒兜底执行一次所有任务
+
+EVENT_ANSWERS = "answers"  # 问卷答案或权重变化
+EVENT_STUDENTS = "students"  # 学生增删、性别或类别变化
+EVENT_QUESTIONNAIRE = "questionnaire"  # 问卷题目变化
+EVENT_JOB = "job"  # 排队了后台任务
+EVENT_SCAN = "scan"  # 管理员排队了匹配扫描
+EVENT_EXCHANGING = "exchanging"  # 提交了换寝需求或换寝申请
+
+# 需要重新计算匹配分的事件
+MATCHING_EVENTS = (EVENT_ANSWERS, EVENT_STUDENTS, EVENT_QUESTIONNAIRE)
+
+
+def publish(event_type, student_id=None):
+    """加入当前事务，由调用方与数据修改一起提交"""
+    db_session.add(Event(type=event_type, student_id=student_id))
+
+
+@event.listens_for(ExchangingNeed, "after_insert")
+@event.listens_for(ExchangingRequest, "after_insert")
+def _exchanging_created(mapper, connection, target):
+    # 换寝需求和申请不论从哪个接口创建都发布事件；flush 过程中不能再 add，直接用同一个连接写入
+    student_id = getattr(target, "student_id", None) or getattr(target, "from_student_id", None)
+    connection.execute(Event.__table__.insert().values(type=EVENT_EXCHANGING, student_id=student_id))
+
+
+class Signal:
+    """
+    worker 内部的唤醒标记：set 之后，下一次 due 返回 True
+    debounce 大于 0 时，距离最后一次 set 超过 debounce 秒（或距离第一次 set 超过 max_delay 秒）才算到期，
+    一连串的提交合并为一次计算
+    """
+
+    def __init__(self, debounce=0, max_delay=None):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.first_at = None
+        self.last_at = None
+        self._lock = threading.Lock()
+
+    def set(self):
+        with self._lock:
+            now = time.monotonic()
+            self.first_at = self.first_at or now
+            self.last_at = now
+
+    def due(self):
+        """到期时清除标记并返回 True"""
+        with self._lock:
+            if self.first_at is None:
+                return False
+            now = time.monotonic()
+            if now - self.last_at < self.debounce and \
+                    (self.max_delay is None or now - self.first_at < self.max_delay):
+                return False
+            self.first_at = self.last_at = None
+            return True
+
+
+class EventWatcher:
+    """按主键顺序读取新事件，返回这批事件的类型"""
+
+    def __init__(self):
+        self.last_id = None
+
+    def poll(self):
+        if self.last_id is None:
+            # worker 启动时各任务会先完整执行一次，之前的事件不必再处理
+            self.last_id = db_session.query(func.max(Event.id)).scalar() or 0
+            db_session.commit()
+            return set()
+
+        rows = db_session.query(Event.id, Event.type) \
+            .filter(Event.id > self.last_id) \
+            .order_by(Event.id.asc()) \
+            .limit(GeneralConfig.EVENT_POLL_BATCH) \
+            .all()
+        # 结束只读事务，否则 MySQL 的可重复读隔离级别下看不到之后提交的事件
+        db_session.commit()
+        if rows:
+            self.last_id = rows[-1][0]
+        return set(row[1] for row in rows)
+
+
+def prune(keep_seconds=86400):
+    """删除一天前的事件"""
+    before = datetime.datetime.now() - datetime.timedelta(seconds=keep_seconds)
+    db_session.query(Event).filter(Event.created_at < before).delete(synchronize_session=False)
+    db_session.commit()
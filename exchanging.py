@@ -0,0 +1,243 @@
+import json
+import threading
+
+from sqlalchemy import or_
+
+from config import GeneralConfig
+from database import db_session
+from models import ExchangingCandidate, ExchangingNeed, MatchingScore, Student, get_system_setting, \
+    set_system_setting
+from partitions import category_groups, partition_categories, partition_key
+
+# 扫描过的需求：id 不超过 exchanging_scanned_need_id 的需求已经扫描过，
+# exchanging_pending_need_ids 里的需求需要（重新）扫描——扫描时学生还没有队伍，或之后匹配分被重写
+# 扫描和加入待扫描列表都在 worker 里执行，用锁串行，避免扫描结束时覆盖掉扫描期间加入的需求
+_lock = threading.Lock()
+
+
+class SwapGraph:
+    """
+    有换寝需求的学生组成的有向图：a -> b 表示 a 搬进 b 的位置（b 所在队伍去掉 b）后，a 与室友的平均匹配分更高
+    出边在第一次用到时才查询，同一轮扫描内复用
+    """
+
+    def __init__(self):
+        needs = db_session.query(ExchangingNeed.student_id, Student.team_id, Student.gender, Student.category) \
+            .join(Student, Student.id == ExchangingNeed.student_id) \
+            .filter(ExchangingNeed.processed == 0) \
+            .filter(Student.team_id.isnot(None)) \
+            .all()
+
+        # 只能与同一匹配分块（同性别，同一类别或可以混寝的类别）的学生换寝
+        groups = category_groups()
+        self.nodes = {}
+        for student_id, team_id, gender, category in needs:
+            self.nodes[student_id] = (team_id, partition_key(gender, partition_categories(category, groups)))
+
+        team_ids = set(team_id for team_id, _ in self.nodes.values())
+        self.team_members = {team_id: [] for team_id in team_ids}
+        for student_id, team_id in db_session.query(Student.id, Student.team_id) \
+                .filter(Student.team_id.in_(team_ids)).all():
+            self.team_members[team_id].append(student_id)
+
+        self._out_edges = {}
+
+    def group_of(self, student_id):
+        return self.nodes[student_id][1]
+
+    def fit(self, student_id, team_id, without, scores):
+        """学生与某队伍（去掉 without）现有成员的平均匹配分，没有任何分数时返回 None"""
+        values = [scores[member] for member in self.team_members[team_id]
+                  if member != without and member != student_id and member in scores]
+        if not values:
+            return None
+        return sum(values) / len(values)
+
+    def out_edges(self, student_id):
+        if student_id in self._out_edges:
+            return self._out_edges[student_id]
+
+        team_id = self.nodes[student_id][0]
+        targets = [target for target in self.nodes
+                   if target != student_id
+                   and self.nodes[target][0] != team_id
+                   and self.group_of(target) == self.group_of(student_id)]
+
+        members = set(self.team_members[team_id])
+        for target in targets:
+            members.update(self.team_members[self.nodes[target][0]])
+
+        scores = mutual_scores(student_id, members)
+        current = self.fit(student_id, team_id, student_id, scores)
+        edges = []
+        for target in targets:
+            fit = self.fit(student_id, self.nodes[target][0], target, scores)
+            if fit is None:
+                continue
+            gain = fit - (current if current is not None else 0)
+            if gain > 0:
+                edges.append((target, gain))
+
+        edges.sort(key=lambda edge: -edge[1])
+        self._out_edges[student_id] = edges[:GeneralConfig.EXCHANGING_FANOUT]
+        return self._out_edges[student_id]
+
+    def cycles_through(self, student_id, max_length):
+        """所有经过该学生、每个人都能提升匹配分、且涉及的队伍互不相同的换寝环"""
+        cycles = []
+
+        def search(path, gains, teams):
+            for target, gain in self.out_edges(path[-1]):
+                if target == path[0] and len(path) >= 2:
+                    cycles.append((list(path), gains + [gain]))
+                    continue
+                if len(path) >= max_length or target in path:
+                    continue
+                target_team = self.nodes[target][0]
+                if target_team in teams:
+                    continue
+                search(path + [target], gains + [gain], teams | {target_team})
+
+        search([student_id], [], {self.nodes[student_id][0]})
+        return cycles
+
+
+def mutual_scores(student_id, others):
+    """学生与一组同学之间的双向匹配分均值，只有单向分数时直接使用单向分数"""
+    rows = db_session.query(MatchingScore.from_student_id, MatchingScore.to_student_id, MatchingScore.score) \
+        .filter(or_(
+            (MatchingScore.from_student_id == student_id) & MatchingScore.to_student_id.in_(others),
+            (MatchingScore.to_student_id == student_id) & MatchingScore.from_student_id.in_(others)
+        )).all()
+
+    collected = {}
+    for from_student_id, to_student_id, score in rows:
+        other = to_student_id if from_student_id == student_id else from_student_id
+        collected.setdefault(other, []).append(float(score))
+
+    return {other: sum(values) / len(values) for other, values in collected.items()}
+
+
+def cycle_key(student_ids):
+    # 同一个环从不同起点出发得到的序列是相同的，统一旋转到最小 id 开头
+    start = student_ids.index(min(student_ids))
+    return ",".join(str(student_id) for student_id in student_ids[start:] + student_ids[:start])
+
+
+def pending_need_ids():
+    return set(json.loads(get_system_setting("exchanging_pending_need_ids", "[]")))
+
+
+def set_pending_need_ids(need_ids):
+    set_system_setting("exchanging_pending_need_ids", json.dumps(sorted(need_ids)))
+
+
+def rescored_needs(student_ids):
+    """
+    匹配分重写后，学生本人或室友的匹配分被重写的未处理需求加入待扫描列表
+    换寝环上每条边只取决于出发学生与两个队伍成员之间的匹配分，这些需求重新扫描后能找到所有受影响的换寝环
+    """
+    student_ids = set(student_ids)
+    if not student_ids:
+        return
+    needs = db_session.query(ExchangingNeed.id, ExchangingNeed.student_id, Student.team_id) \
+        .join(Student, Student.id == ExchangingNeed.student_id) \
+        .filter(ExchangingNeed.processed == 0) \
+        .all()
+    team_ids = set(team_id for _, _, team_id in needs if team_id is not None)
+    rescored_team_ids = set(team_id for student_id, team_id in db_session.query(Student.id, Student.team_id)
+                            .filter(Student.team_id.in_(team_ids)).all() if student_id in student_ids)
+    need_ids = [need_id for need_id, student_id, team_id in needs
+                if student_id in student_ids or team_id in rescored_team_ids]
+    db_session.commit()
+    if need_ids:
+        with _lock:
+            set_pending_need_ids(pending_need_ids() | set(need_ids))
+
+
+def scan_exchanging_needs():
+    """为上次扫描之后新提交的需求和待扫描列表里的需求寻找换寝环"""
+    with _lock:
+        _scan_needs()
+
+
+def _scan_needs():
+    scanned_need_id = int(get_system_setting("exchanging_scanned_need_id", 0))
+    pending_ids = pending_need_ids()
+    needs = db_session.query(ExchangingNeed.id, ExchangingNeed.student_id) \
+        .filter(or_(ExchangingNeed.id > scanned_need_id, ExchangingNeed.id.in_(pending_ids))) \
+        .filter(ExchangingNeed.processed == 0) \
+        .order_by(ExchangingNeed.id.asc()) \
+        .all()
+    if not needs:
+        # 待扫描的需求都已处理或删除
+        if pending_ids:
+            set_pending_need_ids([])
+        return
+
+    graph = SwapGraph()
+    # 重新扫描的需求按当前的匹配分重新生成候选，经过这些学生的旧候选的提升可能已经变化
+    rescanned_student_ids = set(student_id for need_id, student_id in needs if need_id in pending_ids)
+    for candidate in db_session.query(ExchangingCandidate).all():
+        if rescanned_student_ids & set(json.loads(candidate.student_ids)):
+            db_session.delete(candidate)
+    db_session.flush()
+
+    existed_keys = set(row[0] for row in db_session.query(ExchangingCandidate.cycle_key).all())
+    candidates = []
+    skipped_ids = []
+
+    for need_id, student_id in needs:
+        if student_id not in graph.nodes:
+            # 学生还没有队伍，之后再扫描
+            skipped_ids.append(need_id)
+            continue
+        for student_ids, gains in graph.cycles_through(student_id, GeneralConfig.EXCHANGING_MAX_CYCLE_LENGTH):
+            key = cycle_key(student_ids)
+            if key in existed_keys:
+                continue
+            existed_keys.add(key)
+            candidates.append(ExchangingCandidate(
+                cycle_key=key,
+                student_ids=json.dumps(student_ids),
+                team_ids=json.dumps([graph.nodes[member][0] for member in student_ids]),
+                gains=json.dumps([round(gain, 2) for gain in gains]),
+                total_gain=round(sum(gains), 2),
+                min_gain=round(min(gains), 2),
+                length=len(student_ids)
+            ))
+
+    db_session.bulk_save_objects(candidates)
+    db_session.commit()
+    set_system_setting("exchanging_scanned_need_id", str(max(scanned_need_id, needs[-1][0])))
+    set_pending_need_ids(skipped_ids)
+
+
+def valid_candidates(student_id=None):
+    """返回仍然有效的换寝候选并按总提升排序，顺便清理已经失效的候选（需求已处理或队伍发生变化）"""
+    candidates = db_session.query(ExchangingCandidate) \
+        .order_by(ExchangingCandidate.total_gain.desc()) \
+        .all()
+
+    involved_ids = set()
+    for candidate in candidates:
+        involved_ids.update(json.loads(candidate.student_ids))
+
+    current_teams = dict(db_session.query(Student.id, Student.team_id).filter(Student.id.in_(involved_ids)).all())
+    open_need_ids = set(row[0] for row in db_session.query(ExchangingNeed.student_id)
+                        .filter(ExchangingNeed.processed == 0)
+                        .filter(ExchangingNeed.student_id.in_(involved_ids)).all())
+
+    result = []
+    for candidate in candidates:
+        student_ids = json.loads(candidate.student_ids)
+        team_ids = json.loads(candidate.team_ids)
+        if any(current_teams.get(member) != team_id or member not in open_need_ids
+               for member, team_id in zip(student_ids, team_ids)):
+            db_session.delete(candidate)
+            continue
+        if student_id is None or student_id in student_ids:
+            result.append(candidate)
+
+    db_session.commit()
+    return result
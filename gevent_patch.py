@@ -0,0 +1,10 @@
+from config import GeneralConfig
+
+# gevent worker 里所有请求共用一个线程，数据库驱动 pymysql 读写 socket 时必须能让出协程，否则一条慢查询会卡住整个 worker
+# gunicorn.config.py 使用 gevent worker 时打开 DATABASE_GEVENT，app 在导入其他模块之前先导入这里完成 monkey patch，
+# 不依赖 gunicorn 打补丁的时机；本地 flask run 和任务进程不打补丁
+
+if GeneralConfig.DATABASE_GEVENT:
+    from gevent import monkey
+
+    monkey.patch_all()
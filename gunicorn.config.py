@@ -1,9 +1,19 @@
+import os
+
+# worker 使用 gevent，app 导入时先 monkey patch（见 gevent_patch.py）
+# 须在导入 config 之前设置，fork 出来的 worker 沿用 master 已经导入的 config
+os.environ.setdefault("DATABASE_GEVENT", "true")
+
+from config import GeneralConfig  # noqa: E402
+
 # 日志配置
 loglevel = "debug"
 accesslog = './log/access.log'
 errorlog = './log/error.log'
 
-workers = 4
+workers = GeneralConfig.GUNICORN_WORKERS
 # 设置工作模式为协程
 worker_class = "gevent"
-bind = "0.0.0.0:5000"
\ No newline at end of file
+# 每个 worker 同时处理的请求数，超过连接池大小的请求在连接池上排队
+worker_connections = GeneralConfig.GUNICORN_WORKER_CONNECTIONS
+bind = "0.0.0.0:5000"
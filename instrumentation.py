@@ -0,0 +1,215 @@
+import random
+import re
+import threading
+import time
+from functools import wraps
+
+from flask import g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy_serializer import SerializerMixin
+
+from config import GeneralConfig
+
+# SQL 统计：按 SQL_STATS_SAMPLE_RATE 抽样请求，记录每个接口的 SQL 条数、数据库耗时、序列化耗时，
+# 以及每种语句（去掉参数后的指纹）的次数和耗时；同一个请求里同一种语句执行很多次时标记为 N+1
+# 数据只保存在当前进程里，gunicorn 每个 worker 各有一份；未抽中的请求只多一次随机数判断
+
+# 最多记录多少种语句，超过后新的语句只计入 "other"
+MAX_STATEMENTS = 500
+
+_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|:\w+|\$\d+"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(?+)"),
+    (re.compile(r"\s+"), " "),
+    # ORM 查询的字段列表很长，只保留 FROM 之后的部分
+    (re.compile(r"^SELECT (?:DISTINCT )?[^()]*? FROM ", re.IGNORECASE), "SELECT … FROM "),
+]
+
+_lock = threading.Lock()
+_endpoints = {}
+_statements = {}
+_n_plus_one = {}
+_last_logged_at = time.monotonic()
+
+
+def fingerprint(statement):
+    """去掉语句里的参数和字面量，IN (?, ?, ...) 合并为 IN (?+)，参数个数不同的同一种查询得到同一个指纹"""
+    statement = statement.strip()
+    for pattern, replacement in _PATTERNS:
+        statement = pattern.sub(replacement, statement)
+    return statement[:1000]
+
+
+def _current():
+    if has_request_context():
+        return g.get("sql_stats")
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _current() is not None:
+        context.sql_stats_started_at = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current()
+    started_at = getattr(context, "sql_stats_started_at", None)
+    if stats is None or started_at is None:
+        return
+    seconds = time.perf_counter() - started_at
+    stats["queries"] += 1
+    stats["db_seconds"] += seconds
+    key = fingerprint(statement)
+    stats["fingerprints"][key] = stats["fingerprints"].get(key, 0) + 1
+    stats["statements"].append((key, seconds))
+
+
+def _timed_serialization(function):
+    """把 to_dict 和 JSON 编码的耗时计入序列化时间，嵌套调用只计一次"""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        stats = _current()
+        if stats is None or stats["serializing"]:
+            return function(*args, **kwargs)
+        stats["serializing"] = True
+        started_at = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats["serializing"] = False
+            stats["serialize_seconds"] += time.perf_counter() - started_at
+
+    return wrapper
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    dumps = _timed_serialization(DefaultJSONProvider.dumps)
+
+
+def _start_request():
+    if GeneralConfig.SQL_STATS_SAMPLE_RATE > 0 and random.random() < GeneralConfig.SQL_STATS_SAMPLE_RATE:
+        g.sql_stats = {"started_at": time.perf_counter(), "queries": 0, "db_seconds": 0.0, "serialize_seconds": 0.0,
+                       "serializing": False, "fingerprints": {}, "statements": []}
+
+
+def _finish_request(exception=None):
+    stats = g.pop("sql_stats", None)
+    if stats is None:
+        return
+    seconds = time.perf_counter() - stats["started_at"]
+    endpoint = "{} {}".format(request.method, request.url_rule.rule if request.url_rule else "<unmatched>")
+    repeated = {key: count for key, count in stats["fingerprints"].items()
+                if count >= GeneralConfig.SQL_STATS_N_PLUS_ONE}
+
+    with _lock:
+        summary = _endpoints.setdefault(endpoint, {"requests": 0, "queries": 0, "max_queries": 0, "seconds": 0.0,
+                                                   "db_seconds": 0.0, "serialize_seconds": 0.0, "slow": 0})
+        summary["requests"] += 1
+        summary["queries"] += stats["queries"]
+        summary["max_queries"] = max(summary["max_queries"], stats["queries"])
+        summary["seconds"] += seconds
+        summary["db_seconds"] += stats["db_seconds"]
+        summary["serialize_seconds"] += stats["serialize_seconds"]
+        if seconds * 1000 >= GeneralConfig.SQL_STATS_SLOW_MS:
+            summary["slow"] += 1
+
+        for key, statement_seconds in stats["statements"]:
+            if key not in _statements and len(_statements) >= MAX_STATEMENTS:
+                key = "other"
+            statement = _statements.setdefault(key, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            statement["count"] += 1
+            statement["seconds"] += statement_seconds
+            statement["max_seconds"] = max(statement["max_seconds"], statement_seconds)
+
+        new_patterns = []
+        for key, count in repeated.items():
+            pattern = _n_plus_one.get((endpoint, key))
+            if pattern is None:
+                pattern = _n_plus_one[(endpoint, key)] = {"requests": 0, "max_repeats": 0}
+                new_patterns.append((key, count))
+            pattern["requests"] += 1
+            pattern["max_repeats"] = max(pattern["max_repeats"], count)
+
+    for key, count in new_patterns:
+        print("[SQL] 疑似 N+1：{} 一次请求执行了 {} 次 {}".format(endpoint, count, key), flush=True)
+    if seconds * 1000 >= GeneralConfig.SQL_STATS_SLOW_MS:
+        print("[SQL] 慢请求：{} 耗时 {:.0f}ms，{} 条 SQL 耗时 {:.0f}ms，序列化 {:.0f}ms".format(
+            endpoint, seconds * 1000, stats["queries"], stats["db_seconds"] * 1000, stats["serialize_seconds"] * 1000),
+            flush=True)
+    _log_summary_if_due()
+
+
+def snapshot(limit=20):
+    """各接口的平均值（按数据库总耗时排序）、耗时最多的语句和疑似 N+1 的语句"""
+    with _lock:
+        endpoints = [{
+            "endpoint": endpoint,
+            "requests": summary["requests"],
+            "queries_per_request": round(summary["queries"] / summary["requests"], 1),
+            "max_queries": summary["max_queries"],
+            "ms_per_request": round(summary["seconds"] / summary["requests"] * 1000, 1),
+            "db_ms_per_request": round(summary["db_seconds"] / summary["requests"] * 1000, 1),
+            "serialize_ms_per_request": round(summary["serialize_seconds"] / summary["requests"] * 1000, 1),
+            "db_seconds": round(summary["db_seconds"], 3),
+            "slow": summary["slow"]
+        } for endpoint, summary in _endpoints.items()]
+        statements = [{
+            "statement": key,
+            "count": statement["count"],
+            "seconds": round(statement["seconds"], 3),
+            "avg_ms": round(statement["seconds"] / statement["count"] * 1000, 2),
+            "max_ms": round(statement["max_seconds"] * 1000, 2)
+        } for key, statement in _statements.items()]
+        n_plus_one = [{"endpoint": endpoint, "statement": key, **pattern}
+                      for (endpoint, key), pattern in _n_plus_one.items()]
+
+    endpoints.sort(key=lambda item: -item["db_seconds"])
+    statements.sort(key=lambda item: -item["seconds"])
+    n_plus_one.sort(key=lambda item: -item["max_repeats"])
+    return {
+        "sample_rate": GeneralConfig.SQL_STATS_SAMPLE_RATE,
+        "endpoints": endpoints[:limit],
+        "statements": statements[:limit],
+        "n_plus_one": n_plus_one[:limit]
+    }
+
+
+def reset():
+    with _lock:
+        _endpoints.clear()
+        _statements.clear()
+        _n_plus_one.clear()
+
+
+def _log_summary_if_due():
+    global _last_logged_at
+    if GeneralConfig.SQL_STATS_LOG_INTERVAL <= 0:
+        return
+    with _lock:
+        if time.monotonic() - _last_logged_at < GeneralConfig.SQL_STATS_LOG_INTERVAL:
+            return
+        _last_logged_at = time.monotonic()
+
+    summary = snapshot(limit=5)
+    for item in summary["endpoints"]:
+        print("[SQL] {endpoint}：{requests} 次抽样，平均 {queries_per_request} 条 SQL、{ms_per_request}ms，"
+              "其中数据库 {db_ms_per_request}ms、序列化 {serialize_ms_per_request}ms".format(**item), flush=True)
+
+
+def init_app(app, *engines):
+    """在 app 和数据库引擎（主库和只读副本）上注册统计钩子，SQL_STATS_SAMPLE_RATE 为 0 时不注册"""
+    if GeneralConfig.SQL_STATS_SAMPLE_RATE <= 0:
+        return
+    for engine in engines:
+        if engine is not None:
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    app.before_request(_start_request)
+    app.teardown_request(_finish_request)
+    app.json = TimedJSONProvider(app)
+    if not hasattr(SerializerMixin.to_dict, "__wrapped__"):
+        SerializerMixin.to_dict = _timed_serialization(SerializerMixin.to_dict)
@@ -0,0 +1,290 @@
+import datetime
+import json
+import traceback
+
+import bcrypt
+
+import events
+from bulk import purge
+from config import GeneralConfig
+from database import db_session
+from models import Job, MatchingScore, QuestionnaireAnswer, CustomQuestionnaireAnswer, \
+    CustomQuestionnaireItem, TeamInvitation, TeamRequest, Team, ExchangingCandidate, ExchangingNeed, \
+    ExchangingRequest, Student, AllocationPlan, set_system_setting
+from questionnaire import normalize_item, diff_items, current_items, invalidated_item_ids, invalidate_scores, \
+    apply_items
+
+# 后台任务状态
+JOB_QUEUED = 0
+JOB_RUNNING = 1
+JOB_FINISHED = 2
+JOB_FAILED = -1
+JOB_CANCELLED = -2
+
+handlers = {}
+# 任务取消（排队中直接取消，或运行中响应取消请求）时的清理函数，参数为任务参数
+cancel_handlers = {}
+
+# 这些任务结束后（包括中途失败或取消）需要重新计算匹配分
+MATCHING_JOB_EVENTS = {
+    "questionnaire_set": events.EVENT_QUESTIONNAIRE,
+    "system_reset": events.EVENT_STUDENTS,
+    "student_import": events.EVENT_STUDENTS,
+    "student_delete": events.EVENT_STUDENTS
+}
+
+
+def job_handler(job_type):
+    def wrapper(fn):
+        handlers[job_type] = fn
+        return fn
+
+    return wrapper
+
+
+def job_cancel_handler(job_type):
+    def wrapper(fn):
+        cancel_handlers[job_type] = fn
+        return fn
+
+    return wrapper
+
+
+def on_cancelled(job):
+    if job.type in cancel_handlers:
+        cancel_handlers[job.type](json.loads(job.params) if job.params else {})
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    """
+    传给任务处理函数的上下文
+    处理函数每做完一批数据修改就调用 report，进度、断点和这批修改在同一个事务里提交，
+    worker 重启后会从最后一次提交的断点继续执行
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.params = json.loads(job.params) if job.params else {}
+        self.checkpoint = json.loads(job.checkpoint) if job.checkpoint else {}
+
+    def report(self, progress=None, message=None, **checkpoint):
+        self.checkpoint.update(checkpoint)
+        self.job.checkpoint = json.dumps(self.checkpoint)
+        if progress is not None:
+            self.job.progress = round(min(max(progress, 0), 1), 4)
+        if message is not None:
+            self.job.progress_message = message
+        self.job.updated_at = datetime.datetime.now()
+        db_session.commit()
+
+        cancel_requested = db_session.query(Job.cancel_requested).filter(Job.id == self.job.id).scalar()
+        if cancel_requested:
+            raise JobCancelled()
+
+
+def enqueue(job_type, params=None, created_by=None):
+    job = Job(type=job_type, params=json.dumps(params or {}), status=JOB_QUEUED, created_by=created_by)
+    db_session.add(job)
+    events.publish(events.EVENT_JOB)
+    db_session.commit()
+    return job
+
+
+def cancel(job):
+    if job.status == JOB_QUEUED:
+        job.status = JOB_CANCELLED
+        job.finished_at = datetime.datetime.now()
+        on_cancelled(job)
+    elif job.status == JOB_RUNNING:
+        job.cancel_requested = 1
+    job.updated_at = datetime.datetime.now()
+    db_session.commit()
+
+
+def run_job(job):
+    job.status = JOB_RUNNING
+    job.started_at = job.started_at or datetime.datetime.now()
+    db_session.commit()
+
+    context = JobContext(job)
+    try:
+        result = handlers[job.type](context)
+        job.status = JOB_FINISHED
+        job.progress = 1
+        job.result = json.dumps(result) if result is not None else None
+    except JobCancelled:
+        db_session.rollback()
+        job.status = JOB_CANCELLED
+        on_cancelled(job)
+    except Exception as e:
+        db_session.rollback()
+        job.status = JOB_FAILED
+        job.error = "{}\n{}".format(e, traceback.format_exc())
+
+    # 参数里可能有明文密码等敏感信息，任务结束后就不再保留
+    job.params = None
+    job.finished_at = datetime.datetime.now()
+    job.updated_at = job.finished_at
+    if job.type in MATCHING_JOB_EVENTS:
+        events.publish(MATCHING_JOB_EVENTS[job.type])
+    db_session.commit()
+
+
+def run_pending_jobs():
+    while True:
+        job = db_session.query(Job) \
+            .filter(Job.status == JOB_QUEUED) \
+            .order_by(Job.id.asc()) \
+            .first()
+        if job is None:
+            return
+        run_job(job)
+
+
+def recover_jobs():
+    """worker 启动时把上次异常退出时仍在运行的任务放回队列，之后会从断点继续"""
+    db_session.query(Job).filter(Job.status == JOB_RUNNING).update({Job.status: JOB_QUEUED})
+    db_session.commit()
+
+
+def purge_stages(context, stages, progress_base=0.0, progress_span=1.0):
+    """依次清空多张表，当前进行到第几张表记录在断点里"""
+    stage = context.checkpoint.get("stage", 0)
+    while stage < len(stages):
+        model = stages[stage]
+        start = progress_base + progress_span * stage / len(stages)
+
+        def on_progress(fraction, deleted):
+            context.report(progress=start + progress_span * fraction / len(stages),
+                           message="正在删除 {}，已删除 {} 行".format(model.__tablename__, deleted))
+
+        purge(model, on_progress=on_progress)
+        stage += 1
+        context.report(stage=stage)
+
+
+@job_handler("questionnaire_set")
+def questionnaire_set(context):
+    # 只作废受修改影响的答案和匹配分，未修改的题目保留答案、文本向量和匹配分
+    incoming = [normalize_item(piece) for piece in context.params["items"]]
+    changes = diff_items(current_items(), incoming)
+
+    if context.checkpoint.get("stage", 0) == 0:
+        invalidate_scores(invalidated_item_ids(changes),
+                          on_progress=lambda fraction, deleted: context.report(
+                              progress=0.8 * fraction, message="正在删除受影响的匹配分，已删除 {} 行".format(deleted)))
+        context.report(progress=0.8, stage=1)
+
+    revision = apply_items(incoming, changes, context.job.created_by)
+    context.report(progress=1, message="问卷已更新")
+
+    return {"revision_id": revision.id, "changes": changes}
+
+
+@job_handler("system_reset")
+def system_reset(context):
+    # 按外键依赖顺序删除
+    purge_stages(context, [MatchingScore, CustomQuestionnaireAnswer, CustomQuestionnaireItem, QuestionnaireAnswer,
+                           TeamInvitation, TeamRequest, Team, ExchangingCandidate, ExchangingNeed,
+                           ExchangingRequest, Student])
+
+    set_system_setting("exchanging_scanned_need_id", "0")
+    set_system_setting("exchanging_pending_need_ids", "[]")
+
+
+@job_handler("student_import")
+def student_import(context):
+    students = context.params["students"]
+    offset = context.checkpoint.get("offset", 0)
+    failed = context.checkpoint.get("failed", [])
+
+    while offset < len(students):
+        chunk = students[offset:offset + GeneralConfig.JOB_IMPORT_CHUNK_SIZE]
+
+        parsed = []
+        for student in chunk:
+            # 导入时要把学生姓名里的空格替换为#
+            space_count = student.split()
+            if len(space_count) != 5:
+                failed.append(student)
+                continue
+            id, name, gender, category, password = space_count
+            parsed.append((student, int(id), name, gender, category, password))
+
+        # 查重
+        existed_ids = set(row[0] for row in db_session.query(Student.id)
+                          .filter(Student.id.in_([item[1] for item in parsed])).all())
+        data_to_store = []
+        for student, id, name, gender, category, password in parsed:
+            if id in existed_ids:
+                failed.append(student)
+                continue
+            existed_ids.add(id)
+
+            name = name.replace("#", " ")
+            password = bcrypt.hashpw(bytes(password, encoding="utf8"), bcrypt.gensalt())
+            data_to_store.append(
+                Student(id=id, name=name, gender=gender, category=category, password=password, last_logged_at=None)
+            )
+
+        db_session.bulk_save_objects(data_to_store)
+        offset += len(chunk)
+        context.report(progress=offset / len(students), message="已处理 {}/{}".format(offset, len(students)),
+                       offset=offset, failed=failed)
+
+    return {"fail_to_import": failed}
+
+
+@job_handler("student_delete")
+def student_delete(context):
+    student_id = context.params["student_id"]
+
+    purge(MatchingScore, MatchingScore.from_student_id == student_id,
+          on_progress=lambda fraction, deleted: context.report(progress=0.4 * fraction, message="正在删除匹配分"))
+    purge(MatchingScore, MatchingScore.to_student_id == student_id,
+          on_progress=lambda fraction, deleted: context.report(progress=0.4 + 0.4 * fraction, message="正在删除匹配分"))
+
+    student = db_session.query(Student).get(student_id)
+    if student is None:
+        return
+
+    db_session.query(TeamInvitation).where(TeamInvitation.from_student_id == student.id).delete()
+    db_session.query(TeamInvitation).where(TeamInvitation.to_student_id == student.id).update({
+        TeamInvitation.to_student_id: 0,
+        TeamInvitation.status: -2,
+        TeamInvitation.reason: "目标用户已被删除"
+    })
+
+    db_session.delete(student)
+    context.report(progress=1, message="学生已删除")
+
+
+@job_handler("allocation")
+def allocation(context):
+    # numpy 只在 worker 里需要
+    from allocation import run_plan_by_id
+
+    run_plan_by_id(context.params["plan_id"])
+
+
+@job_cancel_handler("allocation")
+def allocation_cancelled(params):
+    # 方案随任务一起废弃，否则会一直挡住同一分组创建新方案
+    db_session.query(AllocationPlan) \
+        .filter(AllocationPlan.id == params.get("plan_id"), AllocationPlan.status.in_([0, 1])) \
+        .update({AllocationPlan.status: -2, AllocationPlan.message: "任务已取消",
+                 AllocationPlan.updated_at: datetime.datetime.now()}, synchronize_session=False)
+
+
+def allocation_job(plan_id):
+    """计算该方案的排队中或运行中的任务"""
+    for job in db_session.query(Job) \
+            .filter(Job.type == "allocation", Job.status.in_([JOB_QUEUED, JOB_RUNNING])) \
+            .all():
+        if job.params and json.loads(job.params).get("plan_id") == plan_id:
+            return job
+    return None
@@ -0,0 +1,321 @@
+import ast
+import hashlib
+import json
+import re
+
+import numpy as np
+
+# 逐题的相似度核：先把一道题的答案编码成每人一行定长的数字，再用 NumPy 对一批学生与全体学生批量计算相似度
+# 编码失败（答案格式与题目不符）的行由 valid 判断，匹配任务只为这些答案计算文本向量，它们之间按余弦比较，
+# 与能编码的答案的相似度为 0
+# 文本题（input、textarea 等）没有核，直接按文本向量的余弦计算
+
+KERNELS = {}
+
+# 按控件类型选择核，控件类型不认识时再按 data_type 选择，都不认识的按文本题处理
+WIDGET_KERNELS = {
+    'rate': 'numeric',
+    'number': 'numeric',
+    'slider': 'range',
+    'radio': 'choice',
+    'select': 'choice',
+    'checkbox': 'multi_choice',
+    'time': 'time',
+    'time-range': 'time',
+    'input': None,
+    'textarea': None,
+    'text': None,
+}
+DATA_TYPE_KERNELS = {
+    'integer': 'numeric',
+    'int': 'numeric',
+    'number': 'numeric',
+    'float': 'numeric',
+    'double': 'numeric',
+    'decimal': 'numeric',
+    'time': 'time',
+}
+
+
+def register(cls):
+    KERNELS[cls.name] = cls
+    return cls
+
+
+def parse_numbers(answers):
+    """把一组答案转换成数字，不能转换的为 NaN；通常整组一次转换成功，只有混入了非数字答案时才逐个转换"""
+    answers = [answer if answer is not None else "nan" for answer in answers]
+    try:
+        return np.asarray(answers, dtype=np.float64)
+    except ValueError:
+        pass
+
+    values = np.full(len(answers), np.nan)
+    for index, answer in enumerate(answers):
+        try:
+            values[index] = float(answer)
+        except ValueError:
+            pass
+    return values
+
+
+def parse_list(answer):
+    """多选、范围类的答案以 str(list) 的形式保存，如 "[1, '2']"，解析失败返回 None"""
+    try:
+        value = ast.literal_eval(answer)
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        return None
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def option_key(value):
+    """选项值统一成字符串比较，1、"1"、1.0 视为同一个选项"""
+    try:
+        return repr(float(value))
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def option_values(options):
+    keys = []
+    for option in (options or {}).get('optionItems') or []:
+        key = option_key(option.get('value'))
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+class Kernel:
+    name = None
+    # 每个答案编码成的数字个数
+    width = 1
+    dtype = np.float64
+
+    def __init__(self, options=None):
+        self.options = options or {}
+
+    def signature(self):
+        """编码方式的标识，变化后这道题的缓存需要全部重新计算"""
+        return self.name
+
+    def encode(self, answers):
+        """返回 (m, width) 的编码，答案格式不对（含 None）的行为 NaN"""
+        raise NotImplementedError
+
+    def valid(self, values):
+        """编码成功的行"""
+        return ~np.isnan(values).any(axis=1)
+
+    def similarity(self, left, right):
+        """left 为 (m, width)、right 为 (n, width) 的编码，返回 (m, n) 的相似度，取值 [0, 1]"""
+        raise NotImplementedError
+
+    def pair_similarity(self, left, right):
+        """left、right 都为 (p, width) 的编码，返回逐对的 (p,) 相似度，用于只计算候选学生对的模式"""
+        raise NotImplementedError
+
+    def profile(self, values):
+        """
+        候选学生对模式下找相近学生用的坐标 (m, c)：坐标越近相似度越高，编码失败的行为 NaN
+        返回 None 表示这道题不用来找候选，但仍参与候选对的匹配分计算
+        """
+        return None
+
+
+@register
+class NumericKernel(Kernel):
+    """打分、数字题：1 / (1 + |a - b|)，与原来的数值题算法一致"""
+    name = 'numeric'
+
+    def encode(self, answers):
+        return parse_numbers(answers)[:, None]
+
+    def similarity(self, left, right):
+        return 1 / (1 + np.abs(left[:, 0][:, None] - right[:, 0][None, :]))
+
+    def pair_similarity(self, left, right):
+        return 1 / (1 + np.abs(left[:, 0] - right[:, 0]))
+
+    def profile(self, values):
+        return values
+
+
+@register
+class ChoiceKernel(Kernel):
+    """
+    单选题：答案编码为选项的下标，相似度查 (k, k) 的表
+    选项值都是数字时沿用数值题的 1 / (1 + |a - b|)（问卷里的选项值是按远近设计的），否则只有同一个选项为 1
+    """
+    name = 'choice'
+
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.keys = option_values(self.options)
+        self.codes = {key: code for code, key in enumerate(self.keys)}
+        numbers = parse_numbers(self.keys)
+        table = 1 / (1 + np.abs(numbers[:, None] - numbers[None, :]))
+        self.table = np.where(np.isnan(table), np.eye(len(self.keys)), table)
+
+    def signature(self):
+        return "{}:{}".format(self.name, hashlib.sha1(json.dumps(self.keys).encode("utf8")).hexdigest()[:12])
+
+    def encode(self, answers):
+        return np.asarray([self.codes.get(option_key(answer), np.nan) if answer is not None else np.nan
+                           for answer in answers], dtype=np.float64)[:, None]
+
+    def similarity(self, left, right):
+        left = np.nan_to_num(left[:, 0]).astype(np.int64)
+        right = np.nan_to_num(right[:, 0]).astype(np.int64)
+        return self.table[left[:, None], right[None, :]]
+
+    def pair_similarity(self, left, right):
+        left = np.nan_to_num(left[:, 0]).astype(np.int64)
+        right = np.nan_to_num(right[:, 0]).astype(np.int64)
+        return self.table[left, right]
+
+    def profile(self, values):
+        # 选项值都是数字时按数值，否则按 one-hot，不同选项的距离为 1
+        numbers = parse_numbers(self.keys)
+        codes = np.nan_to_num(values[:, 0]).astype(np.int64)
+        if not np.isnan(numbers).any():
+            return np.where(np.isnan(values[:, 0]), np.nan, numbers[codes])[:, None]
+        one_hot = np.eye(len(self.keys))[codes] / np.sqrt(2)
+        return np.where(np.isnan(values), np.nan, one_hot)
+
+
+@register
+class MultiChoiceKernel(Kernel):
+    """
+    多选题：答案编码为选中选项的位集，每 64 个选项一个 uint64，第 0 列为 1 表示编码成功
+    相似度为两人所选集合的 Jaccard 系数（交集、并集的大小用 popcount 计算），都没选时为 1
+    """
+    name = 'multi_choice'
+    dtype = np.uint64
+
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.keys = option_values(self.options)
+        self.codes = {key: code for code, key in enumerate(self.keys)}
+        self.words = (len(self.keys) + 63) // 64
+        self.width = 1 + self.words
+
+    def signature(self):
+        return "{}:bits:{}".format(self.name, hashlib.sha1(json.dumps(self.keys).encode("utf8")).hexdigest()[:12])
+
+    def encode(self, answers):
+        encoded = np.zeros((len(answers), self.width), dtype=np.uint64)
+        for index, answer in enumerate(answers):
+            values = parse_list(answer) if answer is not None else None
+            codes = [self.codes.get(option_key(value)) for value in values] if values is not None else [None]
+            if None in codes:
+                continue
+            encoded[index, 0] = 1
+            for code in codes:
+                encoded[index, 1 + code // 64] |= np.uint64(1 << (code % 64))
+        return encoded
+
+    def valid(self, values):
+        return values[:, 0] == 1
+
+    def similarity(self, left, right):
+        left_counts = np.bitwise_count(left[:, 1:]).sum(axis=1, dtype=np.int64)
+        right_counts = np.bitwise_count(right[:, 1:]).sum(axis=1, dtype=np.int64)
+        intersection = np.zeros((len(left), len(right)), dtype=np.int64)
+        for word in range(1, self.width):
+            intersection += np.bitwise_count(left[:, word][:, None] & right[:, word][None, :])
+        union = left_counts[:, None] + right_counts[None, :] - intersection
+        return np.where(union > 0, intersection / np.where(union > 0, union, 1), 1.0)
+
+    def pair_similarity(self, left, right):
+        intersection = np.bitwise_count(left[:, 1:] & right[:, 1:]).sum(axis=1, dtype=np.int64)
+        union = np.bitwise_count(left[:, 1:] | right[:, 1:]).sum(axis=1, dtype=np.int64)
+        return np.where(union > 0, intersection / np.where(union > 0, union, 1), 1.0)
+
+    def profile(self, values):
+        # 每个选项一列，选中为 1
+        codes = np.arange(len(self.keys))
+        words = values[:, 1 + codes // 64]
+        selected = (words >> (codes % 64).astype(np.uint64)) & np.uint64(1)
+        return np.where(self.valid(values)[:, None], selected.astype(np.float64), np.nan)
+
+
+@register
+class TimeKernel(Kernel):
+    """时间题：答案编码为一天中的分钟数，距离按环形计算（23:30 与 00:30 相差 1 小时），相似度为 1 / (1 + 相差的小时数)"""
+    name = 'time'
+    pattern = re.compile(r'(\d{1,2}):(\d{2})(?::(\d{2}))?')
+
+    def encode(self, answers):
+        encoded = np.full((len(answers), 1), np.nan)
+        for index, answer in enumerate(answers):
+            match = self.pattern.search(answer) if answer is not None else None
+            if match is not None:
+                encoded[index, 0] = (int(match.group(1)) * 60 + int(match.group(2))) % 1440
+        return encoded
+
+    def similarity(self, left, right):
+        distance = np.abs(left[:, 0][:, None] - right[:, 0][None, :])
+        distance = np.minimum(distance, 1440 - distance)
+        return 1 / (1 + distance / 60)
+
+    def pair_similarity(self, left, right):
+        distance = np.abs(left[:, 0] - right[:, 0])
+        distance = np.minimum(distance, 1440 - distance)
+        return 1 / (1 + distance / 60)
+
+    def profile(self, values):
+        # 放到周长 24（小时）的圆上，午夜前后的时间也相近
+        angle = values[:, 0] / 1440 * 2 * np.pi
+        radius = 24 / (2 * np.pi)
+        return np.stack([np.cos(angle), np.sin(angle)], axis=1) * radius
+
+
+@register
+class RangeKernel(Kernel):
+    """
+    滑块题：答案可能是一个数，也可能是 [下限, 上限] 的范围，统一编码为范围（一个数即上下限相同）
+    相似度为 1 / (1 + (|下限之差| + |上限之差|) / 2)，两个答案都是一个数时与数值题一致
+    """
+    name = 'range'
+    width = 2
+
+    def encode(self, answers):
+        encoded = np.full((len(answers), 2), np.nan)
+        for index, answer in enumerate(answers):
+            values = parse_list(answer) if answer is not None else None
+            if values is None or len(values) not in (1, 2):
+                continue
+            numbers = parse_numbers([str(value) for value in values])
+            encoded[index] = np.sort(numbers) if len(numbers) == 2 else numbers[0]
+        return encoded
+
+    def similarity(self, left, right):
+        distance = np.abs(left[:, None, :] - right[None, :, :]).sum(axis=2) / 2
+        return 1 / (1 + distance)
+
+    def pair_similarity(self, left, right):
+        return 1 / (1 + np.abs(left - right).sum(axis=1) / 2)
+
+    def profile(self, values):
+        return values / 2
+
+
+def kernel_for(widget_type, data_type, options=None):
+    """题目的相似度核，文本题返回 None"""
+    if widget_type in WIDGET_KERNELS:
+        name = WIDGET_KERNELS[widget_type]
+    else:
+        name = DATA_TYPE_KERNELS.get((data_type or "").lower())
+    if name is None:
+        return None
+
+    kernel = KERNELS[name](options)
+    if name == 'choice' and not kernel.keys:
+        # 不知道选项时单选题的答案按数字比较
+        return NumericKernel(options)
+    if name == 'multi_choice' and not kernel.keys:
+        # 不知道选项时无法编码，多选题按文本处理
+        return None
+    return kernel
@@ -0,0 +1,4 @@
+"""
+学生端接口压测：用合成数据准备一个测试库，用 gunicorn.config.py 启动 API，按三个阶段的真实流量回放请求
+用法: python -m loadtest.run --per-gender 1000 --users 50 --duration 60 --step all
+"""
@@ -0,0 +1,120 @@
+"""
+连接池压测：用 gunicorn.config.py（gevent worker）启动 API，每个请求通过 /loadtest/hold 占用一个数据库连接 --hold 秒，
+逐级提高并发的请求数，报告吞吐、延迟、连接池等待时间和超时次数，检查吞吐是否随并发上升，而不是停在连接池大小上
+MySQL 上执行 SELECT SLEEP，SQLite 上先取得连接再 sleep；不需要准备数据
+
+用法: python -m loadtest.pool --concurrency 10,50,100,200 --hold 0.05 --duration 10
+     python -m loadtest.pool --pool-size 10 --pool-timeout 30      # 原来的配置：每个 worker 10 个连接
+
+一个 worker、--hold 0.05 时，吞吐的上限约为 min(并发数, 连接数) / 0.05 次/秒，再受 worker 的 CPU 限制
+一次 SQLite 上的结果（单核机器，一个 worker，--duration 4）：
+  并发              10      50      100
+  连接数 10         180     184     183 次/秒，p99 77 / 2189 / 3945 ms，平均等待连接 0 / 207 / 453 ms
+  连接数 80         179     443     387 次/秒，p99 82 / 205 / 931 ms，平均等待连接 0 / 0 / 15 ms
+这组数字只说明连接数为 10 时请求会在连接池上排队，加大连接池能去掉这部分等待；
+并发 100 时吞吐反而下降，是因为这台机器上唯一的 worker 已经用满 CPU，不能说明吞吐会随并发继续上升
+默认值（DATABASE_MAX_CONNECTIONS=80、GUNICORN_WORKER_CONNECTIONS=1000）还没有在 MySQL 和多核机器上验证过，
+上线前应当用 --database-url 指向 MySQL、--workers 设为实际的 worker 数重新压测，按结果调整
+所有 API 实例的连接合计不应超过 MySQL 的 max_connections
+"""
+import argparse
+import json
+import re
+import tempfile
+import threading
+import time
+import urllib.request
+
+from loadtest.run import Client, Stats, start_server
+
+
+def pool_metrics(base_url):
+    """从 /metrics 读取连接池的等待时间和超时次数（同一台机器上所有 worker 的合计）"""
+    with urllib.request.urlopen(base_url + "/metrics", timeout=10) as response:
+        text = response.read().decode("utf8")
+
+    def value(pattern):
+        match = re.search(pattern, text, re.MULTILINE)
+        return float(match.group(1)) if match else 0.0
+
+    return {
+        "checkout_seconds": value(r'^rmmt_db_pool_checkout_seconds_sum\{database="primary"\} (\S+)$'),
+        "checkouts": value(r'^rmmt_db_pool_checkout_seconds_count\{database="primary"\} (\S+)$'),
+        "timeouts": value(r'^rmmt_db_pool_checkout_timeouts_total\{database="primary"\} (\S+)$'),
+    }
+
+
+def run_level(base_url, concurrency, hold, duration):
+    stats = Stats()
+    deadline = time.monotonic() + duration
+    path = "/loadtest/hold?seconds={}".format(hold)
+    before = pool_metrics(base_url)
+
+    def user():
+        client = Client(base_url, stats)
+        while time.monotonic() < deadline:
+            client.request("GET", path, name="GET /loadtest/hold")
+        client.close()
+
+    started_at = time.monotonic()
+    threads = [threading.Thread(target=user) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = stats.summary(time.monotonic() - started_at)
+    after = pool_metrics(base_url)
+
+    endpoint = summary["endpoints"].get("GET /loadtest/hold", {})
+    checkouts = after["checkouts"] - before["checkouts"]
+    return {
+        "concurrency": concurrency,
+        "requests_per_second": summary["requests_per_second"],
+        "errors": endpoint.get("errors", 0),
+        "p50_ms": endpoint.get("p50_ms"),
+        "p99_ms": endpoint.get("p99_ms"),
+        "pool_wait_ms": round((after["checkout_seconds"] - before["checkout_seconds"]) / checkouts * 1000, 1)
+        if checkouts else None,
+        "pool_timeouts": int(after["timeouts"] - before["timeouts"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="连接池压测")
+    parser.add_argument("--database-url", default=None, help="默认用临时 SQLite 库，MySQL 的结果更接近线上")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn worker 数")
+    parser.add_argument("--concurrency", default="10,50,100,200", help="逐级的并发请求数，逗号分隔")
+    parser.add_argument("--hold", type=float, default=0.05, help="每个请求占用连接的秒数")
+    parser.add_argument("--duration", type=float, default=10, help="每一级的压测秒数")
+    parser.add_argument("--pool-size", type=int, default=0, help="DATABASE_POOL_SIZE，0 表示按配置计算")
+    parser.add_argument("--max-overflow", type=int, default=None, help="DATABASE_MAX_OVERFLOW")
+    parser.add_argument("--pool-timeout", type=float, default=None, help="DATABASE_POOL_TIMEOUT")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-pool-")
+    database_url = args.database_url or "sqlite:///{}/pool.db".format(workdir)
+    env = {
+        "DATABASE_POOL_SIZE": str(args.pool_size),
+        "METRICS_DIR": workdir + "/metrics",
+        "METRICS_FLUSH_SECONDS": "0",
+        "SQL_STATS_SAMPLE_RATE": "0",
+    }
+    if args.max_overflow is not None:
+        env["DATABASE_MAX_OVERFLOW"] = str(args.max_overflow)
+    if args.pool_timeout is not None:
+        env["DATABASE_POOL_TIMEOUT"] = str(args.pool_timeout)
+
+    process, base_url = start_server(database_url, workdir, args.workers, 60, env)
+    try:
+        levels = [run_level(base_url, int(concurrency), args.hold, args.duration)
+                  for concurrency in args.concurrency.split(",")]
+    finally:
+        process.terminate()
+        process.wait()
+
+    print(json.dumps({"workers": args.workers, "hold_seconds": args.hold, "env": env, "levels": levels},
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""
+学生端接口压测：准备数据、用 gunicorn.config.py（gevent worker）启动 API，按阶段回放流量，报告每个接口的
+p50 / p95 / p99 延迟和每个请求执行的 SQL 条数（由 loadtest.wsgi 统计）
+阶段 1：登录、读取系统设置和问卷、提交问卷答案
+阶段 2：登录、读取推荐队友、查看推荐学生的详情
+阶段 3：登录、发出组队邀请并接受；已组队的学生再邀请比空位多一个的同学，被邀请的同学同时接受（抢位）
+用法: python -m loadtest.run --per-gender 1000 --users 50 --duration 60 --step 1,2,3
+     python -m loadtest.run --target http://127.0.0.1:5000 ...   # 压一个已经启动的服务，须先用 loadtest.seed 准备好数据
+SQLite 只能串行写入，并发写入会等待或报 database is locked，要得到接近线上的结果请用 --database-url 指向空的 MySQL 测试库
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from benchmarks.cohort import PASSWORD, questionnaire_widgets, random_answer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Stats:
+    """按接口记录延迟、SQL 条数和业务返回码"""
+
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, status, code, queries):
+        with self._lock:
+            endpoint = self.endpoints.setdefault(name, {"seconds": [], "queries": [], "errors": 0, "rejected": 0})
+            endpoint["seconds"].append(seconds)
+            if queries is not None:
+                endpoint["queries"].append(queries)
+            if status != 200:
+                endpoint["errors"] += 1
+            elif code != 200:
+                # 业务上的拒绝（如队伍已满、邀请已处理），抢位时是预期内的
+                endpoint["rejected"] += 1
+
+    def summary(self, seconds):
+        endpoints = {}
+        total = 0
+        for name, endpoint in sorted(self.endpoints.items()):
+            latencies = np.asarray(endpoint["seconds"]) * 1000
+            total += len(latencies)
+            endpoints[name] = {
+                "requests": len(latencies),
+                "errors": endpoint["errors"],
+                "rejected": endpoint["rejected"],
+                "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+                "p95_ms": round(float(np.percentile(latencies, 95)), 1),
+                "p99_ms": round(float(np.percentile(latencies, 99)), 1),
+                "queries_per_request": round(float(np.mean(endpoint["queries"])), 1) if endpoint["queries"] else None
+            }
+        return {"seconds": round(seconds, 1), "requests": total,
+                "requests_per_second": round(total / seconds, 1) if seconds else None, "endpoints": endpoints}
+
+
+class Client:
+    """一个模拟的学生，保持一个 keep-alive 连接"""
+
+    def __init__(self, base_url, stats):
+        url = urllib.parse.urlparse(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.stats = stats
+        self.token = None
+        self.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+
+    def request(self, method, path, body=None, name=None):
+        headers = {"Content-Type": "application/json"}
+        if self.token is not None:
+            headers["Authorization"] = "Bearer " + self.token
+        name = name or "{} {}".format(method, path)
+
+        response = None
+        for _ in range(2):
+            started_at = time.perf_counter()
+            try:
+                self.connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                                        headers=headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # 空闲的 keep-alive 连接被服务端关闭了，重新连接再发一次
+                self.connection.close()
+                response = None
+            except (http.client.HTTPException, OSError):
+                self.connection.close()
+                response = None
+                break
+        if response is None:
+            self.stats.record(name, time.perf_counter() - started_at, None, None, None)
+            return None
+        seconds = time.perf_counter() - started_at
+
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            payload = None
+        queries = response.getheader("X-Query-Count")
+        self.stats.record(name, seconds, response.status, payload.get("code") if isinstance(payload, dict) else None,
+                          int(queries) if queries is not None else None)
+        return payload
+
+    def login(self, student_id):
+        payload = self.request("POST", "/api/student/login", {"id": student_id, "password": PASSWORD})
+        self.token = payload["data"]["access_token"] if payload and payload.get("code") == 200 else None
+        return self.token is not None
+
+    def close(self):
+        self.connection.close()
+
+
+class Cohort:
+    """合成学生的分布与 benchmarks.cohort.generate 一致：1..n 为男生，n+1..2n 为女生"""
+
+    def __init__(self, per_gender, seed):
+        self.per_gender = per_gender
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._free = {gender: self.rng.sample(self.students(gender), per_gender) for gender in (1, 2)}
+
+    def students(self, gender):
+        return list(range(1, self.per_gender + 1)) if gender == 1 else \
+            list(range(self.per_gender + 1, 2 * self.per_gender + 1))
+
+    def random_student(self, rng):
+        return rng.randint(1, 2 * self.per_gender)
+
+    def take_group(self, size, rng):
+        """取出一组还没组队的同性别学生，用完时返回 None"""
+        with self._lock:
+            gender = rng.choice([1, 2])
+            free = self._free[gender] if len(self._free[gender]) >= size else self._free[3 - gender]
+            if len(free) < size:
+                return None
+            group, free[:] = free[:size], free[size:]
+            return group
+
+
+def step_1(base_url, stats, cohort, widgets, rng):
+    client = Client(base_url, stats)
+    if client.login(cohort.random_student(rng)):
+        client.request("GET", "/api/student/system_setting")
+        client.request("GET", "/api/student/questionnaire/list")
+        client.request("GET", "/api/student/questionnaire/answer")
+        answers = {options['name']: {"answer": random_answer(widget_type, options, rng), "weight": rng.choice([1, 2, 3])}
+                   for widget_type, options in widgets}
+        client.request("POST", "/api/student/questionnaire/answer", answers)
+    client.close()
+
+
+def step_2(base_url, stats, cohort, widgets, rng):
+    client = Client(base_url, stats)
+    if client.login(cohort.random_student(rng)):
+        client.request("GET", "/api/student/system_setting")
+        payload = client.request("GET", "/api/student/team/recommend_teammates")
+        recommended = payload["data"]["students_with_score"] if payload and payload.get("code") == 200 else []
+        for student in recommended[:3]:
+            client.request("GET", "/api/student/student/{}".format(student["id"]), name="GET /api/student/student/<id>")
+    client.close()
+
+
+def step_3(base_url, stats, cohort, widgets, rng, team_max_student_count):
+    # 队长和第一个同学组成队伍，再邀请比空位多一个的同学，让他们同时接受
+    group = cohort.take_group(team_max_student_count + 1, rng)
+    if group is None:
+        return False
+    leader, first, racers = group[0], group[1], group[2:]
+
+    clients = {student_id: Client(base_url, stats) for student_id in group}
+    try:
+        if not all(clients[student_id].login(student_id) for student_id in group):
+            return True
+        payload = clients[leader].request("POST", "/api/student/team/invite", {"target_student_id": first})
+        if not payload or payload.get("code") != 200:
+            return True
+        clients[first].request("GET", "/api/student/team/invitations")
+        clients[first].request("POST", "/api/student/team/invitation/process",
+                               {"team_invitation_id": payload["data"]["team_invitation_id"], "accept": True})
+
+        invitations = {}
+        for student_id in racers:
+            payload = clients[leader].request("POST", "/api/student/team/invite", {"target_student_id": student_id})
+            if payload and payload.get("code") == 200:
+                invitations[student_id] = payload["data"]["team_invitation_id"]
+
+        barrier = threading.Barrier(len(invitations)) if invitations else None
+
+        def accept(student_id):
+            barrier.wait()
+            clients[student_id].request("POST", "/api/student/team/invitation/process",
+                                        {"team_invitation_id": invitations[student_id], "accept": True},
+                                        name="POST /api/student/team/invitation/process (race)")
+
+        threads = [threading.Thread(target=accept, args=(student_id,)) for student_id in invitations]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        clients[leader].request("GET", "/api/student/team/detail")
+    finally:
+        for client in clients.values():
+            client.close()
+    return True
+
+
+def run_phase(step, args, base_url, cohort, widgets):
+    stats = Stats()
+    deadline = time.monotonic() + args.duration
+
+    def user(index):
+        rng = random.Random(args.seed * 1000 + step * 100 + index)
+        while time.monotonic() < deadline:
+            if step == 1:
+                step_1(base_url, stats, cohort, widgets, rng)
+            elif step == 2:
+                step_2(base_url, stats, cohort, widgets, rng)
+            elif not step_3(base_url, stats, cohort, widgets, rng, args.team_max_student_count):
+                # 没有未组队的学生了
+                return
+
+    started_at = time.monotonic()
+    threads = [threading.Thread(target=user, args=(index,)) for index in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = stats.summary(time.monotonic() - started_at)
+    result["step"] = step
+    return result
+
+
+def overfilled_teams(team_max_student_count):
+    """抢位后人数超过上限的队伍数，应为 0"""
+    from sqlalchemy import func
+
+    from database import db_session
+    from models import Student
+
+    db_session.remove()
+    return db_session.query(Student.team_id).filter(Student.team_id.isnot(None)).group_by(Student.team_id) \
+        .having(func.count(Student.id) > team_max_student_count).count()
+
+
+def start_server(database_url, workdir, workers, timeout, env=None):
+    """用 gunicorn.config.py 启动 loadtest.wsgi:app，等待 /ready 返回 200；env 为额外的环境变量（如连接池参数）"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    env = dict(os.environ, DATABASE_URL=database_url, DATABASE_LOG="false",
+               SCORE_MATRIX_PATH=os.path.join(workdir, "scores"), **(env or {}))
+    command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.config.py", "--bind", "127.0.0.1:{}".format(port),
+               "--access-logfile", "/dev/null", "--error-logfile", os.path.join(workdir, "error.log")]
+    if workers:
+        # 连接池按 GUNICORN_WORKERS 分配连接预算，两处保持一致
+        env["GUNICORN_WORKERS"] = str(workers)
+        command += ["--workers", str(workers)]
+    process = subprocess.Popen(command + ["loadtest.wsgi:app"], cwd=ROOT, env=env)
+
+    base_url = "http://127.0.0.1:{}".format(port)
+    started_at = time.monotonic()
+    while time.monotonic() - started_at < timeout:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/ready")
+            if connection.getresponse().status == 200:
+                return process, base_url
+        except (http.client.HTTPException, OSError):
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("{} 秒内 /ready 没有返回 200，见 {}".format(timeout, os.path.join(workdir, "error.log")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="学生端接口压测")
+    parser.add_argument("--per-gender", type=int, default=1000, help="每个性别的合成学生数")
+    parser.add_argument("--database-url", default=None, help="默认用临时 SQLite 库；MySQL 须为空的测试库")
+    parser.add_argument("--target", default=None, help="压一个已经启动的服务，不再准备数据和启动 gunicorn")
+    parser.add_argument("--workers", type=int, default=0, help="覆盖 gunicorn.config.py 的 workers")
+    parser.add_argument("--users", type=int, default=50, help="并发的模拟学生数")
+    parser.add_argument("--duration", type=float, default=60, help="每个阶段的压测秒数")
+    parser.add_argument("--step", default="1,2,3", help="回放的阶段，逗号分隔，按顺序执行")
+    parser.add_argument("--team-max-student-count", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    process = None
+    base_url = args.target
+    if base_url is None:
+        from config import GeneralConfig
+
+        from loadtest.seed import seed
+
+        GeneralConfig.MATCHING_STORE_PATH = os.path.join(workdir, "matching")
+        GeneralConfig.SCORE_MATRIX_PATH = os.path.join(workdir, "scores")
+        database_url = args.database_url or "sqlite:///" + os.path.join(workdir, "loadtest.db")
+        seed(database_url, args.per_gender, seed=args.seed)
+        process, base_url = start_server(database_url, workdir, args.workers, 60)
+
+    try:
+        _, widgets = questionnaire_widgets()
+        cohort = Cohort(args.per_gender, args.seed)
+        phases = [run_phase(int(step), args, base_url, cohort, widgets) for step in args.step.split(",")]
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = {"base_url": base_url, "users": args.users, "phases": phases}
+    if args.target is None and "3" in args.step.split(","):
+        report["overfilled_teams"] = overfilled_teams(args.team_max_student_count)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+压测数据：合成学生和答案（见 benchmarks/cohort.py），打开三个阶段的时间窗口，并计算一遍匹配分
+用法: python -m loadtest.seed --database-url sqlite:///loadtest.db --per-gender 1000
+"""
+import argparse
+import datetime
+import json
+
+from benchmarks.cohort import HashEncoder, generate, use_database
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def open_steps(team_max_student_count=4):
+    """三个阶段的时间窗口都设为从昨天到明天"""
+    from models import set_system_setting
+
+    now = datetime.datetime.now()
+    for step in (1, 2, 3):
+        set_system_setting("step_{}_start_at".format(step), (now - datetime.timedelta(days=1)).strftime(TIME_FORMAT))
+        set_system_setting("step_{}_end_at".format(step), (now + datetime.timedelta(days=1)).strftime(TIME_FORMAT))
+    set_system_setting("team_max_student_count", str(team_max_student_count))
+    set_system_setting("tips", "压测数据")
+
+
+def seed(database_url, per_gender, scores=True, seed=0):
+    use_database(database_url)
+    result = generate(per_gender, seed=seed)
+    open_steps()
+
+    if scores:
+        # 用 HashEncoder 代替模型算一遍匹配分，推荐接口读到的是已发布的匹配分矩阵
+        import encoders
+        import matching
+        from progress import ScanProgress
+
+        encoders._encoder = HashEncoder()
+        result["scored_students"] = matching.refresh_all(ScanProgress(persist=False, level="error"))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="准备压测数据")
+    parser.add_argument("--database-url", required=True, help="空的测试库，例如 sqlite:///loadtest.db")
+    parser.add_argument("--per-gender", type=int, default=1000)
+    parser.add_argument("--no-scores", action="store_true", help="不计算匹配分")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(seed(args.database_url, args.per_gender, not args.no_scores, args.seed), ensure_ascii=False,
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
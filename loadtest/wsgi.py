@@ -0,0 +1,44 @@
+"""
+压测用的入口：在 app 外面统计每个请求执行的 SQL 条数，通过 X-Query-Count 响应头返回给压测客户端
+另有 /loadtest/hold 模拟占用数据库连接的慢查询，供 loadtest.pool 使用
+"""
+import time
+
+from flask import g, has_request_context, jsonify, request
+from sqlalchemy import event, text
+
+from app import app
+from database import db_session, engine, replica_engine
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+
+
+for counted_engine in (engine, replica_engine):
+    if counted_engine is not None:
+        event.listen(counted_engine, "after_cursor_execute", count_query)
+
+
+@app.after_request
+def add_query_count(response):
+    response.headers["X-Query-Count"] = str(g.get("query_count", 0))
+    return response
+
+
+@app.get("/loadtest/hold")
+def hold():
+    """占用一个数据库连接 seconds 秒"""
+    seconds = request.args.get("seconds", 0.05, type=float)
+    if engine.dialect.name == "mysql":
+        db_session.execute(text("SELECT SLEEP(:seconds)"), {"seconds": seconds})
+    else:
+        # SQLite 的查询在 C 代码里执行，不会让出协程；先取得连接，再用 sleep（打过补丁后只让出当前协程）占用它
+        db_session.execute(text("SELECT 1"))
+        time.sleep(seconds)
+    db_session.commit()
+    return jsonify({
+        "code": 200,
+        "msg": "success"
+    })
@@ -0,0 +1,911 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+from sqlalchemy import func, insert, or_, select
+
+from ann import IVFIndex
+from bulk import purge
+from config import GeneralConfig
+from database import db_session
+from encoders import get_encoder
+from kernels import kernel_for
+from metrics import EMBEDDING_CACHE, MATCHING_PAIRS, MATCHING_ROWS_WRITTEN
+from models import MatchingScore, QuestionnaireAnswer, QuestionnaireItem, QuestionnaireRevision, Student
+from partitions import category_filter, partition_key, partitions
+from progress import ScanProgress
+from questionnaire import item_options, widget_options
+from score_matrix import block_path
+from snapshot import load_snapshot
+
+# 计算相似度和匹配分时每次处理的行数，限制 (rows, n) 临时矩阵的内存占用
+ROW_BLOCK = 512
+# 每个事务写入的匹配分行数
+INSERT_CHUNK = 10000
+# 删除匹配分时每条 SQL 里 IN 的学生数
+DELETE_CHUNK = 500
+# 计算答案摘要用的 64 位 FNV 质数
+PRIME = 1099511628211
+
+# 匹配分的计算方式与原来逐对计算的 get_score 一致：
+#   score(from, to) = Σ sim_i · w_i / Σ w_i × 100
+# 只统计双方都回答了的题目，w_i 为 to_student 自己设置的权重，权重 <= 0 的题目不参与计算
+# sim_i 只由两个人的答案决定，按题目缓存在磁盘上，权重变化时只需要重新加权汇总
+# 学生很多的分块可以打开 MATCHING_ANN，只为每位学生的近邻（候选学生对）计算和保存匹配分，见 refresh_candidates
+
+
+def item_kernels():
+    """每道题的相似度核，文本题为 None"""
+    widgets = widget_options()
+    return {item.id: kernel_for(item.type, item.data_type, item_options(item, widgets))
+            for item in db_session.query(QuestionnaireItem).all()}
+
+
+def answer_hash(answer):
+    # 0 表示未回答或尚未计算
+    value = int.from_bytes(hashlib.blake2b(answer.encode("utf8"), digest_size=8).digest(), "little")
+    return value or 1
+
+
+def answer_hashes(answers):
+    return np.asarray([answer_hash(answer) if answer is not None else 0 for answer in answers], dtype=np.uint64)
+
+
+class SimilarityStore:
+    """
+    一个分块的逐题相似度缓存，每道题一组 .npy 文件，通过 memmap 读写：
+    <name>.sim.npy     (n, n) 两两相似度，未回答的行列为 0
+    <name>.hash.npy    (n,)   计算相似度时的答案哈希，与当前答案不同的行需要重新计算
+    <name>.weight.npy  (n,)   写入匹配分时的答案权重，与当前权重不同的学生需要重写匹配分
+    <name>.value.npy   (n, k) 相似度核对答案的编码（见 kernels.py）
+    <name>.vector.npy  (n, d) 文本题答案的向量
+    行的顺序与 ids.npy 中的学生 id 一致
+    """
+
+    def __init__(self, key, root=None):
+        self.path = os.path.join(root or GeneralConfig.MATCHING_STORE_PATH, key)
+        self.dtype = np.dtype(GeneralConfig.MATCHING_SIMILARITY_DTYPE)
+        os.makedirs(self.path, exist_ok=True)
+
+        ids_path = os.path.join(self.path, "ids.npy")
+        self.created = not os.path.exists(ids_path)
+        self.ids = np.load(ids_path) if not self.created else np.zeros(0, dtype=np.int64)
+
+        meta_path = os.path.join(self.path, "meta.json")
+        self.meta = {"items": {}, "signature": None, "checked_at": 0}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta.update(json.load(f))
+
+        # 中途异常退出可能留下尺寸不对的文件，这些题目当作没有缓存
+        for item_id in list(self.meta["items"].keys()):
+            if not self._is_consistent(item_id):
+                del self.meta["items"][item_id]
+
+    def clear(self):
+        """删除所有题目的缓存，之后所有学生都会重新计算相似度并重写匹配分"""
+        for item_id in self.item_ids():
+            self.remove_item(item_id)
+        self.meta["signature"] = None
+        self.save_meta()
+
+    def _file(self, item_id, kind):
+        name = hashlib.sha1(item_id.encode("utf8")).hexdigest()[:16]
+        return os.path.join(self.path, "{}.{}.npy".format(name, kind))
+
+    def _is_consistent(self, item_id):
+        n = len(self.ids)
+        try:
+            for kind, shape in (("sim", (n, n)), ("hash", (n,)), ("weight", (n,)), ("value", (n,))):
+                if np.load(self._file(item_id, kind), mmap_mode="r").shape[:len(shape)] != shape:
+                    return False
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def _save(self, path, array):
+        # 先写临时文件再替换，读者不会看到写了一半的文件
+        temp_path = path + ".tmp.npy"
+        np.save(temp_path, array)
+        os.replace(temp_path, path)
+
+    def save_meta(self):
+        temp_path = os.path.join(self.path, "meta.json.tmp")
+        with open(temp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(temp_path, os.path.join(self.path, "meta.json"))
+
+    def item_ids(self):
+        return list(self.meta["items"].keys())
+
+    def array(self, item_id, kind, mode="r+"):
+        path = self._file(item_id, kind)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode=mode)
+
+    def add_item(self, item_id, kernel):
+        n = len(self.ids)
+        self._save(self._file(item_id, "sim"), np.zeros((n, n), dtype=self.dtype))
+        self._save(self._file(item_id, "hash"), np.zeros(n, dtype=np.uint64))
+        self._save(self._file(item_id, "weight"), np.full(n, np.nan))
+        self._save(self._file(item_id, "value"), kernel.encode([None] * n) if kernel else np.full((n, 1), np.nan))
+        self.meta["items"][item_id] = {"vectors": False, "kernel": kernel.signature() if kernel else "text"}
+
+    def remove_item(self, item_id):
+        for kind in ("sim", "hash", "weight", "value", "vector"):
+            path = self._file(item_id, kind)
+            if os.path.exists(path):
+                os.remove(path)
+        del self.meta["items"][item_id]
+
+    def save_vectors(self, item_id, vectors):
+        self._save(self._file(item_id, "vector"), vectors)
+        self.meta["items"][item_id]["vectors"] = True
+
+    def resize(self, ids):
+        """按新的学生列表重排所有文件，保留仍在分块里的学生的数据，新学生的行全部标记为需要计算"""
+        ids = np.asarray(ids, dtype=np.int64)
+        position = np.searchsorted(self.ids, ids)
+        position_clipped = np.minimum(position, max(len(self.ids) - 1, 0))
+        kept = (position < len(self.ids)) & (self.ids[position_clipped] == ids) if len(self.ids) else \
+            np.zeros(len(ids), dtype=bool)
+        new_rows = np.flatnonzero(kept)
+        old_rows = position[kept]
+
+        for item_id in self.item_ids():
+            old_sim = self.array(item_id, "sim", mode="r")
+            sim = np.lib.format.open_memmap(self._file(item_id, "sim") + ".tmp.npy", mode="w+", dtype=self.dtype,
+                                            shape=(len(ids), len(ids)))
+            for start in range(0, len(new_rows), ROW_BLOCK):
+                rows = slice(start, start + ROW_BLOCK)
+                sim[new_rows[rows][:, None], new_rows[None, :]] = old_sim[old_rows[rows]][:, old_rows]
+            sim.flush()
+            del sim, old_sim
+            os.replace(self._file(item_id, "sim") + ".tmp.npy", self._file(item_id, "sim"))
+
+            for kind, fill in (("hash", 0), ("weight", np.nan), ("value", np.nan), ("vector", 0)):
+                old = self.array(item_id, kind, mode="r")
+                if old is None:
+                    continue
+                # 多选题的位集是整数，0 即未编码
+                resized = np.full((len(ids),) + old.shape[1:], fill if old.dtype.kind == "f" else 0, dtype=old.dtype)
+                resized[new_rows] = old[old_rows]
+                del old
+                self._save(self._file(item_id, kind), resized)
+
+        self._save(os.path.join(self.path, "ids.npy"), ids)
+        self.ids = ids
+
+
+def block_signature(gender, categories=None):
+    """分块内答案的概况，没有变化时跳过这个分块"""
+    block = select(Student.id).where(Student.gender == gender)
+    if categories is not None:
+        block = block.where(category_filter(Student.category, categories))
+    count, max_id, max_updated_at, weight_sum = db_session.query(
+        func.count(QuestionnaireAnswer.id), func.max(QuestionnaireAnswer.id),
+        func.max(QuestionnaireAnswer.updated_at), func.sum(QuestionnaireAnswer.weight)) \
+        .filter(QuestionnaireAnswer.student_id.in_(block)) \
+        .one()
+    revision_id = db_session.query(func.max(QuestionnaireRevision.id)).scalar()
+    return json.dumps([count, max_id, str(max_updated_at), str(weight_sum), revision_id])
+
+
+def load_vectors(answer_ids, answers):
+    """读取答案的文本向量，没有向量的答案现场编码并写回数据库"""
+    rows = dict(db_session.query(QuestionnaireAnswer.id, QuestionnaireAnswer.vector)
+                .filter(QuestionnaireAnswer.id.in_(answer_ids.tolist())).all())
+    vectors = [json.loads(rows[answer_id]) if rows.get(answer_id) else None for answer_id in answer_ids.tolist()]
+
+    missing = [index for index, vector in enumerate(vectors) if vector is None]
+    EMBEDDING_CACHE.inc(len(vectors) - len(missing), result="hit")
+    EMBEDDING_CACHE.inc(len(missing), result="miss")
+    if missing:
+        encoded = np.asarray(get_encoder().encode([answers[index] for index in missing]), dtype=np.float32)
+        db_session.bulk_update_mappings(QuestionnaireAnswer, [
+            {"id": int(answer_ids[index]), "vector": json.dumps(vector.tolist())}
+            for index, vector in zip(missing, encoded)
+        ])
+        db_session.commit()
+        for index, vector in zip(missing, encoded):
+            vectors[index] = vector
+
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def update_item(store, item_id, kernel, answer_ids, answers, weights, hashes=None, progress=None):
+    """重新计算答案有变化的学生在这道题上与所有人的相似度，返回这些学生的下标"""
+    answered = answers != None  # noqa: E711
+    if hashes is None:
+        hashes = answer_hashes(answers)
+    stored_hashes = store.array(item_id, "hash")
+    dirty = np.flatnonzero(hashes != stored_hashes)
+    if len(dirty) == 0:
+        return dirty
+
+    # 只编码答案有变化的学生，其余学生的编码直接读缓存
+    values = store.array(item_id, "value")
+    if kernel is not None:
+        values[dirty] = kernel.encode(answers[dirty])
+        values.flush()
+    values = np.asarray(values)
+    encoded = kernel.valid(values) if kernel is not None else np.zeros(len(answers), dtype=bool)
+
+    # 文本题，或答案格式与题目不符、不能编码时，这些答案之间按文本向量的余弦计算，与能编码的答案的相似度为 0
+    # 只有这些学生的答案需要文本向量，其余行在向量缓存里为 0
+    fallback = answered & ~encoded
+    normalized = None
+    if fallback.any():
+        vectors = store.array(item_id, "vector") if store.meta["items"][item_id]["vectors"] else None
+        if vectors is None:
+            stale = np.flatnonzero(fallback)
+        else:
+            missing = ~np.asarray(vectors).any(axis=1)
+            changed = np.zeros(len(answers), dtype=bool)
+            changed[dirty] = True
+            stale = np.flatnonzero(fallback & (changed | missing))
+        if len(stale):
+            fresh = load_vectors(answer_ids[stale], answers[stale])
+            if vectors is None or vectors.shape[1] != fresh.shape[1]:
+                vectors = np.zeros((len(answers), fresh.shape[1]), dtype=np.float32)
+                if len(stale) < np.count_nonzero(fallback):
+                    # 向量维度变了（换了编码模型），旧向量全部作废
+                    stale = np.flatnonzero(fallback)
+                    fresh = load_vectors(answer_ids[stale], answers[stale])
+            else:
+                vectors = np.array(vectors)
+            vectors[stale] = fresh
+            store.save_vectors(item_id, vectors)
+        norms = np.linalg.norm(vectors, axis=1)
+        normalized = vectors / np.where(norms > 0, norms, 1)[:, None]
+    fallback_columns = np.flatnonzero(fallback)
+
+    sim = store.array(item_id, "sim")
+    for start in range(0, len(dirty), ROW_BLOCK):
+        rows = dirty[start:start + ROW_BLOCK]
+        block = np.zeros((len(rows), len(answers)))
+        if kernel is not None:
+            with np.errstate(invalid="ignore"):
+                block = kernel.similarity(values[rows], values)
+            block[~encoded[rows]] = 0
+            block[:, ~encoded] = 0
+        fallback_rows = np.flatnonzero(fallback[rows])
+        if len(fallback_rows) and len(fallback_columns):
+            block[np.ix_(fallback_rows, fallback_columns)] = \
+                normalized[rows[fallback_rows]] @ normalized[fallback_columns].T
+        block[~answered[rows]] = 0
+        block[:, ~answered] = 0
+        sim[rows] = block
+        sim[:, rows] = block.T
+        if progress is not None:
+            progress.advance(len(rows) * len(answers))
+    sim.flush()
+    MATCHING_PAIRS.inc(len(dirty) * len(answers))
+
+    # 相似度已写入，但这些学生的匹配分还没重写，把权重标记为未知，异常退出后下次仍会重写
+    stored_weights = store.array(item_id, "weight")
+    stored_weights[dirty] = np.nan
+    stored_weights.flush()
+    stored_hashes[:] = hashes
+    stored_hashes.flush()
+
+    return dirty
+
+
+def effective_weights(weights):
+    """未回答的题目和权重 <= 0 的题目不计入"""
+    return np.where(np.isnan(weights) | (weights <= 0), 0.0, weights)
+
+
+def aggregate(store, item_weights, rows):
+    """
+    用缓存的相似度重新加权汇总 rows 中每位学生发出和收到的匹配分
+    返回 (outgoing, incoming)：outgoing[r, j] 为 rows[r] → j 的分数，incoming[r, j] 为 j → rows[r] 的分数
+    """
+    n = len(store.ids)
+    outgoing_numerator = np.zeros((len(rows), n))
+    incoming_numerator = np.zeros((len(rows), n))
+    outgoing_denominator = np.zeros((len(rows), n))
+    incoming_denominator = np.zeros((len(rows), n))
+
+    for item_id, weights in item_weights.items():
+        answered = (~np.isnan(weights)).astype(np.float64)
+        weights = effective_weights(weights)
+        block = np.asarray(store.array(item_id, "sim", mode="r")[rows], dtype=np.float64)
+
+        # 分数按接收方（to_student）的权重计算
+        outgoing_numerator += block * answered[rows][:, None] * weights[None, :]
+        outgoing_denominator += answered[rows][:, None] * weights[None, :]
+        incoming_numerator += block * weights[rows][:, None] * answered[None, :]
+        incoming_denominator += weights[rows][:, None] * answered[None, :]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        outgoing = np.where(outgoing_denominator > 0, outgoing_numerator / outgoing_denominator * 100, 0)
+        incoming = np.where(incoming_denominator > 0, incoming_numerator / incoming_denominator * 100, 0)
+    return np.round(outgoing, 2), np.round(incoming, 2)
+
+
+def incomplete_students(ids):
+    """
+    匹配分不完整的学生（答案修改后匹配分会被删除），
+    以及还有发给分块外学生的匹配分的学生（换了类别、调整了类别分组或按旧的分块方式算过），重写时一并删除
+    """
+    counts = dict(db_session.query(MatchingScore.from_student_id, func.count(MatchingScore.id))
+                  .filter(MatchingScore.from_student_id.in_(ids.tolist()))
+                  .group_by(MatchingScore.from_student_id)
+                  .all())
+    outside = set(row[0] for row in db_session.query(MatchingScore.from_student_id)
+                  .filter(MatchingScore.from_student_id.in_(ids.tolist()))
+                  .filter(MatchingScore.to_student_id.notin_(ids.tolist()))
+                  .distinct()
+                  .all())
+    return np.asarray([index for index, student_id in enumerate(ids.tolist())
+                       if counts.get(student_id, 0) < len(ids) - 1 or student_id in outside], dtype=np.int64)
+
+
+def write_scores(store, item_weights, rows, progress=None):
+    """删除并重写 rows 中学生发出和收到的所有匹配分"""
+    ids = store.ids
+    student_ids = ids[rows].tolist()
+    for start in range(0, len(student_ids), DELETE_CHUNK):
+        chunk = student_ids[start:start + DELETE_CHUNK]
+        purge(MatchingScore, or_(MatchingScore.from_student_id.in_(chunk), MatchingScore.to_student_id.in_(chunk)))
+
+    rewritten = np.zeros(len(ids), dtype=bool)
+    rewritten[rows] = True
+    for start in range(0, len(rows), ROW_BLOCK):
+        block_rows = rows[start:start + ROW_BLOCK]
+        outgoing, incoming = aggregate(store, item_weights, block_rows)
+
+        row_index, column_index = np.nonzero(block_rows[:, None] != np.arange(len(ids))[None, :])
+        from_ids = ids[block_rows][row_index]
+        to_ids = ids[column_index]
+        scores = outgoing[row_index, column_index]
+        # 双方都在重写范围内时，这条分数由对方发出的那一行写入
+        incoming_index = ~rewritten[column_index]
+        from_ids = np.concatenate([from_ids, to_ids[incoming_index]])
+        to_ids = np.concatenate([to_ids, ids[block_rows][row_index][incoming_index]])
+        scores = np.concatenate([scores, incoming[row_index, column_index][incoming_index]])
+
+        for chunk in range(0, len(scores), INSERT_CHUNK):
+            part = slice(chunk, chunk + INSERT_CHUNK)
+            db_session.execute(insert(MatchingScore.__table__), [
+                {"from_student_id": from_id, "to_student_id": to_id, "score": score}
+                for from_id, to_id, score in zip(from_ids[part].tolist(), to_ids[part].tolist(),
+                                                 scores[part].tolist())
+            ])
+            db_session.commit()
+            if progress is not None:
+                progress.advance(len(scores[part]))
+        MATCHING_ROWS_WRITTEN.inc(len(scores))
+
+
+def publish_scores(store, item_weights, rows):
+    """
+    把分块的匹配分发布为新版本的 .npy 文件供 API 进程读取（见 score_matrix）
+    上一个版本的学生列表相同时只重新计算 rows 对应的行和列，否则整体重新计算
+    """
+    path = block_path(os.path.basename(store.path))
+    os.makedirs(path, exist_ok=True)
+    current_path = os.path.join(path, "current.json")
+    n = len(store.ids)
+
+    previous = None
+    keep = set()
+    if os.path.exists(current_path):
+        with open(current_path) as f:
+            previous = json.load(f)
+        # 保留上一个版本，正在读取它的进程不受影响；更早的版本删除
+        keep.update((previous["ids"], previous["scores"]))
+        if not np.array_equal(np.load(os.path.join(path, previous["ids"])), store.ids):
+            previous = None
+    if previous is not None and len(rows) == 0:
+        return previous["version"]
+
+    version = int(time.time() * 1000)
+    scores_file = "scores-{}.npy".format(version)
+    ids_file = "ids-{}.npy".format(version)
+    matrix = np.lib.format.open_memmap(os.path.join(path, scores_file + ".tmp"), mode="w+", dtype=np.float32,
+                                       shape=(n, n))
+    if previous is not None:
+        old = np.load(os.path.join(path, previous["scores"]), mmap_mode="r")
+        for start in range(0, n, ROW_BLOCK):
+            matrix[start:start + ROW_BLOCK] = old[start:start + ROW_BLOCK]
+        del old
+    else:
+        rows = np.arange(n)
+
+    for start in range(0, len(rows), ROW_BLOCK):
+        block_rows = rows[start:start + ROW_BLOCK]
+        outgoing, incoming = aggregate(store, item_weights, block_rows)
+        matrix[block_rows] = incoming
+        matrix[:, block_rows] = outgoing.T
+    matrix[np.arange(n), np.arange(n)] = np.nan
+    matrix.flush()
+    del matrix
+
+    os.replace(os.path.join(path, scores_file + ".tmp"), os.path.join(path, scores_file))
+    np.save(os.path.join(path, ids_file), store.ids)
+    with open(current_path + ".tmp", "w") as f:
+        json.dump({"version": version, "ids": ids_file, "scores": scores_file}, f)
+    os.replace(current_path + ".tmp", current_path)
+
+    keep.update((ids_file, scores_file))
+    for name in os.listdir(path):
+        if name.endswith(".npy") and name not in keep:
+            os.remove(os.path.join(path, name))
+
+    return version
+
+
+class CandidateStore:
+    """
+    候选对模式下一个分块的缓存，放在该分块相似度缓存目录的 candidates 子目录里：
+    meta.json          答案概况、候选参数和上次完整检查的时间
+    <name>.vectors.npz 文本向量，按答案 id 排序，附计算向量时的答案哈希
+    pairs.npz          学生 id 与答案摘要（student_digests），上次写入数据库的候选对（学生 id，left < right）与双向匹配分
+    """
+
+    def __init__(self, key, root=None):
+        self.block_path = os.path.join(root or GeneralConfig.MATCHING_STORE_PATH, key)
+        self.path = os.path.join(self.block_path, "candidates")
+        os.makedirs(self.path, exist_ok=True)
+        self.meta = {"signature": None, "settings": None, "checked_at": 0}
+        meta_path = os.path.join(self.path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta.update(json.load(f))
+
+    def remove_dense(self):
+        """切换到候选对模式后，(n, n) 的逐题相似度缓存不再使用"""
+        for name in os.listdir(self.block_path):
+            if name != "candidates":
+                os.remove(os.path.join(self.block_path, name))
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            os.remove(os.path.join(self.path, name))
+        self.meta = {"signature": None, "settings": None, "checked_at": 0}
+
+    def save_meta(self):
+        temp_path = os.path.join(self.path, "meta.json.tmp")
+        with open(temp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(temp_path, os.path.join(self.path, "meta.json"))
+
+    def _save(self, name, **arrays):
+        temp_path = os.path.join(self.path, name + ".tmp.npz")
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, os.path.join(self.path, name + ".npz"))
+
+    def _load(self, name):
+        path = os.path.join(self.path, name + ".npz")
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+
+    def vectors(self, item_id, answer_ids, answers):
+        """答案的文本向量：答案没变的直接读缓存，其余用 load_vectors 读取或编码"""
+        name = hashlib.sha1(item_id.encode("utf8")).hexdigest()[:16] + ".vectors"
+        hashes = answer_hashes(answers)
+        cached = self._load(name)
+        vectors = None
+        stale = np.arange(len(answer_ids))
+        if cached is not None and len(cached["ids"]):
+            position = np.minimum(np.searchsorted(cached["ids"], answer_ids), len(cached["ids"]) - 1)
+            hit = (cached["ids"][position] == answer_ids) & (cached["hashes"][position] == hashes)
+            vectors = np.zeros((len(answer_ids), cached["vectors"].shape[1]), dtype=np.float32)
+            vectors[hit] = cached["vectors"][position[hit]]
+            stale = np.flatnonzero(~hit)
+        if len(stale):
+            fresh = load_vectors(answer_ids[stale], answers[stale])
+            if vectors is None or vectors.shape[1] != fresh.shape[1]:
+                vectors = np.zeros((len(answer_ids), fresh.shape[1]), dtype=np.float32)
+                if len(stale) < len(answer_ids):
+                    # 向量维度变了（换了编码模型），旧向量全部作废
+                    stale = np.arange(len(answer_ids))
+                    fresh = load_vectors(answer_ids[stale], answers[stale])
+            vectors[stale] = fresh
+            order = np.argsort(answer_ids)
+            self._save(name, ids=answer_ids[order], hashes=hashes[order], vectors=vectors[order])
+        return vectors
+
+    def pairs(self):
+        return self._load("pairs")
+
+    def save_pairs(self, ids, digests, left, right, outgoing, incoming):
+        self._save("pairs", ids=ids, digests=digests, left=left, right=right, outgoing=outgoing, incoming=incoming)
+
+
+class PairItem:
+    """候选对模式下一道题的答案编码，各数组按分块的学生顺序排列"""
+
+    def __init__(self, kernel, values, answered, weights, normalized):
+        self.kernel = kernel
+        self.values = values
+        self.answered = answered
+        self.weights = weights
+        self.encoded = kernel.valid(values) if kernel is not None else np.zeros(len(answered), dtype=bool)
+        # 文本题和不能编码的答案按文本向量的余弦比较，与能编码的答案的相似度为 0（与 update_item 一致）
+        self.fallback = answered & ~self.encoded
+        self.normalized = normalized
+
+    def similarity(self, left, right):
+        """学生对 (left[p], right[p]) 在这道题上的相似度"""
+        result = np.zeros(len(left))
+        if self.kernel is not None:
+            both = np.flatnonzero(self.encoded[left] & self.encoded[right])
+            with np.errstate(invalid="ignore"):
+                result[both] = self.kernel.pair_similarity(self.values[left[both]], self.values[right[both]])
+        both = np.flatnonzero(self.fallback[left] & self.fallback[right])
+        if len(both):
+            result[both] = (self.normalized[left[both]] * self.normalized[right[both]]).sum(axis=1)
+        result[~(self.answered[left] & self.answered[right])] = 0
+        return result
+
+
+def pair_items(store, kernels, answers):
+    """把快照里每道题的答案编码成 PairItem，只为需要按余弦比较的答案读取文本向量"""
+    items = {}
+    for item_id, (answer_ids, item_answers, weights) in answers.items():
+        kernel = kernels.get(item_id)
+        answered = item_answers != None  # noqa: E711
+        values = kernel.encode(item_answers) if kernel is not None else None
+        item = PairItem(kernel, values, answered, weights, None)
+        rows = np.flatnonzero(item.fallback)
+        if len(rows):
+            vectors = store.vectors(item_id, answer_ids[rows], item_answers[rows])
+            norms = np.linalg.norm(vectors, axis=1)
+            item.normalized = np.zeros((len(item_answers), vectors.shape[1]), dtype=np.float32)
+            item.normalized[rows] = vectors / np.where(norms > 0, norms, 1)[:, None]
+        items[item_id] = item
+    return items
+
+
+def aggregate_pairs(items, left, right):
+    """学生对 (left[p], right[p]) 的双向匹配分，算法与 aggregate 相同；返回 (left → right, right → left)"""
+    outgoing_numerator = np.zeros(len(left))
+    incoming_numerator = np.zeros(len(left))
+    outgoing_denominator = np.zeros(len(left))
+    incoming_denominator = np.zeros(len(left))
+
+    dtype = np.dtype(GeneralConfig.MATCHING_SIMILARITY_DTYPE)
+    for item in items.values():
+        answered = (~np.isnan(item.weights)).astype(np.float64)
+        weights = effective_weights(item.weights)
+        # 按相似度缓存的精度取整，与完整模式算出的匹配分一致
+        sim = item.similarity(left, right).astype(dtype).astype(np.float64)
+
+        # 分数按接收方（to_student）的权重计算
+        outgoing_numerator += sim * answered[left] * weights[right]
+        outgoing_denominator += answered[left] * weights[right]
+        incoming_numerator += sim * weights[left] * answered[right]
+        incoming_denominator += weights[left] * answered[right]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        outgoing = np.where(outgoing_denominator > 0, outgoing_numerator / outgoing_denominator * 100, 0)
+        incoming = np.where(incoming_denominator > 0, incoming_numerator / incoming_denominator * 100, 0)
+    return np.round(outgoing, 2), np.round(incoming, 2)
+
+
+def candidate_settings():
+    """候选参数，变化后整个分块重新挑选候选对"""
+    return [GeneralConfig.MATCHING_ANN_TEXT_NEIGHBOURS, GeneralConfig.MATCHING_ANN_NUMERIC_NEIGHBOURS,
+            GeneralConfig.MATCHING_ANN_PROBES, GeneralConfig.MATCHING_ANN_LISTS]
+
+
+def numeric_profile(items):
+    """
+    所有能给出坐标的题目（数值、时间、滑块、单选、多选，见 Kernel.profile）拼成每位学生的一个坐标
+    未回答或不能编码的用该列的均值代替；每列除以标准差（不小于 1），各题对距离的影响相近
+    """
+    columns = []
+    for item in items.values():
+        if item.kernel is None:
+            continue
+        with np.errstate(invalid="ignore"):
+            profile = item.kernel.profile(item.values)
+        if profile is None:
+            continue
+        profile = np.where(item.encoded[:, None], profile, np.nan)
+        for column in profile.T:
+            known = ~np.isnan(column)
+            if not known.any():
+                continue
+            column = np.where(known, column, column[known].mean())
+            columns.append(column / max(float(column.std()), 1.0))
+    return np.stack(columns, axis=1) if columns else None
+
+
+def student_digests(answers, kernels):
+    """每位学生全部答案、权重和题目编码方式的摘要，摘要没变的学生匹配分不变"""
+    digests = None
+    for item_id in sorted(answers):
+        _, item_answers, weights = answers[item_id]
+        kernel = kernels.get(item_id)
+        salt = np.uint64(answer_hash(item_id + (kernel.signature() if kernel else "text")))
+        values = (answer_hashes(item_answers) * np.uint64(PRIME)) ^ weights.view(np.uint64) ^ salt
+        values[item_answers == None] = 0  # noqa: E711
+        digests = values if digests is None else digests * np.uint64(PRIME) + values
+    return digests
+
+
+def neighbour_codes(rows, queries, neighbours, n):
+    """近邻 (m, k) 转成无序学生对的编码 lo * n + hi；下标都是 rows 里的位置，rows 为对应的分块下标"""
+    left = np.repeat(rows[queries], neighbours.shape[1])
+    right = neighbours.ravel()
+    found = right >= 0
+    left, right = left[found], rows[right[found]]
+    return np.minimum(left, right) * n + np.maximum(left, right)
+
+
+def candidate_pairs(items, n, queries=None):
+    """
+    候选学生对：每道文本题在回答了的学生里各取余弦最高的 MATCHING_ANN_TEXT_NEIGHBOURS 个，
+    再按 numeric_profile 的坐标取最近的 MATCHING_ANN_NUMERIC_NEIGHBOURS 个
+    queries 为需要查询近邻的学生下标，默认所有学生；返回 (left, right)，left < right
+    """
+    queried = np.ones(n, dtype=bool) if queries is None else np.isin(np.arange(n), queries)
+    codes = [np.zeros(0, dtype=np.int64)]
+    for item in items.values():
+        rows = np.flatnonzero(item.fallback) if item.kernel is None else np.zeros(0, dtype=np.int64)
+        k = min(GeneralConfig.MATCHING_ANN_TEXT_NEIGHBOURS, len(rows) - 1)
+        local = np.flatnonzero(queried[rows])
+        if k > 0 and len(local):
+            index = IVFIndex(item.normalized[rows], GeneralConfig.MATCHING_ANN_LISTS or None)
+            codes.append(neighbour_codes(rows, local, index.neighbours(k, GeneralConfig.MATCHING_ANN_PROBES, local), n))
+
+    profile = numeric_profile(items)
+    k = min(GeneralConfig.MATCHING_ANN_NUMERIC_NEIGHBOURS, n - 1)
+    local = np.flatnonzero(queried)
+    if profile is not None and k > 0 and len(local):
+        index = IVFIndex(profile, GeneralConfig.MATCHING_ANN_LISTS or None)
+        codes.append(neighbour_codes(np.arange(n), local,
+                                     index.neighbours(k, GeneralConfig.MATCHING_ANN_PROBES, local), n))
+
+    codes = np.unique(np.concatenate(codes))
+    return codes // n, codes % n
+
+
+def written_counts(ids):
+    """数据库里每位学生发出的匹配分条数"""
+    counts = dict(db_session.query(MatchingScore.from_student_id, func.count(MatchingScore.id))
+                  .filter(MatchingScore.from_student_id.in_(ids.tolist()))
+                  .group_by(MatchingScore.from_student_id)
+                  .all())
+    return np.asarray([counts.get(student_id, 0) for student_id in ids.tolist()])
+
+
+def write_pairs(student_ids, left_ids, right_ids, outgoing, incoming, removed=(), progress=None):
+    """删除 student_ids 和 removed（已离开分块的学生）发出和收到的所有匹配分，再写入至少一方在 student_ids 中的候选对"""
+    deleted = np.concatenate([student_ids, np.asarray(removed, dtype=np.int64)])
+    for start in range(0, len(deleted), DELETE_CHUNK):
+        chunk = deleted[start:start + DELETE_CHUNK].tolist()
+        purge(MatchingScore, or_(MatchingScore.from_student_id.in_(chunk), MatchingScore.to_student_id.in_(chunk)))
+
+    selected = np.isin(left_ids, student_ids) | np.isin(right_ids, student_ids)
+    from_ids = np.concatenate([left_ids[selected], right_ids[selected]])
+    to_ids = np.concatenate([right_ids[selected], left_ids[selected]])
+    scores = np.concatenate([outgoing[selected], incoming[selected]])
+    for chunk in range(0, len(scores), INSERT_CHUNK):
+        part = slice(chunk, chunk + INSERT_CHUNK)
+        db_session.execute(insert(MatchingScore.__table__), [
+            {"from_student_id": from_id, "to_student_id": to_id, "score": score}
+            for from_id, to_id, score in zip(from_ids[part].tolist(), to_ids[part].tolist(), scores[part].tolist())
+        ])
+        db_session.commit()
+        if progress is not None:
+            progress.advance(len(scores[part]))
+    MATCHING_ROWS_WRITTEN.inc(len(scores))
+
+
+def refresh_candidates(gender, categories, progress=None, force=False, rebuild=False, rescored=None):
+    """
+    候选对模式下更新一个分块，返回重写的学生数：
+    用 IVF 索引为每位学生挑出文本答案和数值答案最接近的同学（candidate_pairs），只为这些学生对精确计算匹配分，
+    matching_scores 里只保存候选对，不在候选对里的学生之间没有匹配分；不发布 (n, n) 的匹配分矩阵，API 直接查询数据库
+    之后只为答案或权重有变化的学生重新查询近邻，其余学生之间的候选对保留；rebuild 或候选参数变化时重新挑选所有候选对
+    """
+    progress = progress or ScanProgress(persist=False)
+    key = partition_key(gender, categories)
+    store = CandidateStore(key)
+    store.remove_dense()
+    shutil.rmtree(block_path(key), ignore_errors=True)
+    if rebuild:
+        store.clear()
+    signature = block_signature(gender, categories)
+    settings = candidate_settings()
+    previous = store.pairs() if settings == store.meta["settings"] else None
+    full_check = force or signature == store.meta["signature"]
+    if previous is not None and full_check and not force and \
+            time.time() - store.meta["checked_at"] < GeneralConfig.MATCHING_FULL_CHECK_SECONDS:
+        return 0
+
+    snapshot = load_snapshot(gender, categories)
+    ids = snapshot.ids
+    n = len(ids)
+    progress.start_block(key, n)
+
+    progress.stage("candidates", 0)
+    kernels = item_kernels()
+    items = pair_items(store, kernels, snapshot.answers)
+    digests = student_digests(snapshot.answers, kernels)
+    if digests is None:
+        digests = np.zeros(n, dtype=np.uint64)
+    if previous is None:
+        dirty = np.arange(n)
+        kept = np.zeros(0, dtype=bool)
+        removed = np.zeros(0, dtype=np.int64)
+    else:
+        position = np.minimum(np.searchsorted(previous["ids"], ids), max(len(previous["ids"]) - 1, 0))
+        clean = (previous["ids"][position] == ids) & (previous["digests"][position] == digests) \
+            if len(previous["ids"]) else np.zeros(n, dtype=bool)
+        dirty = np.flatnonzero(~clean)
+        kept = np.isin(previous["left"], ids[clean]) & np.isin(previous["right"], ids[clean])
+        removed = np.setdiff1d(previous["ids"], ids)
+    left, right = candidate_pairs(items, n, dirty) if len(dirty) else (np.zeros(0, dtype=np.int64),) * 2
+
+    progress.stage("similarity", len(left))
+    outgoing = np.zeros(len(left))
+    incoming = np.zeros(len(left))
+    for start in range(0, len(left), INSERT_CHUNK):
+        part = slice(start, start + INSERT_CHUNK)
+        outgoing[part], incoming[part] = aggregate_pairs(items, left[part], right[part])
+        progress.advance(len(left[part]))
+    MATCHING_PAIRS.inc(len(left))
+    left_ids, right_ids = ids[left], ids[right]
+    if previous is not None:
+        # 两个答案都没变的学生之间的匹配分不变，沿用上次的结果
+        left_ids = np.concatenate([previous["left"][kept], left_ids])
+        right_ids = np.concatenate([previous["right"][kept], right_ids])
+        outgoing = np.concatenate([previous["outgoing"][kept], outgoing])
+        incoming = np.concatenate([previous["incoming"][kept], incoming])
+
+    changed = ids[dirty]
+    if full_check and previous is not None:
+        # 定期检查：数据库里的条数与候选对不一致的学生（如被别的操作删除了匹配分）也重写
+        expected = np.bincount(np.searchsorted(ids, np.concatenate([left_ids, right_ids])), minlength=n)
+        changed = np.union1d(changed, ids[written_counts(ids) != expected])
+
+    progress.stage("scores", 2 * np.count_nonzero(np.isin(left_ids, changed) | np.isin(right_ids, changed)))
+    if len(changed) or len(removed):
+        write_pairs(changed, left_ids, right_ids, outgoing, incoming, removed, progress)
+        if rescored is not None:
+            rescored.update(changed.tolist())
+
+    store.save_pairs(ids, digests, left_ids, right_ids, outgoing, incoming)
+    store.meta.update(signature=signature, settings=settings, checked_at=time.time())
+    store.save_meta()
+    progress.finish_block(len(changed))
+    return len(changed)
+
+
+def use_candidates(gender, categories):
+    """分块是否使用候选对模式"""
+    if not GeneralConfig.MATCHING_ANN:
+        return False
+    query = db_session.query(func.count(Student.id)).filter(Student.gender == gender)
+    if categories is not None:
+        query = query.filter(category_filter(Student.category, categories))
+    count = query.scalar()
+    db_session.commit()
+    return count >= GeneralConfig.MATCHING_ANN_MIN_STUDENTS
+
+
+def refresh_block(gender, categories, progress=None, force=False, rebuild=False, rescored=None):
+    """
+    更新一个分块（一个性别和能混寝的一组类别）的相似度缓存，并重写答案或权重有变化的学生的匹配分，返回重写的学生数
+    force 时不论答案概况是否变化都做一次完整检查，rebuild 时丢弃缓存，重新计算所有学生并重写全部匹配分
+    rescored 不为 None 时把重写了匹配分的学生 id 加入其中
+    """
+    if use_candidates(gender, categories):
+        return refresh_candidates(gender, categories, progress, force, rebuild, rescored)
+
+    progress = progress or ScanProgress(persist=False)
+    key = partition_key(gender, categories)
+    # 从候选对模式切换回来时，数据库里只有候选对的匹配分，按第一次建立缓存处理，补全所有学生
+    shutil.rmtree(os.path.join(GeneralConfig.MATCHING_STORE_PATH, key, "candidates"), ignore_errors=True)
+    store = SimilarityStore(key)
+    if rebuild:
+        store.clear()
+    signature = block_signature(gender, categories)
+    # 答案概况没变时只定期做一次完整检查，补上因其他原因缺失的匹配分
+    full_check = store.created or force or signature == store.meta["signature"]
+    if full_check and not store.created and not force and \
+            time.time() - store.meta["checked_at"] < GeneralConfig.MATCHING_FULL_CHECK_SECONDS:
+        return 0
+
+    snapshot = load_snapshot(gender, categories)
+    ids, answers = snapshot.ids, snapshot.answers
+    progress.start_block(key, len(ids))
+    if not np.array_equal(ids, store.ids):
+        store.resize(ids)
+
+    # 题目被删除后，回答过这道题的学生的匹配分也要重写
+    removed = np.zeros(len(ids), dtype=bool)
+    for item_id in store.item_ids():
+        if item_id not in answers:
+            removed |= ~np.isnan(store.array(item_id, "weight", mode="r"))
+            store.remove_item(item_id)
+    kernels = item_kernels()
+    for item_id in answers.keys():
+        kernel = kernels.get(item_id)
+        kernel_signature = kernel.signature() if kernel else "text"
+        if item_id in store.meta["items"] and store.meta["items"][item_id].get("kernel") != kernel_signature:
+            # 题目类型或选项变了，答案的编码方式随之改变，这道题的缓存全部重新计算
+            removed |= ~np.isnan(store.array(item_id, "weight", mode="r"))
+            store.remove_item(item_id)
+        if item_id not in store.meta["items"]:
+            store.add_item(item_id, kernel)
+    store.save_meta()
+
+    hashes = {item_id: answer_hashes(item_answers) for item_id, (_, item_answers, _) in answers.items()}
+    progress.stage("similarity", sum(np.count_nonzero(hashes[item_id] != store.array(item_id, "hash", mode="r"))
+                                     for item_id in answers.keys()) * len(ids))
+    for item_id, (answer_ids, item_answers, weights) in answers.items():
+        dirty = update_item(store, item_id, kernels.get(item_id), answer_ids, item_answers, weights,
+                            hashes[item_id], progress)
+        if len(dirty):
+            progress.log("debug", "题目 {} 有 {} 位学生的答案需要重新计算相似度".format(item_id, len(dirty)),
+                         "scan.item_updated", block=key, item_id=item_id, students=len(dirty))
+
+    item_weights = {item_id: weights for item_id, (_, _, weights) in answers.items()}
+    changed = removed
+    for item_id, weights in item_weights.items():
+        stored_weights = store.array(item_id, "weight", mode="r")
+        changed |= ~((stored_weights == weights) | (np.isnan(stored_weights) & np.isnan(weights)))
+    rows = np.flatnonzero(changed)
+
+    if rebuild:
+        rows = np.arange(len(ids))
+    elif store.created:
+        # 第一次建立缓存时，数据库里已有的匹配分与缓存算出的一致，只补全缺失的部分
+        rows = incomplete_students(ids)
+    elif full_check:
+        rows = np.union1d(rows, incomplete_students(ids))
+
+    # 至少一方在 rows 中的有序学生对都要重写
+    n, kept = len(ids), len(ids) - len(rows)
+    progress.stage("scores", n * (n - 1) - kept * (kept - 1))
+    if len(rows):
+        write_scores(store, item_weights, rows, progress)
+        if rescored is not None:
+            rescored.update(ids[rows].tolist())
+
+    progress.stage("publish", 0)
+    publish_scores(store, item_weights, rows)
+
+    for item_id, weights in item_weights.items():
+        stored_weights = store.array(item_id, "weight")
+        stored_weights[:] = weights
+        stored_weights.flush()
+
+    store.meta["signature"] = signature
+    store.meta["checked_at"] = time.time()
+    store.save_meta()
+    progress.finish_block(len(rows))
+    return len(rows)
+
+
+def remove_stale_blocks(keys):
+    """删除不再对应任何学生的分块（类别分组调整、类别不再使用或按旧的分块方式建立）的缓存和已发布的匹配分矩阵"""
+    for root in (GeneralConfig.MATCHING_STORE_PATH, GeneralConfig.SCORE_MATRIX_PATH):
+        for key in os.listdir(root) if os.path.isdir(root) else []:
+            if key not in keys and key.startswith("gender-"):
+                shutil.rmtree(os.path.join(root, key), ignore_errors=True)
+
+
+def refresh_all(progress=None, category=None, force=False, rebuild=False, rescored=None):
+    """更新所有分块；指定 category 时只更新这个类别的学生所在的分块"""
+    blocks = partitions(category)
+    rewritten = sum(refresh_block(gender, categories, progress=progress, force=force, rebuild=rebuild,
+                                  rescored=rescored)
+                    for gender, categories in blocks)
+    if category is None:
+        remove_stale_blocks(set(partition_key(gender, categories) for gender, categories in blocks))
+    return rewritten
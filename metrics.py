@@ -0,0 +1,291 @@
+import glob
+import json
+import os
+import socket
+import threading
+import time
+
+from config import GeneralConfig
+
+# Prometheus 文本格式的指标：计数器、直方图和仪表
+# gunicorn 的每个 worker 各有一份指标，定期写到 METRICS_DIR/<主机名>/<角色>/<pid>.json，
+# 任意一个 worker 响应 /metrics 时汇总同一主机同一角色的所有文件（计数器、直方图、仪表都按进程求和），
+# 已经退出的 worker 的文件在汇总时删除，它的计数器随之清零，Prometheus 按计数器重置处理
+# 任务进程只有一个，直接用 serve 在 METRICS_PORT 上暴露自己的指标
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+_registry = {}
+_lock = threading.Lock()
+_role = None
+_flushed_at = 0.0
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        _registry[name] = self
+
+    def _key(self, labels):
+        return json.dumps([str(labels.get(label, "")) for label in self.labels], ensure_ascii=False)
+
+    def state(self):
+        return dict(self.values)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        # 有 function 时在导出时取值，如连接池当前借出的连接数
+        self.function = function
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[self._key(labels)] = value
+
+    def state(self):
+        if self.function is not None:
+            return {self._key({}): self.function()}
+        return dict(self.values)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            # [各桶的计数..., 总和, 次数]，桶不累加，导出时再累加
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[index] += 1
+                    break
+            values[-2] += value
+            values[-1] += 1
+
+    def state(self):
+        with _lock:
+            return {key: list(values) for key, values in self.values.items()}
+
+
+class Timer:
+    """with metrics.Timer(histogram, **labels): ... 记录代码块的耗时"""
+
+    def __init__(self, histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started_at, **self.labels)
+
+
+def _directory():
+    return os.path.join(GeneralConfig.METRICS_DIR, socket.gethostname(), _role)
+
+
+def collect():
+    return {name: {"type": metric.type, "help": metric.help, "labels": metric.labels,
+                   "buckets": getattr(metric, "buckets", None), "values": metric.state()}
+            for name, metric in _registry.items()}
+
+
+def flush(force=False):
+    """把本进程的指标写到共享目录，最多每 METRICS_FLUSH_SECONDS 秒写一次"""
+    global _flushed_at
+    if _role is None or (not force and time.monotonic() - _flushed_at < GeneralConfig.METRICS_FLUSH_SECONDS):
+        return
+    _flushed_at = time.monotonic()
+    directory = _directory()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "{}.json".format(os.getpid()))
+    with open(path + ".tmp", "w") as f:
+        json.dump(collect(), f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(states):
+    merged = {}
+    for state in states:
+        for name, metric in state.items():
+            target = merged.setdefault(name, dict(metric, values={}))
+            for key, value in metric["values"].items():
+                if key not in target["values"]:
+                    target["values"][key] = value
+                elif isinstance(value, list):
+                    target["values"][key] = [a + b for a, b in zip(target["values"][key], value)]
+                else:
+                    target["values"][key] += value
+    return merged
+
+
+def _labels(names, key, extra=None):
+    pairs = list(zip(names, json.loads(key)))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+
+def exposition():
+    """所有进程汇总后的 Prometheus 文本格式"""
+    states = [collect()]
+    if _role is not None:
+        flush(force=True)
+        states = []
+        for path in glob.glob(os.path.join(_directory(), "*.json")):
+            # 重启后已经退出的 worker 的文件删除，否则它最后的仪表值（如借出的连接数）会一直被计入
+            pid = os.path.basename(path)[:-len(".json")]
+            if pid.isdigit() and not _alive(int(pid)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    states.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    lines = []
+    for name, metric in sorted(_merge(states).items()):
+        lines.append("# HELP {} {}".format(name, metric["help"]))
+        lines.append("# TYPE {} {}".format(name, metric["type"]))
+        for key, value in sorted(metric["values"].items()):
+            if metric["type"] != "histogram":
+                lines.append("{}{} {}".format(name, _labels(metric["labels"], key), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric["buckets"], value):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, _labels(metric["labels"], key, ("le", bound)), cumulative))
+            lines.append("{}_bucket{} {}".format(name, _labels(metric["labels"], key, ("le", "+Inf")), value[-1]))
+            lines.append("{}_sum{} {}".format(name, _labels(metric["labels"], key), value[-2]))
+            lines.append("{}_count{} {}".format(name, _labels(metric["labels"], key), value[-1]))
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# API
+REQUEST_SECONDS = Histogram("rmmt_http_request_duration_seconds", "请求耗时", ("blueprint", "method", "route", "status"))
+DB_CHECKOUT_SECONDS = Histogram("rmmt_db_pool_checkout_seconds", "从连接池取得连接的等待时间", ("database",),
+                                buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+DB_CHECKOUT_TIMEOUTS = Counter("rmmt_db_pool_checkout_timeouts_total", "等待空闲连接超过 DATABASE_POOL_TIMEOUT 的次数",
+                               ("database",))
+JWT_REFRESHES = Counter("rmmt_jwt_refreshes_total", "即将过期而刷新的令牌数")
+
+# 匹配任务
+MATCHING_PAIRS = Counter("rmmt_matching_pairs_total", "重新计算的逐题学生对相似度个数")
+MATCHING_ROWS_WRITTEN = Counter("rmmt_matching_rows_written_total", "写入 matching_scores 的行数")
+EMBEDDING_CACHE = Counter("rmmt_embedding_cache_total", "文本答案向量是否已缓存在数据库里", ("result",))
+SCAN_SECONDS = Histogram("rmmt_matching_scan_duration_seconds", "一次匹配扫描的耗时")
+SCAN_REWRITTEN = Counter("rmmt_matching_rewritten_students_total", "重写了匹配分的学生数")
+
+
+def instrument_pool(engine, database):
+    """统计取得连接的等待时间和超时次数，导出连接池大小和当前借出的连接数"""
+    from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+    pool_connect = engine.pool.connect
+
+    def timed_connect():
+        try:
+            with Timer(DB_CHECKOUT_SECONDS, database=database):
+                return pool_connect()
+        except PoolTimeout:
+            DB_CHECKOUT_TIMEOUTS.inc(database=database)
+            raise
+
+    engine.pool.connect = timed_connect
+    prefix, name = ("rmmt_db_pool", "连接池") if database == "primary" else ("rmmt_db_replica_pool", "只读副本连接池")
+    Gauge(prefix + "_checked_out", name + "当前借出的连接数", function=engine.pool.checkedout)
+    Gauge(prefix + "_size", name + "常驻的连接数", function=engine.pool.size)
+
+
+def init_app(app, engine, replica_engine=None):
+    """统计请求耗时和连接池等待时间，注册 /metrics"""
+    global _role
+    from flask import Response, g, request
+
+    _role = "api"
+
+    instrument_pool(engine, "primary")
+    if replica_engine is not None:
+        instrument_pool(replica_engine, "replica")
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started_at = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started_at = g.pop("metrics_started_at", None)
+        if started_at is not None and request.url_rule is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - started_at, blueprint=request.blueprint or "",
+                                    method=request.method, route=request.url_rule.rule, status=response.status_code)
+        flush()
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(exposition(), content_type=CONTENT_TYPE)
+
+
+def serve(port):
+    """在后台线程里用 HTTP 暴露本进程的指标（任务进程用）"""
+    from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    def application(environ, start_response):
+        if environ.get("PATH_INFO") != "/metrics":
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b""]
+        start_response("200 OK", [("Content-Type", CONTENT_TYPE)])
+        return [exposition().encode("utf8")]
+
+    server = make_server("0.0.0.0", port, application, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
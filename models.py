@@ -1,4 +1,6 @@
 # coding: utf-8
+import datetime
+import json
 from copy import deepcopy
 
 import bcrypt
@@ -41,6 +43,16 @@ class QuestionnaireItem(Base, SerializerMixin):
     type = Column(String(64), nullable=False, server_default=text("'text'"))
 
 
+class QuestionnaireRevision(Base, SerializerMixin):
+    __tablename__ = 'questionnaire_revisions'
+
+    id = Column(INTEGER(11), primary_key=True)
+    items = Column(LONGTEXT, nullable=False, comment='该版本全部问卷题目 JSON')
+    changes = Column(Text, comment='与上一版本的差异 JSON')
+    created_by = Column(INTEGER(11))
+    created_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+
+
 class SystemSetting(Base, SerializerMixin):
     __tablename__ = 'system_settings'
 
@@ -295,6 +307,20 @@ class ExchangingRequest(Base, SerializerMixin):
     updated_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
 
 
+class ExchangingCandidate(Base, SerializerMixin):
+    __tablename__ = 'exchanging_candidates'
+
+    id = Column(INTEGER(11), primary_key=True)
+    cycle_key = Column(String(255), nullable=False, unique=True)
+    student_ids = Column(Text, nullable=False, comment='换寝环 JSON，每位学生搬到下一位学生的位置')
+    team_ids = Column(Text, nullable=False, comment='生成候选时各学生所在队伍 JSON')
+    gains = Column(Text, comment='每位学生匹配分的提升 JSON')
+    total_gain = Column(DOUBLE(), nullable=False, index=True)
+    min_gain = Column(DOUBLE(), nullable=False)
+    length = Column(TINYINT(4), nullable=False)
+    created_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+
+
 class MatchingScore(Base, SerializerMixin):
     __tablename__ = 'matching_scores'
 
@@ -356,6 +382,171 @@ class TeamInvitation(Base, SerializerMixin):
     team = relationship('Team')
 
 
+class AllocationPlan(Base, SerializerMixin):
+    __tablename__ = 'allocation_plans'
+
+    id = Column(INTEGER(11), primary_key=True)
+    gender = Column(TINYINT(4), nullable=False, comment='男1 女2')
+    category = Column(Text)
+    status = Column(TINYINT(4), server_default=text("'0'"), comment='0排队中 1计算中 2待确认 3已提交 -1失败 -2已废弃')
+    team_max_student_count = Column(INTEGER(11))
+    total_score = Column(DOUBLE())
+    result = Column(LONGTEXT, comment='分配方案 JSON')
+    message = Column(Text)
+    created_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+    updated_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+
+    # 按方案把学生批量放进队伍，效果与逐个调用 Student.set_team 相同
+    # Attention: 方案生成后如果学生或队伍发生了变化，方案即视为过期，需要重新生成
+    def apply(self):
+        plan_teams = json.loads(self.result)["teams"]
+        max_count = int(self.team_max_student_count)
+        student_ids = [student_id for plan_team in plan_teams for student_id in plan_team["student_ids"]]
+
+        free_students_count = db_session.query(Student) \
+            .filter(Student.id.in_(student_ids)) \
+            .filter(Student.team_id.is_(None)) \
+            .filter(Student.gender == self.gender) \
+            .count()
+        if free_students_count != len(student_ids):
+            return jsonify({
+                "code": 400,
+                "msg": "部分学生已经加入其他队伍，分配方案已过期，请重新生成"
+            })
+
+        for plan_team in plan_teams:
+            if plan_team["team_id"] is None:
+                continue
+            team = db_session.query(Team).get(plan_team["team_id"])
+            students_count_in_team = db_session.query(Student).where(Student.team_id == plan_team["team_id"]).count()
+            if team is None or students_count_in_team + len(plan_team["student_ids"]) > max_count:
+                return jsonify({
+                    "code": 400,
+                    "msg": "部分队伍已解散或人数有变，分配方案已过期，请重新生成"
+                })
+
+        full_team_ids = []
+        for plan_team in plan_teams:
+            if plan_team["team_id"] is None:
+                team = Team(gender=self.gender, category=self.category)
+                db_session.add(team)
+                db_session.flush()
+                plan_team["team_id"] = team.id
+
+            db_session.query(Student) \
+                .filter(Student.id.in_(plan_team["student_ids"])) \
+                .update({Student.team_id: plan_team["team_id"]}, synchronize_session=False)
+            if len(plan_team["member_ids"]) + len(plan_team["student_ids"]) >= max_count:
+                full_team_ids.append(plan_team["team_id"])
+
+        # 使其他队伍请求无效
+        db_session.query(TeamInvitation) \
+            .filter(TeamInvitation.status == 0) \
+            .filter(TeamInvitation.from_student_id.in_(student_ids)) \
+            .update({
+            TeamInvitation.status: -2,
+            TeamInvitation.reason: "请求发出者已加入其他队伍，请求无效"
+        }, synchronize_session=False)
+
+        db_session.query(TeamInvitation) \
+            .filter(TeamInvitation.status == 0) \
+            .filter(TeamInvitation.to_student_id.in_(student_ids)) \
+            .update({
+            TeamInvitation.status: -2,
+            TeamInvitation.reason: "被邀请者已加入其他队伍，请求无效"
+        }, synchronize_session=False)
+
+        db_session.query(TeamRequest) \
+            .filter(TeamRequest.status == 0) \
+            .filter(TeamRequest.student_id.in_(student_ids)).update({
+            TeamRequest.status: -2,
+            TeamRequest.reason: "已进入其他队伍，请求失效"
+        }, synchronize_session=False)
+
+        db_session.query(TeamInvitation) \
+            .filter(TeamInvitation.status == 0) \
+            .filter(TeamInvitation.team_id.in_(full_team_ids)) \
+            .update({
+            TeamInvitation.status: -2,
+            TeamInvitation.reason: "目标队伍已满人，请求失效"
+        }, synchronize_session=False)
+
+        db_session.query(TeamRequest) \
+            .filter(TeamRequest.status == 0) \
+            .filter(TeamRequest.team_id.in_(full_team_ids)).update({
+            TeamRequest.status: -2,
+            TeamRequest.reason: "目标队伍已满人，请求失效"
+        }, synchronize_session=False)
+
+        self.status = 3
+        self.result = json.dumps({**json.loads(self.result), "teams": plan_teams})
+        self.updated_at = datetime.datetime.now()
+        db_session.commit()
+
+        return True
+
+
+class Job(Base, SerializerMixin):
+    __tablename__ = 'jobs'
+
+    id = Column(INTEGER(11), primary_key=True)
+    type = Column(String(64), nullable=False)
+    status = Column(TINYINT(4), server_default=text("'0'"), index=True, comment='0排队中 1运行中 2已完成 -1失败 -2已取消')
+    cancel_requested = Column(TINYINT(1), server_default=text("'0'"))
+    params = Column(LONGTEXT, comment='任务参数 JSON，任务结束后清空')
+    checkpoint = Column(LONGTEXT, comment='断点 JSON，worker 重启后从这里继续')
+    progress = Column(DOUBLE(), server_default=text("'0'"))
+    progress_message = Column(Text)
+    result = Column(LONGTEXT)
+    error = Column(Text)
+    created_by = Column(INTEGER(11))
+    created_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    updated_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+
+    serialize_rules = ('-params', '-checkpoint')
+
+
+class ScanRun(Base, SerializerMixin):
+    __tablename__ = 'scan_runs'
+
+    id = Column(INTEGER(11), primary_key=True)
+    mode = Column(String(16), nullable=False, server_default=text("'scheduled'"),
+                  comment='scheduled 定时扫描 incremental 管理员触发的增量更新 full 管理员触发的全部重新计算')
+    category = Column(String(255), comment='只更新这个类别的学生所在的分块，为空时更新全部')
+    status = Column(TINYINT(4), server_default=text("'0'"), index=True, comment='0排队中 1运行中 2已完成 -1失败 -2已取消')
+    cancel_requested = Column(TINYINT(1), server_default=text("'0'"))
+    stage = Column(String(64), comment='当前分块所处的阶段 similarity / scores / publish')
+    blocks = Column(LONGTEXT, comment='各分块进度 JSON')
+    pairs_done = Column(BIGINT(20), server_default=text("'0'"))
+    rewritten = Column(INTEGER(11), server_default=text("'0'"), comment='重写了匹配分的学生数')
+    error = Column(Text)
+    requested_by = Column(INTEGER(11))
+    created_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    updated_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+
+    serialize_rules = ('-blocks',)
+
+
+class Event(Base, SerializerMixin):
+    __tablename__ = 'events'
+
+    id = Column(INTEGER(11), primary_key=True)
+    type = Column(String(32), nullable=False, comment='answers / students / questionnaire / job / scan / exchanging')
+    student_id = Column(BIGINT(20))
+    created_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"), index=True)
+
+
+class LastWrite(Base, SerializerMixin):
+    __tablename__ = 'last_writes'
+
+    identity = Column(String(64), primary_key=True, comment='student:学生id / admin:管理员id')
+    written_at = Column(DOUBLE(), nullable=False, comment='最后一次写入数据的 Unix 时间戳')
+
+
 def get_system_setting(key, default=None):
     item = db_session.query(SystemSetting.value).where(SystemSetting.key == key).first()
 
@@ -366,7 +557,7 @@ def get_system_setting(key, default=None):
 
 
 def set_system_setting(key, value):
-    item = db_session.query(SystemSetting.value).where(SystemSetting.key == key).first()
+    item = db_session.query(SystemSetting).where(SystemSetting.key == key).first()
 
     if item is None:
         item = SystemSetting(key=key, value=value)
@@ -0,0 +1,85 @@
+import json
+
+from sqlalchemy import or_
+
+from database import db_session
+from models import Student, get_system_setting
+from score_matrix import block_key
+
+# 匹配按 (性别, 类别) 分块：只有同性别、同类别的学生能组成队伍，不同分块之间的学生对既不计算也不保存匹配分
+# 管理员可以在系统设置 matching_category_groups 里把若干类别合为一组，同一组的类别可以混寝，在同一个分块里计算，
+# 例如 [["计算机类", "软件工程"], ["数学类", "统计学"]]；有共同类别的组会合并
+
+CATEGORY_GROUPS_SETTING = "matching_category_groups"
+
+
+def parse_category_groups(value):
+    """解析系统设置的值，返回 {类别: 组内全部类别（排好序的 tuple）}，格式不对时抛出 ValueError"""
+    groups = json.loads(value) if value else []
+    if not isinstance(groups, list) or \
+            not all(isinstance(group, list) and all(isinstance(category, str) for category in group)
+                    for group in groups):
+        raise ValueError("应为类别名数组的数组")
+
+    # 有共同类别的组合并成一组
+    merged = {}
+    for group in groups:
+        members = set(group)
+        for category in group:
+            members |= merged.get(category, set())
+        for category in members:
+            merged[category] = members
+    return {category: tuple(sorted(members)) for category, members in merged.items()}
+
+
+def category_groups():
+    try:
+        return parse_category_groups(get_system_setting(CATEGORY_GROUPS_SETTING))
+    except ValueError:
+        # 设置保存时已经校验过，这里只防止直接改库写坏
+        return {}
+
+
+def partition_categories(category, groups=None):
+    """能与该类别的学生混寝的所有类别（含自身）"""
+    groups = category_groups() if groups is None else groups
+    return groups.get(category, (category,))
+
+
+def partition_key(gender, categories):
+    """分块的名字，即匹配分缓存和匹配分矩阵的目录名"""
+    name = categories[0] if len(categories) == 1 else json.dumps(categories, ensure_ascii=False)
+    return block_key(gender, name)
+
+
+def student_partition_key(student, groups=None):
+    """学生所在分块的名字"""
+    return partition_key(student.gender, partition_categories(student.category, groups))
+
+
+def same_partition(category, other_category, groups=None):
+    return other_category in partition_categories(category, groups)
+
+
+def category_filter(column, categories):
+    """column 属于 categories 中的某个类别，None 表示没有设置类别"""
+    condition = column.in_([category for category in categories if category is not None])
+    if None in categories:
+        condition = or_(condition, column.is_(None))
+    return condition
+
+
+def partitions(category=None):
+    """
+    当前所有学生所在的分块，返回 [(gender, categories)]
+    指定 category 时只返回这个类别所在的分块
+    """
+    groups = category_groups()
+    query = db_session.query(Student.gender, Student.category).distinct()
+    if category is not None:
+        query = query.filter(category_filter(Student.category, partition_categories(category, groups)))
+    result = set()
+    for gender, student_category in query.all():
+        if gender is not None:
+            result.add((gender, partition_categories(student_category, groups)))
+    return sorted(result, key=lambda partition: (partition[0], json.dumps(partition[1])))
@@ -0,0 +1,210 @@
+import datetime
+import json
+import sys
+import time
+
+import arrow
+
+import events
+from config import GeneralConfig
+from database import db_session
+from models import ScanRun
+
+# 匹配任务的日志和进度
+# log 按 PROGRESS_LOG_LEVEL 过滤，PROGRESS_LOG_FORMAT 为 json 时每行输出一个 JSON 对象，便于日志系统检索
+# ScanProgress 统计每个分块已计算的学生对、速度和预计剩余时间，最多每 PROGRESS_LOG_INTERVAL 秒打印一次并写入 scan_runs，
+# 管理端通过 /api/admin/matching/scan-runs 查看，也可以通过 /api/admin/matching/trigger 排队一次扫描，worker 收到事件后执行
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+# 扫描状态，与后台任务一致
+SCAN_QUEUED = 0
+SCAN_RUNNING = 1
+SCAN_FINISHED = 2
+SCAN_FAILED = -1
+SCAN_CANCELLED = -2
+
+# 扫描方式
+SCAN_SCHEDULED = "scheduled"
+SCAN_INCREMENTAL = "incremental"
+SCAN_FULL = "full"
+
+# scan_runs 最多保留的记录数
+KEEP_RUNS = 200
+
+
+def enabled(level, threshold=None):
+    threshold = threshold or GeneralConfig.PROGRESS_LOG_LEVEL
+    return LEVELS.get(level, 20) >= LEVELS.get(threshold.lower(), 20)
+
+
+def log(level, message, event=None, threshold=None, **fields):
+    if not enabled(level, threshold):
+        return
+    now = arrow.now("Asia/Shanghai")
+    if GeneralConfig.PROGRESS_LOG_FORMAT == "json":
+        line = json.dumps({"time": now.isoformat(), "level": level, "event": event, "msg": message, **fields},
+                          ensure_ascii=False, default=str)
+    else:
+        line = "[{}] {}".format(now.format("YYYY-MM-DD HH:mm:ss"), message)
+        if fields:
+            line += " " + " ".join("{}={}".format(key, value) for key, value in fields.items())
+    print(line, file=sys.stderr if level == "error" else sys.stdout, flush=True)
+
+
+class ScanCancelled(Exception):
+    pass
+
+
+def enqueue(mode, category=None, requested_by=None):
+    """排队一次扫描，已有相同的扫描在排队时直接返回它"""
+    run = db_session.query(ScanRun) \
+        .filter(ScanRun.status == SCAN_QUEUED, ScanRun.mode == mode, ScanRun.category == category) \
+        .first()
+    if run is None:
+        run = ScanRun(mode=mode, category=category, status=SCAN_QUEUED, requested_by=requested_by)
+        db_session.add(run)
+        events.publish(events.EVENT_SCAN)
+        db_session.commit()
+    return run
+
+
+def cancel(run):
+    if run.status == SCAN_QUEUED:
+        run.status = SCAN_CANCELLED
+        run.finished_at = datetime.datetime.now()
+    elif run.status == SCAN_RUNNING:
+        run.cancel_requested = 1
+    run.updated_at = datetime.datetime.now()
+    db_session.commit()
+
+
+def recover():
+    """worker 启动时把上次异常退出时仍在运行的扫描放回队列，定时扫描直接标记为失败，下次定时扫描会补上"""
+    db_session.query(ScanRun) \
+        .filter(ScanRun.status == SCAN_RUNNING, ScanRun.mode != SCAN_SCHEDULED) \
+        .update({ScanRun.status: SCAN_QUEUED, ScanRun.cancel_requested: 0})
+    db_session.query(ScanRun) \
+        .filter(ScanRun.status == SCAN_RUNNING) \
+        .update({ScanRun.status: SCAN_FAILED, ScanRun.error: "worker 异常退出",
+                 ScanRun.finished_at: datetime.datetime.now()})
+    db_session.commit()
+
+
+class ScanProgress:
+    """
+    一次 scan_students 的进度，matching.refresh_block 在每个阶段开始时调用 stage，每算完一批学生对调用 advance
+    persist 为 False 时只打印不写库（基准和压测用），level 可单独指定这次扫描的日志级别
+    定时扫描的 scan_runs 记录在第一个需要重新计算的分块开始时才创建，没有变化的扫描不留记录；
+    管理员排队的扫描传入已有的 run
+    每次写库时检查是否已请求取消，已请求时抛出 ScanCancelled
+    """
+
+    def __init__(self, persist=True, level=None, run=None):
+        self.persist = persist
+        self.level = level
+        self.run = run
+        self.blocks = []
+        self.block = None
+        self.pairs_done = 0
+        self.rewritten = 0
+        self.reported_at = time.monotonic()
+
+    def log(self, level, message, event=None, **fields):
+        log(level, message, event, threshold=self.level, **fields)
+
+    def start_block(self, key, students):
+        if self.persist and self.run is None:
+            self.run = ScanRun(mode=SCAN_SCHEDULED, status=SCAN_RUNNING, started_at=datetime.datetime.now())
+            db_session.add(self.run)
+            db_session.commit()
+            self._prune()
+        # pairs_done 为分块累计的学生对数，stage_pairs_done / stage_pairs_total 为当前阶段的进度
+        self.block = {"key": key, "students": students, "stage": None, "pairs_done": 0, "stage_pairs_done": 0,
+                      "stage_pairs_total": 0, "pairs_per_second": None, "eta_seconds": None, "rewritten": 0,
+                      "seconds": None}
+        self.blocks.append(self.block)
+        self.block_started_at = time.monotonic()
+        self.log("info", "分块 {} 开始更新，共 {} 位学生".format(key, students), "scan.block_started",
+                 block=key, students=students)
+        self._save()
+
+    def stage(self, stage, pairs_total):
+        """进入新的阶段，pairs_total 为这个阶段要计算或写入的学生对数"""
+        self.block.update(stage=stage, stage_pairs_done=0, stage_pairs_total=int(pairs_total),
+                          pairs_per_second=None, eta_seconds=None)
+        self.stage_started_at = time.monotonic()
+        self._save()
+
+    def advance(self, pairs):
+        self.block["pairs_done"] += int(pairs)
+        self.block["stage_pairs_done"] += int(pairs)
+        self.pairs_done += int(pairs)
+        if time.monotonic() - self.reported_at >= GeneralConfig.PROGRESS_LOG_INTERVAL:
+            self.report()
+
+    def report(self):
+        block = self.block
+        seconds = time.monotonic() - self.stage_started_at
+        if seconds > 0 and block["stage_pairs_done"]:
+            block["pairs_per_second"] = round(block["stage_pairs_done"] / seconds)
+            block["eta_seconds"] = round(max(block["stage_pairs_total"] - block["stage_pairs_done"], 0)
+                                         / block["pairs_per_second"], 1)
+        self.log("info", "分块 {} {}：{}/{} 对，{} 对/秒，预计还需 {} 秒".format(
+            block["key"], block["stage"], block["stage_pairs_done"], block["stage_pairs_total"],
+            block["pairs_per_second"], block["eta_seconds"]), "scan.progress", block=block["key"], stage=block["stage"],
+            pairs_done=block["stage_pairs_done"], pairs_total=block["stage_pairs_total"],
+            pairs_per_second=block["pairs_per_second"], eta_seconds=block["eta_seconds"])
+        self._save()
+
+    def finish_block(self, rewritten):
+        self.block.update(stage="done", rewritten=rewritten, eta_seconds=0,
+                          seconds=round(time.monotonic() - self.block_started_at, 3))
+        self.rewritten += rewritten
+        self.log("info", "分块 {} 更新完成，重写了 {} 位学生的匹配分，耗时 {} 秒".format(
+            self.block["key"], rewritten, self.block["seconds"]), "scan.block_finished", block=self.block["key"],
+            rewritten=rewritten, pairs_done=self.block["pairs_done"], seconds=self.block["seconds"])
+        self._save()
+
+    def finish(self):
+        self._end(SCAN_FINISHED)
+
+    def cancelled(self):
+        self.log("warning", "算法匹配已取消", "scan.cancelled", block=self.block and self.block["key"])
+        self._end(SCAN_CANCELLED)
+
+    def fail(self, error):
+        self.log("error", "算法匹配失败：{}".format(error), "scan.failed", block=self.block and self.block["key"])
+        self._end(SCAN_FAILED, str(error))
+
+    def _end(self, status, error=None):
+        if self.run is None:
+            return
+        db_session.rollback()
+        self.run.status = status
+        self.run.error = error
+        self.run.finished_at = datetime.datetime.now()
+        self._save()
+
+    def _save(self):
+        self.reported_at = time.monotonic()
+        if self.run is None:
+            return
+        self.run.stage = self.block["stage"] if self.block else None
+        self.run.blocks = json.dumps(self.blocks, ensure_ascii=False)
+        self.run.pairs_done = self.pairs_done
+        self.run.rewritten = self.rewritten
+        self.run.updated_at = datetime.datetime.now()
+        db_session.commit()
+
+        if self.run.status == SCAN_RUNNING and \
+                db_session.query(ScanRun.cancel_requested).filter(ScanRun.id == self.run.id).scalar():
+            raise ScanCancelled()
+
+    def _prune(self):
+        oldest = db_session.query(ScanRun.id).order_by(ScanRun.id.desc()).offset(KEEP_RUNS).limit(1).scalar()
+        if oldest is not None:
+            db_session.query(ScanRun) \
+                .filter(ScanRun.id <= oldest, ScanRun.status.notin_([SCAN_QUEUED, SCAN_RUNNING])) \
+                .delete(synchronize_session=False)
+            db_session.commit()
@@ -0,0 +1,176 @@
+import json
+
+from sqlalchemy import func, or_, select
+
+from bulk import purge
+from database import db_session
+from models import MatchingScore, QuestionnaireAnswer, QuestionnaireItem, QuestionnaireRevision, get_system_setting
+
+# 题目的这些字段变化后，已有答案的含义随之改变，需要作废答案
+SEMANTIC_FIELDS = ('type', 'data_type')
+# 只影响展示的字段，修改后答案、向量和匹配分都保留
+DISPLAY_FIELDS = ('title', 'params', 'index')
+
+
+def normalize_item(piece):
+    """把管理员提交的题目转换成与 QuestionnaireItem 字段一致的字典"""
+    type = piece.get('type', 'text')
+    return {
+        'id': piece.get('id', None),
+        'title': piece.get('title', None),
+        'weight': 0 if type == 'text' else piece.get('weight', None),
+        'data_type': piece.get('data_type', None),
+        'params': str(piece.get('params', "{}")),
+        'index': piece.get('index', None),
+        'type': type
+    }
+
+
+def item_snapshot(item):
+    return {
+        'id': item.id,
+        'title': item.title,
+        'weight': float(item.weight) if item.weight is not None else None,
+        'data_type': item.data_type,
+        'params': item.params,
+        'index': item.index,
+        'type': item.type
+    }
+
+
+def changed(old, item, field):
+    # 未提交的字段写入时使用数据库默认值，不算修改
+    return item[field] is not None and old[field] != item[field]
+
+
+def is_fixed_weight(weight):
+    # 权重为负数的题目不允许学生自定义权重，答案的权重与题目一致（见学生提交问卷答案）
+    return weight is not None and float(weight) < 0
+
+
+def diff_items(current, incoming):
+    """
+    比较当前问卷与新问卷，按题目 id 对应，返回
+    added: 新增的题目；removed: 删除的题目 id；retyped: 类型变化、答案作废的题目 id；
+    reweighted: 答案权重需要同步修改的题目 id；edited: 只修改了展示字段的题目 id
+    """
+    current = {item['id']: item for item in current}
+    incoming = {item['id']: item for item in incoming}
+
+    changes = {"added": [], "removed": [], "retyped": [], "reweighted": [], "edited": []}
+    for item_id, item in incoming.items():
+        old = current.get(item_id)
+        if old is None:
+            changes["added"].append(item_id)
+            continue
+
+        if any(changed(old, item, field) for field in SEMANTIC_FIELDS):
+            changes["retyped"].append(item_id)
+            continue
+
+        # 学生自定义的权重保存在答案里，只有固定权重的题目需要把新权重写回答案
+        if changed(old, item, 'weight') and (is_fixed_weight(old['weight']) or is_fixed_weight(item['weight'])):
+            changes["reweighted"].append(item_id)
+        elif any(changed(old, item, field) for field in ('weight',) + DISPLAY_FIELDS):
+            changes["edited"].append(item_id)
+
+    changes["removed"] = [item_id for item_id in current.keys() if item_id not in incoming]
+    return changes
+
+
+def widget_options(questionnaire_json=None):
+    """问卷设计 JSON 里每个控件的 options（选项列表、范围等），按控件名返回，控件名即题目 id"""
+    if questionnaire_json is None:
+        questionnaire_json = get_system_setting("questionnaire_json")
+    try:
+        design = json.loads(questionnaire_json) if questionnaire_json else {}
+    except ValueError:
+        return {}
+
+    options = {}
+    pending = [design]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, list):
+            pending.extend(node)
+        elif isinstance(node, dict):
+            # 栅格、标签页等容器控件的子控件嵌套在 widgetList、cols、tabs 里
+            if isinstance(node.get('options'), dict) and 'type' in node:
+                options[node['options'].get('name') or node.get('id')] = node['options']
+            pending.extend(value for value in node.values() if isinstance(value, (list, dict)))
+    return options
+
+
+def item_options(item, widgets):
+    """题目的 options：优先取问卷设计 JSON 中的控件，其次取题目自己的 params"""
+    if item.id in widgets:
+        return widgets[item.id]
+    try:
+        params = json.loads(item.params) if item.params else {}
+    except ValueError:
+        return {}
+    return params if isinstance(params, dict) else {}
+
+
+def current_items():
+    return [item_snapshot(item) for item in db_session.query(QuestionnaireItem).all()]
+
+
+def invalidated_item_ids(changes):
+    """需要删除匹配分的题目；只改了权重的题目由 apply_items 改写答案权重，匹配任务按新权重重新汇总，不必删除"""
+    return changes["removed"] + changes["retyped"]
+
+
+def invalidate_scores(item_ids, on_progress=None):
+    """删除回答过这些题目的学生的匹配分，其他学生之间的匹配分不受影响"""
+    if not item_ids:
+        return 0
+
+    answered = select(QuestionnaireAnswer.student_id).where(QuestionnaireAnswer.item_id.in_(item_ids))
+    affected_count = db_session.query(func.count(func.distinct(QuestionnaireAnswer.student_id))) \
+        .filter(QuestionnaireAnswer.item_id.in_(item_ids)).scalar()
+    if affected_count == 0:
+        return 0
+
+    answered_count = db_session.query(func.count(func.distinct(QuestionnaireAnswer.student_id))).scalar()
+    if affected_count >= answered_count:
+        # 所有学生都受影响时直接清空整张表
+        return purge(MatchingScore, on_progress=on_progress)
+
+    return purge(MatchingScore,
+                 or_(MatchingScore.from_student_id.in_(answered), MatchingScore.to_student_id.in_(answered)),
+                 on_progress=on_progress)
+
+
+def apply_items(incoming, changes, created_by=None):
+    """按差异修改题目和答案，并记录新版本；调用前应先用 invalidate_scores 删除受影响的匹配分"""
+    incoming = {item['id']: item for item in incoming}
+
+    dropped = changes["removed"] + changes["retyped"]
+    if dropped:
+        purge(QuestionnaireAnswer, QuestionnaireAnswer.item_id.in_(dropped))
+
+    for item_id in changes["reweighted"]:
+        weight = incoming[item_id]['weight']
+        # 改为不固定权重时，答案先沿用新的默认权重，学生之后可以再修改
+        db_session.query(QuestionnaireAnswer) \
+            .filter(QuestionnaireAnswer.item_id == item_id) \
+            .update({QuestionnaireAnswer.weight: weight}, synchronize_session=False)
+
+    if changes["removed"]:
+        db_session.query(QuestionnaireItem) \
+            .filter(QuestionnaireItem.id.in_(changes["removed"])) \
+            .delete(synchronize_session=False)
+
+    for item_id in changes["retyped"] + changes["reweighted"] + changes["edited"]:
+        db_session.query(QuestionnaireItem) \
+            .filter(QuestionnaireItem.id == item_id) \
+            .update({getattr(QuestionnaireItem, field): value for field, value in incoming[item_id].items()
+                     if field != 'id' and value is not None}, synchronize_session=False)
+
+    db_session.bulk_save_objects([QuestionnaireItem(**incoming[item_id]) for item_id in changes["added"]])
+
+    revision = QuestionnaireRevision(items=json.dumps(list(incoming.values()), ensure_ascii=False),
+                                     changes=json.dumps(changes, ensure_ascii=False), created_by=created_by)
+    db_session.add(revision)
+    return revision
@@ -0,0 +1,142 @@
+import threading
+import time
+from functools import wraps
+
+from flask import request
+from flask_jwt_extended import get_jwt
+from sqlalchemy import select, text
+from sqlalchemy.exc import IntegrityError
+
+import metrics
+from config import GeneralConfig
+from database import db_session, engine, replica_engine
+from models import LastWrite
+
+# 读写分离：学生端的只读接口用 replica_reads() 装饰，查询发往只读副本，主库只承担写入和匹配任务
+# 写入和写入之后的读仍然走主库（见 database.RoutingSession）
+# 副本延迟超过 DATABASE_REPLICA_MAX_LAG 秒、复制中断或连不上时改读主库
+# 写入过数据的请求在响应里设置 cookie，之后 DATABASE_REPLICA_MAX_LAG 秒内同一个客户端的请求都读主库，
+# 能读到自己刚写入的数据；过了这段时间副本一定已经追上，否则延迟超限，本来就读主库
+# 浏览器可能不保存或不发送这个 cookie（跨站请求），所以同时在主库的 last_writes 里按登录身份记录最后一次写入的时间，
+# 没有 cookie 时查这张表，多个 API 实例之间也能共享
+
+STICKY_COOKIE = "rmmt_primary_until"
+
+_lock = threading.Lock()
+_lag = None
+_checked_at = None
+
+REPLICA_LAG = metrics.Gauge("rmmt_db_replica_lag_seconds", "只读副本的复制延迟，-1 表示复制中断或无法连接")
+REPLICA_READS = metrics.Counter("rmmt_db_replica_reads_total", "只读接口的请求按读取的库计数", ("database",))
+
+
+def _query_lag():
+    """副本落后主库的秒数，复制中断或无法连接时返回 None；不是 MySQL 复制的副本（如本地的 SQLite）视为没有延迟"""
+    if replica_engine.dialect.name != "mysql":
+        return 0
+    try:
+        with replica_engine.connect() as connection:
+            try:
+                row = connection.execute(text("SHOW REPLICA STATUS")).mappings().first()
+                column = "Seconds_Behind_Source"
+            except Exception:
+                # MySQL 8.0.22 之前的版本
+                row = connection.execute(text("SHOW SLAVE STATUS")).mappings().first()
+                column = "Seconds_Behind_Master"
+    except Exception:
+        return None
+    if row is None:
+        # 没有配置复制，例如本地用来测试的第二个实例
+        return 0
+    return row[column]
+
+
+def replica_lag():
+    """每个进程最多每 DATABASE_REPLICA_LAG_CHECK_SECONDS 秒查询一次"""
+    global _lag, _checked_at
+    with _lock:
+        if _checked_at is not None and time.monotonic() - _checked_at < GeneralConfig.DATABASE_REPLICA_LAG_CHECK_SECONDS:
+            return _lag
+        _checked_at = time.monotonic()
+    lag = _query_lag()
+    _lag = lag
+    REPLICA_LAG.set(-1 if lag is None else lag)
+    return lag
+
+
+def _identity():
+    """当前请求的登录身份，没有登录时返回 None"""
+    try:
+        jwt_data = get_jwt()
+    except RuntimeError:
+        return None
+    if "sub" not in jwt_data:
+        return None
+    return "{}:{}".format(jwt_data.get("role", "student"), jwt_data["sub"])
+
+
+def _record_write(identity):
+    table = LastWrite.__table__
+    now = time.time()
+    with engine.begin() as connection:
+        updated = connection.execute(table.update().where(table.c.identity == identity)
+                                     .values(written_at=now)).rowcount
+    if not updated:
+        try:
+            with engine.begin() as connection:
+                connection.execute(table.insert().values(identity=identity, written_at=now))
+        except IntegrityError:
+            # 同一身份的并发请求已经插入，时间相差无几
+            pass
+
+
+def _written_recently(identity):
+    table = LastWrite.__table__
+    with engine.connect() as connection:
+        written_at = connection.execute(select(table.c.written_at).where(table.c.identity == identity)).scalar()
+    return written_at is not None and float(written_at) + GeneralConfig.DATABASE_REPLICA_MAX_LAG > time.time()
+
+
+def replica_available():
+    if replica_engine is None:
+        return False
+    if request.cookies.get(STICKY_COOKIE, 0, type=float) > time.time():
+        return False
+    lag = replica_lag()
+    if lag is None or lag > GeneralConfig.DATABASE_REPLICA_MAX_LAG:
+        return False
+    identity = _identity()
+    return identity is None or not _written_recently(identity)
+
+
+def replica_reads():
+    """只读接口的查询发往只读副本，放在登录校验之后（当前用户从主库读取）"""
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            if replica_available():
+                db_session.info["use_replica"] = True
+                REPLICA_READS.inc(database="replica")
+            else:
+                REPLICA_READS.inc(database="primary")
+            return fn(*args, **kwargs)
+
+        return decorator
+
+    return wrapper
+
+
+def init_app(app):
+    @app.after_request
+    def stick_to_primary(response):
+        # 本次请求写入过数据，之后一段时间内读主库
+        if replica_engine is not None and db_session.info.get("wrote"):
+            until = time.time() + GeneralConfig.DATABASE_REPLICA_MAX_LAG
+            # http 部署（docker-compose、本地测试）时 secure 的 cookie 会被浏览器丢弃
+            response.set_cookie(STICKY_COOKIE, str(round(until, 3)),
+                                max_age=int(GeneralConfig.DATABASE_REPLICA_MAX_LAG) + 1,
+                                httponly=True, samesite="Lax", secure=request.is_secure)
+            identity = _identity()
+            if identity is not None:
+                _record_write(identity)
+        return response
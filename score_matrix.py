@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import threading
+
+from config import GeneralConfig
+
+# 匹配任务把每个分块的匹配分发布为 (n, n) 的 .npy 文件，API 进程用 memmap 只读打开，
+# 同一台机器上的所有 gunicorn worker 共享操作系统的页缓存，读推荐列表不再查询 matching_scores
+# 第 j 行是学生 ids[j] 收到的匹配分：matrix[j, i] 为 ids[i] → ids[j] 的分数，没有分数为 NaN
+
+
+def block_key(gender, category=None):
+    """匹配分块的名字，同一块内的学生两两计算匹配分"""
+    key = "gender-{}".format(gender)
+    if category is not None:
+        key += "-" + hashlib.sha1(category.encode("utf8")).hexdigest()[:12]
+    return key
+
+
+def block_path(key):
+    return os.path.join(GeneralConfig.SCORE_MATRIX_PATH, key)
+
+
+class ScoreMatrix:
+    def __init__(self, key):
+        self.path = block_path(key)
+        self.current_path = os.path.join(self.path, "current.json")
+        self.version = None
+        self.ids = None
+        self.matrix = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """发布了新版本时重新打开文件，返回是否有可用的版本"""
+        try:
+            mtime = os.stat(self.current_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime:
+            return True
+
+        # numpy 只在真正读取匹配分时才导入
+        import numpy as np
+
+        with self._lock:
+            with open(self.current_path) as f:
+                current = json.load(f)
+            try:
+                self.ids = np.load(os.path.join(self.path, current["ids"]))
+                self.matrix = np.load(os.path.join(self.path, current["scores"]), mmap_mode="r")
+            except FileNotFoundError:
+                # 读取 current.json 和打开文件之间又发布了新版本，下次请求再重新打开
+                return self.matrix is not None
+            self.version = current["version"]
+            self._mtime = mtime
+        return True
+
+    def rows(self, student_ids):
+        import numpy as np
+
+        student_ids = np.asarray(student_ids, dtype=np.int64)
+        rows = np.searchsorted(self.ids, student_ids)
+        rows_clipped = np.minimum(rows, len(self.ids) - 1)
+        found = (rows < len(self.ids)) & (self.ids[rows_clipped] == student_ids) if len(self.ids) else \
+            np.zeros(len(student_ids), dtype=bool)
+        return rows_clipped, found
+
+    def _received_columns(self, student_id, from_ids):
+        """学生所在的行和其中有分数的列，学生不在该分块里时返回 None"""
+        import numpy as np
+
+        (row,), (found,) = self.rows([student_id])
+        if not found:
+            return None
+
+        scores = np.asarray(self.matrix[row])
+        if from_ids is None:
+            columns = np.flatnonzero(~np.isnan(scores))
+        else:
+            columns, column_found = self.rows(from_ids)
+            columns = columns[column_found]
+            columns = columns[~np.isnan(scores[columns])]
+        return scores, columns
+
+    def received(self, student_id, from_ids=None, limit=None):
+        """
+        学生收到的匹配分，按分数从高到低返回 [(from_id, score)]，学生不在该分块里时返回 None
+        from_ids 不为空时只返回这些学生发出的分数，limit 不为空时只返回分数最高的 limit 个
+        """
+        import numpy as np
+
+        result = self._received_columns(student_id, from_ids)
+        if result is None:
+            return None
+        scores, columns = result
+
+        values = -scores[columns]
+        if limit is not None and 0 <= limit < len(columns):
+            # 先用 argpartition 选出前 limit 个再排序，不必对整行排序；与第 limit 名同分的按原顺序取，结果与整行排序一致
+            if limit == 0:
+                selected = np.zeros(0, dtype=np.int64)
+            else:
+                threshold = values[np.argpartition(values, limit - 1)[limit - 1]]
+                better = np.flatnonzero(values < threshold)
+                tied = np.flatnonzero(values == threshold)[:limit - len(better)]
+                selected = np.sort(np.concatenate([better, tied]))
+            columns = columns[selected]
+            values = values[selected]
+        columns = columns[np.argsort(values, kind="stable")]
+
+        return list(zip(self.ids[columns].tolist(), scores[columns].astype(float).round(2).tolist()))
+
+    def senders(self, student_id, from_ids=None):
+        """给该学生打过分的学生 id（不排序），学生不在该分块里时返回 None"""
+        result = self._received_columns(student_id, from_ids)
+        if result is None:
+            return None
+        return self.ids[result[1]].tolist()
+
+    def score(self, from_id, to_id):
+        rows, found = self.rows([to_id, from_id])
+        if not found.all():
+            return None
+        value = float(self.matrix[rows[0], rows[1]])
+        return None if value != value else round(value, 2)
+
+
+_matrices = {}
+
+
+def get_score_matrix(key):
+    """返回该分块已发布的匹配分矩阵，没有发布过时返回 None，调用方应回退到查询数据库"""
+    matrix = _matrices.get(key)
+    if matrix is None:
+        matrix = _matrices.setdefault(key, ScoreMatrix(key))
+    return matrix if matrix.refresh() else None
+
+
+def published_blocks():
+    """各分块已发布的版本和学生数"""
+    blocks = []
+    root = GeneralConfig.SCORE_MATRIX_PATH
+    for key in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        matrix = get_score_matrix(key)
+        if matrix is not None:
+            blocks.append({"key": key, "version": matrix.version, "students": len(matrix.ids)})
+    return blocks
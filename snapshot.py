@@ -0,0 +1,76 @@
+import numpy as np
+from sqlalchemy import Float, select, type_coerce
+
+from database import db_session
+from models import QuestionnaireAnswer, Student
+from partitions import category_filter
+
+# 匹配任务读取一个分块内所有答案的快照：一条 Core 查询流式读取，按列放进 numpy 数组，
+# 不创建 ORM 对象，也不进入 session 的 identity map
+# 文本答案的向量很大，只在需要重新计算相似度的行用到，由 matching.load_vectors 按需读取
+
+# 每次从游标读取的行数
+YIELD_PER = 50000
+
+
+class Snapshot:
+    """
+    ids         (n,)  分块内回答过问卷的学生 id，升序
+    categories  (n,)  学生的类别
+    answers     {item_id: (answer_ids, answers, weights)}，各数组长度为 n，按 ids 的顺序排列，未回答为 0 / None / NaN
+    """
+
+    def __init__(self, ids, categories, answers):
+        self.ids = ids
+        self.categories = categories
+        self.answers = answers
+
+
+def load_snapshot(gender, categories=None):
+    """读取一个性别（和若干类别）的学生的全部答案"""
+    # DOUBLE 列默认转换成 Decimal，这里直接按 float 读取
+    statement = select(QuestionnaireAnswer.id, QuestionnaireAnswer.student_id, QuestionnaireAnswer.item_id,
+                       QuestionnaireAnswer.answer, type_coerce(QuestionnaireAnswer.weight, Float), Student.category) \
+        .join(Student, Student.id == QuestionnaireAnswer.student_id) \
+        .where(Student.gender == gender) \
+        .execution_options(yield_per=YIELD_PER)
+    if categories is not None:
+        statement = statement.where(category_filter(Student.category, categories))
+
+    # 直接用 Core 连接执行，行不经过 ORM 的结果处理；每批行转置后整列追加
+    columns = [[] for _ in range(6)]
+    result = db_session.connection().execute(statement)
+    for partition in result.partitions():
+        for column, values in zip(columns, zip(*partition)):
+            column.extend(values)
+    db_session.commit()
+    answer_ids, student_ids, item_ids, answers, weights, student_categories = columns
+
+    ids, first, rows = np.unique(np.asarray(student_ids, dtype=np.int64), return_index=True, return_inverse=True)
+    categories = np.empty(len(ids), dtype=object)
+    categories[:] = [student_categories[index] for index in first]
+    answer_ids = np.asarray(answer_ids, dtype=np.int64)
+    answer_values = np.empty(len(answers), dtype=object)
+    answer_values[:] = answers
+    answer_values[answer_values == None] = ""  # noqa: E711
+    weights = np.nan_to_num(np.asarray(weights, dtype=np.float64), nan=0.0)
+
+    # 按题目排序后切分，每道题的答案散布到按学生排列的数组里
+    n = len(ids)
+    items = {}
+    codes = {}
+    item_index = np.fromiter((codes.setdefault(item_id, len(codes)) for item_id in item_ids), dtype=np.int64,
+                             count=len(item_ids))
+    order = np.argsort(item_index, kind="stable")
+    bounds = np.searchsorted(item_index[order], np.arange(len(codes) + 1))
+    for item_id, index in codes.items():
+        part = order[bounds[index]:bounds[index + 1]]
+        item_answer_ids = np.zeros(n, dtype=np.int64)
+        item_answers = np.full(n, None, dtype=object)
+        item_weights = np.full(n, np.nan)
+        item_answer_ids[rows[part]] = answer_ids[part]
+        item_answers[rows[part]] = answer_values[part]
+        item_weights[rows[part]] = weights[part]
+        items[item_id] = (item_answer_ids, item_answers, item_weights)
+
+    return Snapshot(ids, categories, items)
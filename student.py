@@ -6,7 +6,13 @@ from flask import Blueprint, request, jsonify, redirect
 from flask_jwt_extended import create_access_token, verify_jwt_in_request, get_jwt, current_user
 from sqlalchemy.orm import joinedload
 
+from compatibility import team_compatibility, members_compatibility, team_sizes
+import events
 from database import db_session
+from partitions import category_filter, category_groups, partition_categories, same_partition, \
+    student_partition_key
+from replica import replica_reads
+from score_matrix import get_score_matrix
 from models import Student, QuestionnaireItem, QuestionnaireAnswer, MatchingScore, Team, TeamInvitation, \
     TeamRequest, get_system_setting
 
@@ -192,6 +198,7 @@ def login():
 
 @student_pages.get("/userinfo")
 @student_required()
+@replica_reads()
 def userinfo():
     return jsonify({
         "code": 200,
@@ -216,6 +223,7 @@ def logout():
 
 @student_pages.get('/questionnaire/list')
 @student_required()
+@replica_reads()
 def questionnaire_list():
     questionnaire_items = db_session.query(QuestionnaireItem).order_by(QuestionnaireItem.index.asc()).all()
 
@@ -230,6 +238,7 @@ def questionnaire_list():
 
 @student_pages.get('/questionnaire/answer')
 @student_required()
+@replica_reads()
 def questionnaire_get_answers():
     questionnaire_answers = db_session.query(QuestionnaireAnswer).filter(
         QuestionnaireAnswer.student_id == current_user.id).options(joinedload(QuestionnaireAnswer.item)).all()
@@ -287,11 +296,12 @@ def questionnaire_set_answers():
                 if exist_answer.item_id == key:
                     need_to_create = False
                     if exist_answer.answer != str(value['answer']) or exist_answer.weight != value['weight']:
-                        exist_answer.answer = str(value['answer'])
+                        # 只改权重时保留文本向量，匹配任务按新权重重新汇总即可
+                        if exist_answer.answer != str(value['answer']):
+                            exist_answer.answer = str(value['answer'])
+                            exist_answer.vector = None
                         exist_answer.weight = value['weight']
                         exist_answer.updated_at = datetime.datetime.now()
-                        # exist_answer.vector = json.dumps(model.encode(exist_answer.answer).tolist())
-                        exist_answer.vector = None
                         db_session.commit()
                         data_changed = True
 
@@ -305,14 +315,9 @@ def questionnaire_set_answers():
 
         if data_changed:
             db_session.bulk_save_objects(bulk_save_models)
-            db_session.commit()
-
-            # 删除匹配得分
-            db_session.query(MatchingScore) \
-                .filter((MatchingScore.to_student_id == current_user.id) | (
-                    MatchingScore.from_student_id == current_user.id)) \
-                .delete(synchronize_session=False)
-
+            # 通知 worker 重新计算匹配分
+            events.publish(events.EVENT_ANSWERS, current_user.id)
+            # 旧的匹配分在重新计算前继续用于推荐，匹配任务只重写这位学生的匹配分
             db_session.commit()
 
     return jsonify({
@@ -323,36 +328,62 @@ def questionnaire_set_answers():
 
 @student_pages.get('/team/recommend_teammates')
 @student_required()
+@replica_reads()
 def team_recommend_teammates():
-    recommend_scores = db_session.query(MatchingScore) \
-        .where(MatchingScore.to_student_id == current_user.id) \
-        .options(joinedload(MatchingScore.from_student)) \
-        .order_by(MatchingScore.score.desc()) \
-        .all()
+    limit = request.args.get('limit', None, type=int)
+    recommend_scores = None
+    scored_student_ids = None
+
+    # 优先从匹配任务发布的匹配分矩阵读取，没有发布或该学生还不在矩阵里时查询数据库
+    # 同一分块里的学生都可以组队：同性别，同一类别或管理员设置的可以混寝的类别
+    groups = category_groups()
+    categories = partition_categories(current_user.category, groups)
+    matrix = get_score_matrix(student_partition_key(current_user, groups))
+    if matrix is not None:
+        candidates = {student.id: student for student in db_session.query(Student)
+                      .where(Student.gender == current_user.gender)
+                      .where(category_filter(Student.category, categories))
+                      .all()}
+        received = matrix.received(current_user.id, from_ids=list(candidates.keys()), limit=limit)
+        if received is not None:
+            recommend_scores = [(candidates[student_id], score) for student_id, score in received]
+            scored_student_ids = matrix.senders(current_user.id, from_ids=list(candidates.keys()))
+
+    if recommend_scores is None:
+        recommend_scores = db_session.query(MatchingScore) \
+            .where(MatchingScore.to_student_id == current_user.id) \
+            .options(joinedload(MatchingScore.from_student)) \
+            .order_by(MatchingScore.score.desc()) \
+            .all()
 
-    construct_data = []
-    added_student_ids = []
-    for piece in recommend_scores:
-        if not (piece.from_student.gender == current_user.gender and piece.from_student.category == current_user.category):
-            continue
-        item = piece.from_student.to_dict(only=['id', 'name', 'contact', 'qq', 'wechat', 'province', 'mbti'])
         # join load 不能执行关联查询 所以在这里手动过滤
-        
-        team_id = piece.from_student.team_id
-        team_students = db_session.query(Student) \
-            .where(Student.team_id == team_id) \
-            .where(team_id != None) \
-            .all()
+        recommend_scores = [(piece.from_student, piece.score) for piece in recommend_scores
+                            if piece.from_student.gender == current_user.gender
+                            and piece.from_student.category in categories]
+        scored_student_ids = [student.id for student, _ in recommend_scores]
+
+    # 有分数的学生都不算在“没有分数”的列表里，limit 只截断推荐列表
+    recommend_scores = recommend_scores[:limit]
 
-        item['score'] = piece.score
-        item['team_students_num'] = len(team_students)
+    # 队伍人数和契合度各用一次查询批量取出，避免逐个学生查询
+    team_ids = [student.team_id for student, _ in recommend_scores]
+    sizes = team_sizes(team_ids)
+    compatibilities = team_compatibility(current_user.id, team_ids)
+
+    construct_data = []
+    for student, score in recommend_scores:
+        item = student.to_dict(only=['id', 'name', 'contact', 'qq', 'wechat', 'province', 'mbti'])
+        team_id = student.team_id
+
+        item['score'] = score
+        item['team_students_num'] = sizes.get(team_id, 0)
+        item['team_compatibility'] = compatibilities.get(team_id)
         construct_data.append(item)
-        added_student_ids.append(item['id'])
 
     students_with_no_score = db_session.query(Student) \
         .where(Student.gender == current_user.gender) \
-        .where(Student.category == current_user.category) \
-        .where(Student.id.not_in(added_student_ids)) \
+        .where(category_filter(Student.category, categories)) \
+        .where(Student.id.not_in(scored_student_ids)) \
         .all()
 
     students_with_no_score = [piece.to_dict(only=['id', 'name', 'contact', 'qq', 'wechat', 'province', 'mbti']) for piece
@@ -392,7 +423,7 @@ def team_invite():
                 "msg": "不支持男女混寝"
             })
             
-        if target_student.category != current_user.category:
+        if not same_partition(target_student.category, current_user.category):
             return jsonify({
                 "code": 400,
                 "msg": "不支持不同专业/培养层次混寝"
@@ -424,7 +455,7 @@ def team_invite():
                     "msg": "不支持男女混寝"
                 })
             
-            if team.category != target_student.category:
+            if not same_partition(team.category, target_student.category):
                 return jsonify({
                     "code": 400,
                     "msg": "不支持不同专业/培养层次混寝"
@@ -525,7 +556,7 @@ def team_request():
                     "msg": "不支持男女混寝"
                 })
             
-            if team.category != current_user.category:
+            if not same_partition(team.category, current_user.category):
                 return jsonify({
                     "code": 400,
                     "msg": "不支持不同专业/培养层次混寝"
@@ -583,6 +614,7 @@ def team_request():
 
 @student_pages.get('/team/invitations')
 @student_required()
+@replica_reads()
 def team_invitation_list():
     # 返回自己发出去和收到的组队申请
     team_invitations = db_session \
@@ -610,6 +642,7 @@ def team_invitation_list():
 
 @student_pages.get('/team/requests')
 @student_required()
+@replica_reads()
 def team_request_list():
     if current_user.team_id is None:
         # 如果没有入队，则返回申请列表
@@ -620,9 +653,11 @@ def team_request_list():
             .order_by(TeamRequest.id.desc()) \
             .all()
 
-        team_requests = [team_request.to_dict(
+        compatibilities = team_compatibility(current_user.id, [team_request.team_id for team_request in team_requests])
+        team_requests = [dict(team_request.to_dict(
             ['id', 'team_id', 'team.id', 'team.description', 'reason', 'team.students.id', 'team.students.name',
-             'status', 'student.id', 'student.name', 'created_at']) for
+             'status', 'student.id', 'student.name', 'created_at']),
+            team_compatibility=compatibilities.get(team_request.team_id)) for
             team_request in
             team_requests]
 
@@ -642,7 +677,10 @@ def team_request_list():
         .order_by(TeamRequest.id.desc()) \
         .all()
 
-    team_requests = [team_request.to_dict(['id', 'status', 'student.id', 'reason', 'student.name', 'created_at']) for
+    compatibilities = members_compatibility(current_user.team_id,
+                                            [team_request.student_id for team_request in team_requests])
+    team_requests = [dict(team_request.to_dict(['id', 'status', 'student.id', 'reason', 'student.name', 'created_at']),
+                          team_compatibility=compatibilities.get(team_request.student_id)) for
                      team_request
                      in
                      team_requests]
@@ -837,6 +875,7 @@ def team_request_process():
 
 @student_pages.get("/system_setting")
 @student_required()
+@replica_reads()
 def get_system_settings():
     return jsonify({
         "code": 200,
@@ -857,47 +896,63 @@ def get_system_settings():
 
 @student_pages.get("/student/<int:id>")
 @student_required()
+@replica_reads()
 def get_student_detail(id):
     # TODO:: 优化Questionnaire_item的 SQL
     student = db_session.query(Student).filter(Student.id == id) \
         .outerjoin(Team).outerjoin(QuestionnaireAnswer) \
         .first()
 
-    matching_score = db_session.query(MatchingScore) \
-        .filter(MatchingScore.from_student_id == student.id) \
-        .filter(MatchingScore.to_student_id == current_user.id) \
-        .first()
+    student.score = None
+    matrix = get_score_matrix(student_partition_key(current_user))
+    if matrix is not None:
+        student.score = matrix.score(student.id, current_user.id)
 
-    if matching_score is not None:
-        student.score = matching_score.score
-    else:
-        student.score = None
+    if student.score is None:
+        matching_score = db_session.query(MatchingScore) \
+            .filter(MatchingScore.from_student_id == student.id) \
+            .filter(MatchingScore.to_student_id == current_user.id) \
+            .first()
+
+        if matching_score is not None:
+            student.score = matching_score.score
+
+    data = student.to_dict(
+        only=['id', 'name', 'team', 'team_id', 'score', 'questionnaire_answers', 'contact', 'team.id',
+              'team.students.id', 'qq', 'wechat', 'province', 'mbti',
+              'team.students.name', 'team.students.contact', 'team.students.qq', 'team.students.wechat',
+              'team.students.mbti', 'has_answered_questionnaire'])
+    # 当前学生与对方所在队伍的契合度
+    data['team_compatibility'] = team_compatibility(current_user.id, [student.team_id]).get(student.team_id)
 
     return jsonify({
         "code": 200,
         "msg": "success",
-        "data": student.to_dict(
-            only=['id', 'name', 'team', 'team_id', 'score', 'questionnaire_answers', 'contact', 'team.id',
-                  'team.students.id', 'qq', 'wechat', 'province', 'mbti',
-                  'team.students.name', 'team.students.contact', 'team.students.qq', 'team.students.wechat',
-                  'team.students.mbti', 'has_answered_questionnaire'])
+        "data": data
     })
 
 
 @student_pages.get("/team/detail")
 @student_required()
+@replica_reads()
 def get_team_detail():
     if current_user.team is None:
         return jsonify({
             "code": 400,
             "msg": "你还没有加入任何队伍"
         })
+    data = current_user.team.to_dict(['id', 'description', 'students.id',
+                                      'students.name', 'students.contact', 'students.qq', 'students.wechat' ,'students.has_answered_questionnaire',
+                                      'students.questionnaire_answers'])
+    # 每位成员与其他成员的契合度
+    compatibilities = members_compatibility(current_user.team_id)
+    for student in data['students']:
+        student['compatibility'] = compatibilities.get(student['id'])
+
     return jsonify({
         "code": 200,
         "msg": "success",
-        "data": current_user.team.to_dict(['id', 'description', 'students.id',
-                                           'students.name', 'students.contact', 'students.qq', 'students.wechat' ,'students.has_answered_questionnaire',
-                                           'students.questionnaire_answers'])
+        "data": data
     })
 
 
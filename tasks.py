@@ -1,158 +1,97 @@
-import decimal
-import json
-import numpy as np
+import datetime
+import threading
+from functools import wraps
 
 import arrow
 from apscheduler.schedulers.blocking import BlockingScheduler
 
-from sqlalchemy.orm import joinedload
-
 import config
+import metrics
+from encoders import get_encoder
+from events import EVENT_EXCHANGING, EVENT_JOB, EVENT_SCAN, MATCHING_EVENTS, EventWatcher, Signal, prune
+from exchanging import rescored_needs, scan_exchanging_needs
+from jobs import recover_jobs, run_pending_jobs
+from matching import refresh_all
+from progress import SCAN_FULL, SCAN_QUEUED, SCAN_RUNNING, ScanCancelled, ScanProgress, log, recover
 from models import *
 
-from text2vec import cos_sim, SentenceModel
-
+# 编码器在第一次需要计算文本相似度时才加载，空闲一段时间后自动释放
+encoder = get_encoder()
+# 定时扫描和管理员触发的扫描读写同一份缓存，同一时间只能运行一个
+matching_lock = threading.Lock()
 
-model = SentenceModel()
+# 各任务的唤醒标记，由 dispatch_events 根据新事件设置，任务只在被唤醒时才访问数据库
+# 答案的修改往往连续提交，匹配扫描等提交停下来 MATCHING_DEBOUNCE_SECONDS 秒后再合并计算
+watcher = EventWatcher()
+matching_signal = Signal(config.GeneralConfig.MATCHING_DEBOUNCE_SECONDS,
+                         config.GeneralConfig.MATCHING_MAX_DELAY_SECONDS)
+scans_signal = Signal()
+jobs_signal = Signal()
+exchanging_signal = Signal()
 
 def scan_students():
     if not is_in_calculating_time():
-        output("当前时间不在算法匹配时间段内")
+        log("debug", "当前时间不在算法匹配时间段内")
+        return
+    # 管理员排队的扫描正在执行时，等它结束后再扫描
+    if not matching_lock.acquire(blocking=False):
+        matching_signal.set()
         return
-    else:
-        output("开始进行算法匹配")
 
-    students = db_session.query(Student).all()
-
-    students = [student for student in students if student.has_answered_questionnaire()]
-    student_ids = [[], [], []]  # 0 None,  1 male, 2 female
-    id_to_students = {}
-
-    for student in students:
-        student_ids[student.gender].append(student.id)
-        id_to_students[student.id] = student
-
-    for student in students:
-        output("正在检测学生 {}({}) 的匹配列表是否完整".format(student.name, student.id))
-        # 已经计算了匹配分数的id
-        existed_ids = [id[0]
-                       for id
-                       in db_session.query(MatchingScore.to_student_id)
-                       .filter(MatchingScore.from_student_id == student.id)
-                       .all()
-                       ]
-
-        matching_scores = []
-
-        # compare
-        for target_student_id in student_ids[student.gender]:
-            if target_student_id not in existed_ids:
-                if target_student_id == student.id:
-                    continue
-
-                from_student = student
-                to_student = id_to_students[target_student_id]
-                output("正在计算学生 {}({}) 对 {}({}) 的匹配分数".format(from_student.name, from_student.id,
-                                                                         to_student.name,
-                                                                         to_student.id))
-                score = get_score(from_student=from_student, to_student=to_student)
-                score = decimal.Decimal(score).quantize(decimal.Decimal('0.00'))
-                matching_scores.append(
-                    MatchingScore(from_student_id=from_student.id, to_student_id=to_student.id, score=score)
-                )
-                output("计算完成")
-
-        db_session.bulk_save_objects(matching_scores)
-        db_session.commit()
-
-    output("算法匹配完成")
-
-
-def get_student_by_id(student_id, students):
-    student = db_session.query(Student) \
-        .options(
-        joinedload(Student.sent_matching_scores), joinedload(Student.questionnaire_answers)) \
-        .group_by(Student) \
-        .filter(Student.id == student_id).first()
-
-    return student
-
-
-def get_score(from_student, to_student):
-    to_student_questionnaire_answers = sorted(to_student.questionnaire_answers, key=lambda x: x.item_id)
-    from_student_questionnaire_answers = sorted(from_student.questionnaire_answers, key=lambda x: x.item_id)
-    
-    question_match = {}
-    changes = False
-    i = j = 0
-    
-    while i < len(to_student_questionnaire_answers) and j < len(from_student_questionnaire_answers):
-        to_answer = to_student_questionnaire_answers[i]
-        from_answer = from_student_questionnaire_answers[j]
-        
-        if to_answer.item_id < from_answer.item_id:
-            i += 1
-            continue
-        if to_answer.item_id > from_answer.item_id:
-            j += 1
-            continue
-            
-        # 相同item_id的问题
-        if to_answer.weight <= 0:
-            i += 1
-            j += 1
-            continue
-            
-        # 判断是否是数值型答案（简单启发式方法）
-        if is_numeric_answer(to_answer.answer) and is_numeric_answer(from_answer.answer):
-            # 数值型答案的相似度计算
-            try:
-                num1 = float(to_answer.answer)
-                num2 = float(from_answer.answer)
-                # 使用简单的反比例函数计算相似度（值越接近相似度越高）
-                diff = abs(num1 - num2)
-                value = 1 / (1 + diff)  # 保证结果在0-1之间
-            except ValueError:
-                value = 0
-        else:
-            # 文本型答案的相似度计算（保持原逻辑）
-            if not to_answer.vector:
-                to_answer.vector = json.dumps(model.encode(to_answer.answer).tolist())
-                changes = True
-            if not from_answer.vector:
-                from_answer.vector = json.dumps(model.encode(from_answer.answer).tolist())
-                changes = True
-                
-            vec1 = np.array(json.loads(to_answer.vector))
-            vec2 = np.array(json.loads(from_answer.vector))
-            value = cos_sim(vec1, vec2).item()
-            
-        question_match[to_answer.item_id] = (value, to_answer.weight)
-        i += 1
-        j += 1
-    
-    # 计算加权平均分
-    total_weight = sum(float(w) for _, w in question_match.values())
-    if total_weight > 0:
-        weighted_sum = sum(float(v) * float(w) for v, w in question_match.values())
-        score = (weighted_sum / total_weight) * 100
-    else:
-        score = 0
-    
-    if changes:
-        db_session.commit()
-        
-    return score
-
-def is_numeric_answer(answer):
-    """简单判断是否是数值型答案"""
     try:
-        float(answer)
-        return True
-    except ValueError:
-        return False
+        output("开始进行算法匹配")
+        # 逐题相似度缓存在磁盘上，只重新计算答案有变化的学生，权重变化只需要重新加权汇总
+        # 进度按分块汇总后限频打印，并写入 scan_runs
+        rewritten = run_scan(ScanProgress())
+        output("算法匹配完成，重写了 {} 位学生的匹配分".format(rewritten))
+    finally:
+        matching_lock.release()
 
 
+def run_scan(progress, **options):
+    rescored = set()
+    try:
+        with metrics.Timer(metrics.SCAN_SECONDS):
+            rewritten = refresh_all(progress, rescored=rescored, **options)
+    except ScanCancelled:
+        progress.cancelled()
+        rewritten = 0
+    except Exception as e:
+        progress.fail(e)
+        raise
+    else:
+        progress.finish()
+        metrics.SCAN_REWRITTEN.inc(rewritten)
+    # 匹配分被重写的学生和室友的换寝需求重新寻找换寝环（取消的扫描也已经重写了一部分）
+    rescored_needs(rescored)
+    exchanging_signal.set()
+    return rewritten
+
+
+def run_pending_scans():
+    """执行管理员排队的扫描，不受算法匹配时间段限制"""
+    while True:
+        run = db_session.query(ScanRun) \
+            .filter(ScanRun.status == SCAN_QUEUED) \
+            .order_by(ScanRun.id.asc()) \
+            .first()
+        if run is None:
+            return
+        if not matching_lock.acquire(blocking=False):
+            scans_signal.set()
+            return
+
+        try:
+            run.status = SCAN_RUNNING
+            run.started_at = datetime.datetime.now()
+            db_session.commit()
+            output("开始执行管理员触发的算法匹配 #{}（{}）".format(run.id, run.mode))
+            rewritten = run_scan(ScanProgress(run=run), category=run.category, force=True,
+                                 rebuild=run.mode == SCAN_FULL)
+            output("算法匹配 #{} 结束，重写了 {} 位学生的匹配分".format(run.id, rewritten))
+        finally:
+            matching_lock.release()
+
 
 def is_in_calculating_time():
     start_time_string = db_session.query(SystemSetting.value).filter(SystemSetting.key == "step_2_start_at").first()[0]
@@ -163,8 +102,39 @@ def is_in_calculating_time():
 
 
 def output(message):
-    time_prefix = "[{}] ".format(arrow.now("Asia/Shanghai").format("YYYY-MM-DD HH:mm:ss"))
-    print(time_prefix + message)
+    log("info", message)
+
+
+def dispatch_events():
+    types = watcher.poll()
+    if types & set(MATCHING_EVENTS):
+        matching_signal.set()
+    if EVENT_SCAN in types:
+        scans_signal.set()
+    if EVENT_JOB in types:
+        jobs_signal.set()
+    if EVENT_EXCHANGING in types:
+        exchanging_signal.set()
+
+
+def wake_all():
+    # 兜底：被跳过的事件、直接修改数据库、算法匹配时间段开始等情况没有事件
+    for signal in (matching_signal, scans_signal, jobs_signal, exchanging_signal):
+        signal.set()
+
+
+def when(signal, function):
+    @wraps(function)
+    def wrapper():
+        if signal.due():
+            try:
+                function()
+            except Exception:
+                # 执行失败时保留标记，下一轮重试，不必等兜底
+                signal.set()
+                raise
+
+    return wrapper
 
 
 if __name__ == '__main__':
@@ -173,6 +143,24 @@ if __name__ == '__main__':
         'max_instances': 1
     })
 
-    scheduler.add_job(scan_students, "interval", seconds=config.GeneralConfig.ASYNC_JOB_SCAN_INTERVAL)
+    recover()
+    recover_jobs()
+    # 启动时所有任务先执行一次
+    wake_all()
+    watcher.poll()
+
+    poll = config.GeneralConfig.EVENT_POLL_INTERVAL
+    scheduler.add_job(dispatch_events, "interval", seconds=poll)
+    scheduler.add_job(when(matching_signal, scan_students), "interval", seconds=poll)
+    scheduler.add_job(when(scans_signal, run_pending_scans), "interval", seconds=poll)
+    scheduler.add_job(when(jobs_signal, run_pending_jobs), "interval", seconds=poll)
+    scheduler.add_job(when(exchanging_signal, scan_exchanging_needs), "interval", seconds=poll)
+    scheduler.add_job(wake_all, "interval", seconds=config.GeneralConfig.EVENT_FALLBACK_SECONDS)
+    scheduler.add_job(prune, "interval", hours=1)
+    scheduler.add_job(encoder.unload_if_idle, "interval", seconds=60)
+
+    # 匹配进度和耗时的指标，供 Prometheus 抓取
+    if config.GeneralConfig.METRICS_PORT:
+        metrics.serve(config.GeneralConfig.METRICS_PORT)
 
     scheduler.start()